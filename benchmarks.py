@@ -0,0 +1,325 @@
+"""Benchmarks de rendimiento del Sistema de Análisis de Riesgo EPS/IPS.
+
+
+Uso:
+   python benchmarks.py motores --entidades 20000
+   python benchmarks.py backends --entidades 2000 --filas-por-entidad 50
+   python benchmarks.py incremental --entidades 2000 --filas-por-entidad 50
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+
+import numpy as np
+import pandas as pd
+
+
+from script import DataProcessor, MLRiskModel, REPSValidator, RiskPredictor, SQLBackend, UploadSchema
+
+
+
+
+def generar_indicadores(n_entidades, semilla=42):
+   """Genera una tabla sintética de indicadores con la forma de calcular_indicadores_por_nit"""
+   rng = np.random.default_rng(semilla)
+   df_indicadores = pd.DataFrame({
+       'razon_corriente': rng.gamma(2.0, 0.8, n_entidades),
+       'prueba_acida': rng.gamma(2.0, 0.6, n_entidades),
+       'razon_endeudamiento': rng.beta(2.0, 2.0, n_entidades),
+       'leverage_financiero': rng.gamma(1.5, 1.0, n_entidades),
+       'roa': rng.normal(0.03, 0.08, n_entidades),
+       'roe': rng.normal(0.06, 0.15, n_entidades),
+       'margen_neto': rng.normal(0.04, 0.1, n_entidades),
+   }, index=pd.Index([str(800000000 + i) for i in range(n_entidades)], name='nit'))
+   return df_indicadores
+
+
+
+
+def _medir(funcion, repeticiones):
+   """Retorna el mejor tiempo (segundos) de varias repeticiones"""
+   tiempos = []
+   for _ in range(repeticiones):
+       inicio = time.perf_counter()
+       funcion()
+       tiempos.append(time.perf_counter() - inicio)
+   return min(tiempos)
+
+
+
+
+def benchmark_motores(n_entidades, repeticiones=3):
+   """Compara latencia y throughput del motor de reglas contra el modelo ML"""
+   df_indicadores = generar_indicadores(n_entidades)
+   registros = df_indicadores.to_dict(orient='index')
+   predictor = RiskPredictor()
+
+
+   def scoring_reglas():
+       return [predictor.predecir_riesgo(indicadores)[0] for indicadores in registros.values()]
+
+
+   # Las etiquetas de entrenamiento salen del motor de reglas
+   etiquetas = pd.Series(scoring_reglas(), index=df_indicadores.index)
+
+
+   resultados = []
+   for algoritmo in ['logistic_regression', 'gradient_boosting']:
+       with tempfile.TemporaryDirectory() as directorio:
+           modelo = MLRiskModel(os.path.join(directorio, 'modelo.joblib'))
+           inicio = time.perf_counter()
+           modelo.entrenar(df_indicadores, etiquetas, algoritmo)
+           tiempo_entrenamiento = time.perf_counter() - inicio
+           modelo.guardar()
+
+
+           inicio = time.perf_counter()
+           modelo_cargado = MLRiskModel(modelo.ruta_modelo)
+           modelo_cargado.cargar()
+           tiempo_carga = time.perf_counter() - inicio
+
+
+       tiempo_lote = _medir(lambda: modelo_cargado.predecir_lote(df_indicadores), repeticiones)
+       tiempo_individual = _medir(lambda: modelo_cargado.predecir_lote(df_indicadores.iloc[:1]), repeticiones)
+       concordancia = (modelo_cargado.predecir_lote(df_indicadores)['Nivel Riesgo'] == etiquetas).mean()
+       resultados.append({
+           'motor': f'ML ({algoritmo})',
+           'tabla_completa_s': tiempo_lote,
+           'latencia_entidad_ms': tiempo_individual * 1000,
+           'entidades_por_s': n_entidades / tiempo_lote,
+           'entrenamiento_s': tiempo_entrenamiento,
+           'carga_s': tiempo_carga,
+           'concordancia_reglas': concordancia
+       })
+
+
+   tiempo_reglas = _medir(scoring_reglas, repeticiones)
+   primera = next(iter(registros.values()))
+   tiempo_regla_individual = _medir(lambda: predictor.predecir_riesgo(primera), repeticiones)
+   resultados.insert(0, {
+       'motor': 'Reglas',
+       'tabla_completa_s': tiempo_reglas,
+       'latencia_entidad_ms': tiempo_regla_individual * 1000,
+       'entidades_por_s': n_entidades / tiempo_reglas,
+       'entrenamiento_s': np.nan,
+       'carga_s': np.nan,
+       'concordancia_reglas': 1.0
+   })
+
+
+   return pd.DataFrame(resultados).set_index('motor')
+
+
+
+
+def generar_movimientos(ruta, n_entidades, filas_por_entidad, semilla=42):
+   """Escribe un CSV sintético de movimientos con la forma del archivo del regulador"""
+   rng = np.random.default_rng(semilla)
+   codigos = np.array(['1105', '1110', '11', '1205', '13', '21', '2105', '22', '3', '51', '55', '4105', '41', '6',
+                       '7', '8105', '9905'])
+   denominaciones = np.array(['activo varios', 'pasivo x', 'gasto', 'otro', 'capital', 'ingresos'])
+   n_filas = n_entidades * filas_por_entidad
+   nits = np.array([str(800000000 + i * 37) for i in range(n_entidades)])
+   razones = np.array([['EPS', 'CLINICA', 'HOSPITAL', 'EMPRESA'][i % 4] + f' {i}' for i in range(n_entidades)])
+   entidad = np.repeat(np.arange(n_entidades), filas_por_entidad)
+   pd.DataFrame({
+       'nit': nits[entidad],
+       'RazonSocial': razones[entidad],
+       'codigoConcepto': codigos[rng.integers(len(codigos), size=n_filas)],
+       'valor': rng.integers(-1000, 100000, size=n_filas).astype(float),
+       'Denominacion': denominaciones[rng.integers(len(denominaciones), size=n_filas)]
+   }).to_csv(ruta, index=False)
+   return n_filas
+
+
+
+
+def _medir_memoria(funcion):
+   """Ejecuta la función una vez y retorna (resultado, segundos, pico de memoria en MB)"""
+   tracemalloc.start()
+   inicio = time.perf_counter()
+   resultado = funcion()
+   segundos = time.perf_counter() - inicio
+   pico = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+   tracemalloc.stop()
+   return resultado, segundos, pico
+
+
+
+
+def _cargar_movimientos(ruta):
+   """Carga el CSV de movimientos con el esquema y el NIT canónico, como la carga de la aplicación"""
+   df = pd.read_csv(ruta, dtype=str)
+   mapeo = UploadSchema.mapear_encabezados(df.columns, set(SQLBackend.COLUMNAS))
+   df, _ = UploadSchema.aplicar_tipos(df[list(mapeo)].rename(columns=mapeo))
+   df['nit'] = REPSValidator.canonicalizar_nits(df['nit'])['nit']
+   return df
+
+
+
+
+def _indicadores_pandas(ruta):
+   """Ruta en memoria: carga con el esquema, clasifica y calcula indicadores con DataProcessor"""
+   df = _cargar_movimientos(ruta)
+   data_processor = DataProcessor()
+   return data_processor.calcular_indicadores_por_nit(data_processor.procesar_dataframe(df))
+
+
+
+
+def _indicadores_sql(ruta):
+   """Ruta out-of-core: carga por lotes a SQLite, clasifica y agrega con SQL"""
+   backend = SQLBackend()
+   try:
+       return backend.procesar_archivo(ruta)
+   finally:
+       backend.cerrar()
+
+
+
+
+def benchmark_backends(n_entidades, filas_por_entidad):
+   """Compara tiempo, pico de memoria y resultados del backend pandas contra el backend SQL"""
+   with tempfile.TemporaryDirectory() as directorio:
+       ruta = os.path.join(directorio, 'movimientos.csv')
+       n_filas = generar_movimientos(ruta, n_entidades, filas_por_entidad)
+
+
+       indicadores_pandas, tiempo_pandas, memoria_pandas = _medir_memoria(lambda: _indicadores_pandas(ruta))
+       indicadores_sql, tiempo_sql, memoria_sql = _medir_memoria(lambda: _indicadores_sql(ruta))
+
+
+   # Diferencia máxima entre ambos resultados (debe ser error de redondeo)
+   df_pandas = pd.DataFrame.from_dict(indicadores_pandas, orient='index').sort_index()
+   df_sql = pd.DataFrame.from_dict(indicadores_sql, orient='index').reindex(df_pandas.index)
+   numericas = df_pandas.select_dtypes('number').columns
+   escala = df_pandas[numericas].abs().clip(lower=1)
+   diferencia = ((df_pandas[numericas] - df_sql[numericas]).abs() / escala).max().max()
+   mismos_textos = (df_pandas[['razon_social', 'tipo_entidad']] == df_sql[['razon_social', 'tipo_entidad']]).all().all()
+
+
+   resultados = []
+   for backend, tiempo, memoria, indicadores in [('pandas', tiempo_pandas, memoria_pandas, indicadores_pandas),
+                                                 ('SQL (SQLite)', tiempo_sql, memoria_sql, indicadores_sql)]:
+       resultados.append({
+           'backend': backend,
+           'filas': n_filas,
+           'entidades': len(indicadores),
+           'tiempo_s': tiempo,
+           'filas_por_s': n_filas / tiempo,
+           'pico_memoria_mb': memoria,
+           'diferencia_relativa_max': diferencia,
+           'mismos_textos': mismos_textos
+       })
+   return pd.DataFrame(resultados).set_index('backend')
+
+
+
+
+def benchmark_incremental(n_entidades, filas_por_entidad, fraccion_cambios=0.05, fraccion_sin_nit=0.01,
+                          semilla=42):
+   """Compara la reclasificación incremental contra la completa (con filas sin NIT) y verifica que coincidan"""
+   with tempfile.TemporaryDirectory() as directorio:
+       ruta = os.path.join(directorio, 'movimientos.csv')
+       n_filas = generar_movimientos(ruta, n_entidades, filas_por_entidad, semilla)
+       df = _cargar_movimientos(ruta)
+   rng = np.random.default_rng(semilla)
+   df.loc[rng.random(n_filas) < fraccion_sin_nit, 'nit'] = np.nan
+
+
+   # Segunda carga: cambian los montos de una fracción de los NITs y de una fila sin NIT
+   data_processor = DataProcessor()
+   snapshot, _, _ = data_processor.procesar_incremental(df)
+   nits = df['nit'].dropna().unique()
+   nits_modificados = rng.choice(nits, size=max(1, int(len(nits) * fraccion_cambios)), replace=False)
+   df_nuevo = df.copy()
+   df_nuevo.loc[df_nuevo['nit'].isin(nits_modificados), 'valor'] *= 1.1
+   df_nuevo.loc[df_nuevo['nit'].isna().idxmax(), 'valor'] += 1
+
+
+   (snapshot_completo, nits_completos, _), tiempo_completo, _ = _medir_memoria(
+       lambda: data_processor.procesar_incremental(df_nuevo)
+   )
+   (snapshot_incremental, nits_reclasificados, _), tiempo_incremental, _ = _medir_memoria(
+       lambda: data_processor.procesar_incremental(df_nuevo, snapshot)
+   )
+
+
+   # Mismas filas clasificadas sin importar el orden (incluidas las filas sin NIT)
+   def ordenar(df_clasificado):
+       return df_clasificado.sort_values(df_clasificado.columns.tolist()).reset_index(drop=True)
+
+
+   mismas_filas = ordenar(snapshot_completo['df_clasificado']).equals(ordenar(snapshot_incremental['df_clasificado']))
+
+
+   # Diferencia máxima entre los indicadores (debe ser error de redondeo: cambia el orden de las sumas)
+   df_completo = pd.DataFrame.from_dict(snapshot_completo['indicadores_por_nit'], orient='index')
+   df_incremental = pd.DataFrame.from_dict(snapshot_incremental['indicadores_por_nit'], orient='index').reindex(
+       index=df_completo.index, columns=df_completo.columns
+   )
+   numericas = df_completo.select_dtypes('number').columns
+   escala = df_completo[numericas].abs().clip(lower=1)
+   diferencia = ((df_completo[numericas] - df_incremental[numericas]).abs() / escala).max().max()
+
+
+   resultados = []
+   for corrida, tiempo, snapshot_corrida, reclasificados in [
+           ('completa', tiempo_completo, snapshot_completo, nits_completos),
+           ('incremental', tiempo_incremental, snapshot_incremental, nits_reclasificados)]:
+       resultados.append({
+           'corrida': corrida,
+           'filas': n_filas,
+           'filas_sin_nit': int(snapshot_corrida['df_clasificado']['nit'].isna().sum()),
+           'grupos_reclasificados': len(reclasificados),
+           'tiempo_s': tiempo,
+           'mismas_filas': mismas_filas,
+           'diferencia_relativa_max': diferencia
+       })
+   return pd.DataFrame(resultados).set_index('corrida')
+
+
+
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+
+   parser_motores = subparsers.add_parser('motores', help='Motor de reglas vs modelo ML')
+   parser_motores.add_argument('--entidades', type=int, default=20000)
+   parser_motores.add_argument('--repeticiones', type=int, default=3)
+
+
+   parser_backends = subparsers.add_parser('backends', help='DataProcessor en memoria vs backend SQL out-of-core')
+   parser_backends.add_argument('--entidades', type=int, default=2000)
+   parser_backends.add_argument('--filas-por-entidad', type=int, default=50)
+
+
+   parser_incremental = subparsers.add_parser('incremental', help='Reclasificación incremental vs corrida completa')
+   parser_incremental.add_argument('--entidades', type=int, default=2000)
+   parser_incremental.add_argument('--filas-por-entidad', type=int, default=50)
+
+
+   args = parser.parse_args()
+
+
+   if args.benchmark == 'motores':
+       resultado = benchmark_motores(args.entidades, args.repeticiones)
+   elif args.benchmark == 'backends':
+       resultado = benchmark_backends(args.entidades, args.filas_por_entidad)
+   elif args.benchmark == 'incremental':
+       resultado = benchmark_incremental(args.entidades, args.filas_por_entidad)
+
+
+   with pd.option_context('display.width', 200, 'display.max_columns', None):
+       print(resultado.round(4))
+
+
+
+
+if __name__ == '__main__':
+   main()
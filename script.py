@@ -7,6 +7,33 @@ from datetime import datetime
 import warnings
 import time
 import re
+import os
+import shutil
+import sys
+import hashlib
+import json
+import threading
+import uuid
+import sqlite3
+import tempfile
+import io
+import importlib.util
+import pickle
+from operator import itemgetter
+import bisect
+import unicodedata
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import joblib
+from scipy import sparse
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.exceptions import NotFittedError
+from sklearn.linear_model import LogisticRegression
+from sklearn.neighbors import NearestNeighbors
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.utils.validation import check_is_fitted
 
 
 warnings.filterwarnings('ignore')
@@ -241,18 +268,72 @@ class REPSValidator:
 
 
    def _limpiar_nit(self, nit):
-       """Limpia y formatea el NIT"""
+       """Limpia y formatea el NIT (mismas reglas que canonicalizar_nits)"""
        if pd.isna(nit):
            return ""
-       nit_str = str(nit).strip()
-       if '.' in nit_str:
-           try:
-               nit_float = float(nit_str)
-               nit_str = str(int(nit_float))
-           except ValueError:
-               pass
-       nit_limpio = re.sub(r'[^\d]', '', nit_str)
-       return nit_limpio
+       if isinstance(nit, str) and nit.isdigit():
+           # Ya canónico (caso normal: la columna se canonicalizó al cargar)
+           return nit
+       return self.canonicalizar_nits(pd.Series([nit]))['nit'].iloc[0]
+
+
+   # Pesos DIAN del dígito de verificación, del dígito más significativo (posición 15) al menos significativo
+   PESOS_DIGITO_VERIFICACION = np.array([71, 67, 59, 53, 47, 43, 41, 37, 29, 23, 19, 17, 13, 7, 3])
+
+
+   @classmethod
+   def canonicalizar_nits(cls, serie):
+       """Normaliza NITs en una pasada vectorizada: NIT canónico y dígito de verificación informado/calculado"""
+       # Cada NIT distinto se procesa una vez
+       codigos, unicos = pd.factorize(serie.astype(object).where(serie.notna()))
+       texto = pd.Series(unicos, dtype=object).astype(str).str.strip().astype('string[pyarrow]')
+
+
+       # Separar el dígito de verificación informado con guion
+       partes = texto.str.extract(r'^(.*[0-9])\s*[-‐–]\s*([0-9])$')
+       base = partes[0].fillna(texto)
+       digito_informado = pd.to_numeric(partes[1], errors='coerce').astype('float64')
+
+
+       # "800123456.0" o "8.00123456E8": valores numéricos leídos como flotante
+       flotante = base.str.fullmatch(r'[0-9]+\.0+|[0-9]+(\.[0-9]+)?[eE]\+?[0-9]+').fillna(False).to_numpy(dtype=bool)
+       if flotante.any():
+           base[flotante] = pd.to_numeric(base[flotante]).round().astype('int64').astype(str)
+       base = base.str.replace(r'[^0-9]', '', regex=True)
+
+
+       digito_calculado = cls.calcular_digito_verificacion(base)
+       digito_valido = (digito_calculado == digito_informado).where(digito_informado.notna())
+       unicos_canonicos = pd.DataFrame({
+           'nit': base.astype(object),
+           'digito_informado': digito_informado,
+           'digito_calculado': digito_calculado,
+           'digito_valido': digito_valido.astype(object)
+       })
+
+
+       # Volver a las filas originales (los NIT vacíos quedan como NaN)
+       resultado = unicos_canonicos.reindex(codigos)
+       resultado.index = serie.index
+       return resultado
+
+
+   @classmethod
+   def calcular_digito_verificacion(cls, nits):
+       """Calcula el dígito de verificación DIAN de una serie de NITs (solo dígitos, máximo 15)"""
+       nits = pd.Series(nits, dtype=object)
+       longitudes = nits.str.len()
+       validos = ((longitudes > 0) & (longitudes <= 15)).fillna(False).to_numpy(dtype=bool)
+       digito = pd.Series(np.nan, index=nits.index)
+       if not validos.any():
+           return digito
+
+
+       rellenos = ''.join(nits[validos].str.zfill(15)).encode('ascii')
+       digitos = np.frombuffer(rellenos, dtype=np.uint8).reshape(-1, 15).astype(np.int64) - ord('0')
+       residuo = (digitos @ cls.PESOS_DIGITO_VERIFICACION) % 11
+       digito[validos] = np.where(residuo > 1, 11 - residuo, residuo)
+       return digito
 
 
    def _crear_respuesta_error(self, nit, error):
@@ -274,6 +355,21 @@ class FinancialClassifier:
    """Clase para clasificar cuentas financieras"""
 
 
+   # Palabras clave de la denominación (en orden de prioridad) cuando el código no tiene coincidencia
+   PALABRAS_CLAVE = [
+       (['activo', 'inversión'], 'Activo corriente'),
+       (['pasivo', 'deuda'], 'Pasivo corriente'),
+       (['patrimonio', 'capital'], 'Patrimonio'),
+       (['ingreso', 'venta'], 'Ventas'),
+       (['costo', 'gasto'], 'Costos'),
+   ]
+
+
+   # Columnas de la tabla de consulta por código y de la tabla de auditoría
+   COLUMNAS_TABLA = ['categoria_principal', 'subcategoria', 'confianza_clasificacion', 'regla']
+   SIN_COINCIDENCIA = ('No clasificada', 'No clasificada', 0.0, 'Sin coincidencia de código')
+
+
    def __init__(self):
        self.categorias_map = self._inicializar_categorias()
 
@@ -308,319 +404,2475 @@ class FinancialClassifier:
            return 'No clasificada', 'No clasificada', 0.0
 
 
-       codigo_str = str(codigo_concepto).strip()
+       clasificacion = self._clasificar_codigo(str(codigo_concepto).strip())
+       if clasificacion is None:
+           clasificacion = self._clasificar_denominacion(denominacion)
+       return clasificacion[:3]
+
+
+   def _clasificar_codigo(self, codigo_str):
+       """Clasifica un código por coincidencia exacta o por prefijo; None si no hay coincidencia"""
+       # Buscar coincidencia exacta
+       if codigo_str in self.categorias_map:
+           categoria, subcategoria = self.categorias_map[codigo_str]
+           return categoria, subcategoria, 1.0, 'Código exacto'
+
+
+       # Buscar por prefijo
+       for codigo, (categoria, subcategoria) in self.categorias_map.items():
+           if codigo_str.startswith(codigo):
+               return categoria, subcategoria, 0.8, f'Prefijo {codigo}'
+       return None
+
+
+   def _clasificar_denominacion(self, denominacion):
+       """Clasificación por palabras clave de la denominación"""
+       denominacion_lower = str(denominacion).lower()
+       for palabras, categoria in self.PALABRAS_CLAVE:
+           for palabra in palabras:
+               if palabra in denominacion_lower:
+                   return categoria, 'Clasificado por denominación', 0.6, f'Palabra clave: {palabra}'
+       return 'No clasificada', 'No clasificada', 0.0, 'Sin coincidencia de código ni denominación'
+
+
+   def tabla_codigos(self, codigos):
+       """Tabla de consulta: clasificación de cada código distinto (ya como texto), con índice ordenado"""
+       distintos = pd.Index(pd.unique(np.asarray(codigos, dtype=object)), dtype=object, name='codigo').sort_values()
+       filas = [self._clasificar_codigo(codigo) or self.SIN_COINCIDENCIA for codigo in distintos]
+       return pd.DataFrame(filas, index=distintos, columns=self.COLUMNAS_TABLA)
+
+
+   def _clasificar_columnas(self, codigos, denominaciones=None):
+       """Clasifica columnas completas con la tabla de consulta; retorna un DataFrame por fila con la regla"""
+       codigos = pd.Series(codigos).reset_index(drop=True)
+       presente = codigos.notna().to_numpy()
+       codigo_str = np.full(len(codigos), None, dtype=object)
+       codigo_str[presente] = codigos[presente].astype(str).str.strip().to_numpy(dtype=object)
+
+
+       # Una búsqueda por fila en la tabla de códigos distintos; la última posición es "sin código"
+       tabla = self.tabla_codigos(codigo_str[presente])
+       posiciones = tabla.index.get_indexer(codigo_str)
+       posiciones[posiciones < 0] = len(tabla)
+       sin_codigo = ('No clasificada', 'No clasificada', 0.0, 'Sin código')
+       resultado = pd.DataFrame({
+           columna: np.append(tabla[columna].to_numpy(dtype=object), valor)[posiciones]
+           for columna, valor in zip(self.COLUMNAS_TABLA, sin_codigo)
+       })
+       resultado['codigo'] = codigo_str
+       resultado['denominacion'] = None
+
+
+       # Los códigos sin coincidencia se clasifican por denominación, una vez por denominación distinta
+       por_denominacion = presente & (resultado['confianza_clasificacion'].to_numpy(dtype=float) == 0)
+       if por_denominacion.any():
+           if denominaciones is None:
+               denominaciones = pd.Series(np.nan, index=codigos.index)
+           valores = pd.Series(denominaciones).to_numpy(dtype=object)[por_denominacion]
+           indices, unicas = pd.factorize(valores, use_na_sentinel=False)
+           clasificadas = np.array([self._clasificar_denominacion(d) for d in unicas], dtype=object)
+           resultado.loc[por_denominacion, self.COLUMNAS_TABLA] = clasificadas[indices]
+           resultado.loc[por_denominacion, 'denominacion'] = valores
+       resultado['confianza_clasificacion'] = resultado['confianza_clasificacion'].astype(float)
+       return resultado
+
+
+   def clasificar_lote(self, codigos, denominaciones=None):
+       """Clasifica todas las filas (categoría, subcategoría, confianza) en una sola pasada vectorizada"""
+       return self._clasificar_columnas(codigos, denominaciones)[self.COLUMNAS_TABLA[:3]]
+
+
+   def tabla_auditoria(self, codigos, denominaciones=None):
+       """Cómo se clasificó cada código (y la denominación si el código no coincide), con su número de filas"""
+       resultado = self._clasificar_columnas(codigos, denominaciones)
+       return resultado.groupby(
+           ['codigo', 'denominacion'] + self.COLUMNAS_TABLA, dropna=False, sort=False
+       ).size().rename('filas').reset_index().sort_values(['codigo', 'denominacion'], na_position='first',
+                                                           ignore_index=True)
+
+
+
+
+class RiskPredictor:
+   """Clase para predecir riesgo financiero"""
+
+
+   def __init__(self):
+       self.umbrales = self._definir_umbrales()
+
+
+   def _definir_umbrales(self):
+       return {
+           'liquidez_alto_riesgo': 1.0,
+           'liquidez_medio_riesgo': 1.5,
+           'endeudamiento_alto_riesgo': 0.7,
+           'endeudamiento_medio_riesgo': 0.5,
+           'margen_alto_riesgo': 0.0,
+           'margen_medio_riesgo': 0.05,
+           'caida_liquidez_riesgo': -0.2,
+           'aumento_endeudamiento_riesgo': 0.1,
+       }
+
+
+   def predecir_riesgo(self, indicadores):
+       """Predice el riesgo basado en indicadores financieros"""
+       puntaje = 0
+       factores = []
+       umbral = self.umbrales
+
+
+       # Evaluar liquidez
+       liquidez = indicadores.get('razon_corriente', 0)
+       if liquidez < umbral['liquidez_alto_riesgo']:
+           puntaje += 3
+           factores.append(('Liquidez crítica', 0.9))
+       elif liquidez < umbral['liquidez_medio_riesgo']:
+           puntaje += 1
+           factores.append(('Liquidez moderada', 0.6))
+
+
+       # Evaluar endeudamiento
+       endeudamiento = indicadores.get('razon_endeudamiento', 0)
+       if endeudamiento > umbral['endeudamiento_alto_riesgo']:
+           puntaje += 3
+           factores.append(('Endeudamiento alto', 0.9))
+       elif endeudamiento > umbral['endeudamiento_medio_riesgo']:
+           puntaje += 1
+           factores.append(('Endeudamiento moderado', 0.6))
+
+
+       # Evaluar rentabilidad
+       margen = indicadores.get('margen_neto', 0)
+       if margen < umbral['margen_alto_riesgo']:
+           puntaje += 2
+           factores.append(('Pérdidas operacionales', 0.8))
+       elif margen < umbral['margen_medio_riesgo']:
+           puntaje += 1
+           factores.append(('Baja rentabilidad', 0.5))
+
+
+       # Evaluar tendencia frente al periodo anterior (solo si hay histórico)
+       delta_liquidez = indicadores.get('delta_razon_corriente')
+       if delta_liquidez is not None and delta_liquidez <= umbral['caida_liquidez_riesgo']:
+           puntaje += 1
+           factores.append(('Deterioro de liquidez', 0.6))
+
+
+       delta_endeudamiento = indicadores.get('delta_razon_endeudamiento')
+       if delta_endeudamiento is not None and delta_endeudamiento >= umbral['aumento_endeudamiento_riesgo']:
+           puntaje += 1
+           factores.append(('Endeudamiento creciente', 0.6))
+
+
+       # Determinar nivel de riesgo
+       if puntaje >= 6:
+           return "ALTO", min(0.95, 0.6 + (puntaje * 0.05)), factores
+       elif puntaje >= 3:
+           return "MEDIO", min(0.8, 0.3 + (puntaje * 0.1)), factores
+       else:
+           return "BAJO", max(0.1, 0.1 + (puntaje * 0.05)), factores
+
+
+
+
+   def _puntajes_por_componente(self, indicadores, umbrales):
+       """Calcula el puntaje de cada componente; los umbrales pueden ser arreglos (barridos)"""
+       u = umbrales
+       liquidez = indicadores['razon_corriente']
+       endeudamiento = indicadores['razon_endeudamiento']
+       margen = indicadores['margen_neto']
+       delta_liquidez = indicadores['delta_razon_corriente']
+       delta_endeudamiento = indicadores['delta_razon_endeudamiento']
+
+
+       # np.nan en las tendencias nunca cumple la condición (igual que su ausencia)
+       with np.errstate(invalid='ignore'):
+           return {
+               'liquidez': np.where(liquidez < u['liquidez_alto_riesgo'], 3,
+                                    np.where(liquidez < u['liquidez_medio_riesgo'], 1, 0)),
+               'endeudamiento': np.where(endeudamiento > u['endeudamiento_alto_riesgo'], 3,
+                                         np.where(endeudamiento > u['endeudamiento_medio_riesgo'], 1, 0)),
+               'margen': np.where(margen < u['margen_alto_riesgo'], 2,
+                                  np.where(margen < u['margen_medio_riesgo'], 1, 0)),
+               'tendencia_liquidez': np.where(delta_liquidez <= u['caida_liquidez_riesgo'], 1, 0),
+               'tendencia_endeudamiento': np.where(delta_endeudamiento >= u['aumento_endeudamiento_riesgo'], 1, 0),
+           }
+
+
+   def _nivel_desde_puntaje(self, puntaje):
+       """Convierte puntajes en nivel de riesgo y probabilidad (vectorizado)"""
+       nivel = np.select([puntaje >= 6, puntaje >= 3], ['ALTO', 'MEDIO'], 'BAJO').astype(object)
+       probabilidad = np.select(
+           [puntaje >= 6, puntaje >= 3],
+           [np.minimum(0.95, 0.6 + puntaje * 0.05), np.minimum(0.8, 0.3 + puntaje * 0.1)],
+           np.maximum(0.1, 0.1 + puntaje * 0.05)
+       )
+       return nivel, probabilidad
+
+
+   def _arreglos_indicadores(self, df_indicadores):
+       """Extrae los arreglos numéricos que usa el scoring desde la tabla de indicadores"""
+       arreglos = {}
+       for columna in ['razon_corriente', 'razon_endeudamiento', 'margen_neto']:
+           arreglos[columna] = (pd.to_numeric(df_indicadores[columna], errors='coerce').to_numpy(dtype=float)
+                                if columna in df_indicadores.columns else np.zeros(len(df_indicadores)))
+       for columna in ['delta_razon_corriente', 'delta_razon_endeudamiento']:
+           arreglos[columna] = (pd.to_numeric(df_indicadores[columna], errors='coerce').to_numpy(dtype=float)
+                                if columna in df_indicadores.columns else np.full(len(df_indicadores), np.nan))
+
+
+       # Igual que en la evaluación individual: cualquier indicador nulo impide el cálculo
+       columnas_base = [c for c in df_indicadores.columns
+                        if c not in ('razon_social', 'tipo_entidad')
+                        and c not in ('delta_razon_corriente', 'delta_razon_endeudamiento')]
+       numericos = df_indicadores[columnas_base].apply(pd.to_numeric, errors='coerce')
+       arreglos['calculable'] = numericos.notna().all(axis=1).to_numpy()
+       return arreglos
+
+
+   def predecir_riesgo_vectorizado(self, df_indicadores, umbrales=None):
+       """Predice el riesgo de toda la tabla de indicadores en una sola pasada"""
+       umbrales = umbrales or self.umbrales
+       arreglos = self._arreglos_indicadores(df_indicadores)
+       componentes = self._puntajes_por_componente(arreglos, umbrales)
+       puntaje = sum(componentes.values())
+       nivel, probabilidad = self._nivel_desde_puntaje(puntaje)
+
+
+       factores_por_componente = {
+           'liquidez': {3: 'Liquidez crítica (90%)', 1: 'Liquidez moderada (60%)'},
+           'endeudamiento': {3: 'Endeudamiento alto (90%)', 1: 'Endeudamiento moderado (60%)'},
+           'margen': {2: 'Pérdidas operacionales (80%)', 1: 'Baja rentabilidad (50%)'},
+           'tendencia_liquidez': {1: 'Deterioro de liquidez (60%)'},
+           'tendencia_endeudamiento': {1: 'Endeudamiento creciente (60%)'},
+       }
+       factores = pd.Series('', index=df_indicadores.index, dtype=object)
+       for componente, textos in factores_por_componente.items():
+           for puntos, texto in textos.items():
+               mascara = componentes[componente] == puntos
+               factores = factores.mask(mascara, factores + np.where(factores == '', '', ', ') + texto)
+
+
+       calculable = arreglos['calculable']
+       return pd.DataFrame({
+           'Nivel Riesgo': np.where(calculable, nivel, 'NO CALC.'),
+           'Probabilidad': np.where(calculable, probabilidad, 0.0),
+           'Factores Clave': factores.where(calculable, 'Datos insuficientes (100%)')
+       }, index=df_indicadores.index)
+
+
+   def barrido_sensibilidad(self, df_indicadores, parametro, valores, umbrales=None):
+       """Cuenta las entidades por nivel para cada valor de un umbral (una sola pasada vectorizada)"""
+       umbrales = dict(umbrales or self.umbrales)
+       arreglos = self._arreglos_indicadores(df_indicadores)
+       calculable = arreglos['calculable']
+       arreglos = {k: v[calculable][:, None] for k, v in arreglos.items() if k != 'calculable'}
+       valores = np.asarray(valores, dtype=float)
+
+
+       # Niveles como códigos enteros (0=BAJO, 1=MEDIO, 2=ALTO): mismos cortes que _nivel_desde_puntaje
+       cortes = [3, 6]
+       nivel_base = np.digitize(sum(self._puntajes_por_componente(arreglos, umbrales).values()), cortes).ravel()
+
+
+       # Matriz entidades × valores del umbral
+       umbrales[parametro] = valores[None, :]
+       puntaje = sum(np.broadcast_to(c, (len(nivel_base), len(valores)))
+                     for c in self._puntajes_por_componente(arreglos, umbrales).values())
+       nivel = np.digitize(puntaje, cortes)
+
+
+       # Un solo conteo de las transiciones (nivel base, nivel) para cada valor del umbral
+       transicion = nivel_base[:, None] * 3 + nivel + np.arange(len(valores)) * 9
+       conteos = np.bincount(transicion.ravel(), minlength=9 * len(valores)).reshape(len(valores), 3, 3)
+
+
+       codigos = {'BAJO': 0, 'MEDIO': 1, 'ALTO': 2}
+       resultado = pd.DataFrame({'valor_umbral': valores})
+       for etiqueta in ['ALTO', 'MEDIO', 'BAJO']:
+           resultado[etiqueta] = conteos[:, :, codigos[etiqueta]].sum(axis=1)
+       resultado['cambian_de_nivel'] = len(nivel_base) - np.trace(conteos, axis1=1, axis2=2)
+       for origen, destino in [('BAJO', 'MEDIO'), ('MEDIO', 'ALTO'), ('BAJO', 'ALTO'),
+                               ('MEDIO', 'BAJO'), ('ALTO', 'MEDIO'), ('ALTO', 'BAJO')]:
+           resultado[f'{origen}→{destino}'] = conteos[:, codigos[origen], codigos[destino]]
+       return resultado
+
+
+
+
+# Ratios financieros que calcula DataProcessor.calcular_ratios_vectorizado, en orden fijo
+RATIOS_FINANCIEROS = ['razon_corriente', 'prueba_acida', 'razon_endeudamiento', 'leverage_financiero',
+                     'roa', 'roe', 'margen_neto']
+
+
+
+
+class MLRiskModel:
+   """Clase para predecir riesgo financiero con un modelo entrenado"""
+
+
+   FEATURES = RATIOS_FINANCIEROS
+   NIVELES = ['ALTO', 'MEDIO', 'BAJO']
+
+
+   # Fallas de un modelo persistido o cargado: archivo dañado o de otra versión, contenido inválido o sin entrenar
+   ERRORES_MODELO = (OSError, EOFError, pickle.UnpicklingError, ImportError, AttributeError, KeyError, TypeError,
+                     ValueError, NotFittedError)
+
+
+   def __init__(self, ruta_modelo=os.path.join('modelos', 'modelo_riesgo.joblib')):
+       self.ruta_modelo = ruta_modelo
+       self.modelo = None
+       self.metadatos = {}
+
+
+   def _crear_estimador(self, algoritmo):
+       """Crea el estimador según el algoritmo seleccionado"""
+       if algoritmo == 'gradient_boosting':
+           return GradientBoostingClassifier(random_state=42)
+       return make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000))
+
+
+   def _matriz_features(self, df_indicadores):
+       """Obtiene la matriz de features (acotada para ratios extremos)"""
+       X = df_indicadores.reindex(columns=self.FEATURES).apply(pd.to_numeric, errors='coerce')
+       return X.clip(-1e6, 1e6)
+
+
+   def entrenar(self, df_indicadores, etiquetas, algoritmo='logistic_regression'):
+       """Entrena el modelo con la tabla de indicadores y etiquetas por NIT"""
+       etiquetas = etiquetas.astype(str).str.strip().str.upper()
+       etiquetas = etiquetas[etiquetas.isin(self.NIVELES)]
+
+
+       X = self._matriz_features(df_indicadores)
+       datos = X.join(etiquetas.rename('etiqueta'), how='inner').dropna()
+       if datos['etiqueta'].nunique() < 2:
+           raise ValueError("Se requieren al menos dos niveles de riesgo distintos en las etiquetas")
+
+
+       modelo = self._crear_estimador(algoritmo)
+       modelo.fit(datos[self.FEATURES].values, datos['etiqueta'].values)
+
+
+       self.modelo = modelo
+       self.metadatos = {
+           'algoritmo': algoritmo,
+           'muestras': len(datos),
+           'exactitud_entrenamiento': float(modelo.score(datos[self.FEATURES].values, datos['etiqueta'].values)),
+           'fecha_entrenamiento': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+       }
+       return self.metadatos
+
+
+   def guardar(self):
+       """Persiste el modelo entrenado en disco"""
+       if self.modelo is None:
+           raise ValueError("No hay un modelo entrenado para guardar")
+       os.makedirs(os.path.dirname(self.ruta_modelo) or '.', exist_ok=True)
+       joblib.dump({'modelo': self.modelo, 'features': self.FEATURES, 'metadatos': self.metadatos},
+                   self.ruta_modelo)
+
+
+   def cargar(self):
+       """Carga el modelo persistido; retorna False si no existe (lanza ERRORES_MODELO si es inválido)"""
+       if not os.path.exists(self.ruta_modelo):
+           return False
+       contenido = joblib.load(self.ruta_modelo)
+       if not isinstance(contenido, dict) or not hasattr(contenido.get('modelo'), 'predict_proba'):
+           raise TypeError("El archivo no contiene un modelo de riesgo")
+       if list(contenido.get('features', self.FEATURES)) != self.FEATURES:
+           raise ValueError("El modelo se entrenó con otros indicadores; vuelva a entrenarlo")
+       check_is_fitted(contenido['modelo'])
+       self.modelo = contenido['modelo']
+       self.metadatos = contenido.get('metadatos', {})
+       return True
+
+
+   def predecir_lote(self, df_indicadores):
+       """Predice el riesgo de toda la tabla de indicadores en una sola llamada"""
+       X = self._matriz_features(df_indicadores)
+       validos = X.notna().all(axis=1).values
+
+
+       niveles = np.full(len(X), 'NO CALC.', dtype=object)
+       probabilidades = np.zeros(len(X))
+       if validos.any():
+           proba = self.modelo.predict_proba(X.values[validos])
+           clases = np.asarray(self.modelo.classes_)
+           niveles[validos] = clases[proba.argmax(axis=1)]
+           probabilidades[validos] = proba.max(axis=1)
+
+
+       return pd.DataFrame({
+           'Nivel Riesgo': niveles,
+           'Probabilidad': probabilidades
+       }, index=df_indicadores.index)
+
+
+
+
+@st.cache_resource(show_spinner=False)
+def cargar_modelo_riesgo(ruta_modelo, fecha_modificacion):
+   """Carga el modelo de riesgo una sola vez por proceso (y por versión del archivo)"""
+   modelo = MLRiskModel(ruta_modelo)
+   return modelo if modelo.cargar() else None
+
+
+
+
+class AccountMatrix:
+   """Matriz dispersa NIT × (código PUC, categoría) con los valores del archivo clasificado"""
+
+
+   # Se construye una sola vez; los totales por categoría, los ratios y los indicadores definidos por el
+   # usuario son productos matriz-vector sobre todas las entidades a la vez.
+   def __init__(self, df_clasificado):
+       valores = df_clasificado['valor']
+       nits = df_clasificado['nit']
+       mascara = (valores.notna() & (valores != 0) & nits.notna()).to_numpy()
+
+
+       codigos = df_clasificado['codigoconcepto'] if 'codigoconcepto' in df_clasificado.columns else None
+       codigos = (codigos[mascara].astype(object).where(codigos[mascara].notna(), '').astype(str).str.strip()
+                  if codigos is not None else pd.Series('', index=nits[mascara].index))
+       filas, self.nits = pd.factorize(nits[mascara].astype(str))
+       # Un mismo código puede quedar en distintas categorías (clasificación por denominación)
+       columnas, self.columnas = pd.MultiIndex.from_arrays(
+           [codigos.to_numpy(dtype=object), df_clasificado['categoria_principal'][mascara].to_numpy(dtype=object)],
+       ).factorize()
+       self.columnas = self.columnas.set_names(['codigo', 'categoria_principal'])
+       self.nits.name = 'nit'
+
+
+       # Los valores repetidos de un mismo NIT y cuenta se suman al convertir a CSR
+       self.matriz = sparse.csr_matrix(
+           (valores[mascara].to_numpy(dtype='float64'), (filas, columnas)),
+           shape=(len(self.nits), len(self.columnas))
+       )
+       self.categorias = pd.Index(self.columnas.get_level_values('categoria_principal').unique(),
+                                  name='categoria_principal')
+
+
+   @property
+   def nbytes(self):
+       """Memoria ocupada: arreglos CSR más los índices de NITs, columnas y categorías"""
+       return int(
+           self.matriz.data.nbytes + self.matriz.indices.nbytes + self.matriz.indptr.nbytes
+           + self.nits.memory_usage(deep=True) + self.columnas.memory_usage(deep=True)
+           + self.categorias.memory_usage(deep=True)
+       )
+
+
+   def vector(self, pesos_categorias=None, pesos_codigos=None):
+       """Vector de pesos sobre las columnas: {categoría: peso} y {prefijo de código PUC: peso}"""
+       vector = np.zeros(len(self.columnas))
+       categorias = self.columnas.get_level_values('categoria_principal')
+       for categoria, peso in (pesos_categorias or {}).items():
+           vector[categorias == categoria] += peso
+       if pesos_codigos:
+           codigos = self.columnas.get_level_values('codigo').astype(str)
+           for prefijo, peso in pesos_codigos.items():
+               vector[codigos.str.startswith(str(prefijo))] += peso
+       return vector
+
+
+   def combinar(self, pesos_categorias=None, pesos_codigos=None):
+       """Combinación lineal de cuentas para cada NIT (un producto matriz-vector)"""
+       return self.matriz @ self.vector(pesos_categorias, pesos_codigos)
+
+
+   def combinar_varias(self, combinaciones):
+       """Varias combinaciones lineales a la vez (un solo producto matriz-matriz); una columna por combinación"""
+       if not combinaciones:
+           return np.zeros((len(self.nits), 0))
+       pesos = np.column_stack([self.vector(*combinacion) for combinacion in combinaciones])
+       return np.asarray(self.matriz @ pesos)
+
+
+   @staticmethod
+   def dividir_seguro(numerador, denominador):
+       """División elemento a elemento; 0 donde el denominador es 0"""
+       numerador = np.asarray(numerador, dtype=float)
+       denominador = np.asarray(denominador, dtype=float)
+       return np.divide(numerador, denominador, out=np.zeros(np.broadcast(numerador, denominador).shape),
+                        where=denominador != 0)
+
+
+   def indicador(self, numerador, denominador=None, por_codigo=False):
+       """Indicador definido por el usuario: pesos del numerador y (opcional) del denominador, por NIT"""
+       def combinar(pesos):
+           return self.combinar(pesos_codigos=pesos) if por_codigo else self.combinar(pesos_categorias=pesos)
+
+
+       valores = combinar(numerador)
+       if denominador is not None:
+           valores = self.dividir_seguro(valores, combinar(denominador))
+       return pd.Series(valores, index=self.nits)
+
+
+   def totales_por_categoria(self):
+       """Totales por categoría de cada NIT (misma tabla que DataProcessor.calcular_totales_por_categoria)"""
+       codigos_categoria = self.categorias.get_indexer(self.columnas.get_level_values('categoria_principal'))
+       agregacion = sparse.csr_matrix(
+           (np.ones(len(self.columnas)), (np.arange(len(self.columnas)), codigos_categoria)),
+           shape=(len(self.columnas), len(self.categorias))
+       )
+       return pd.DataFrame(
+           (self.matriz @ agregacion).toarray(), index=self.nits, columns=self.categorias
+       ).sort_index().sort_index(axis=1)
+
+
+   def calcular_ratios(self):
+       """Ratios financieros de todos los NITs: una sola definición (DataProcessor.calcular_ratios_vectorizado)"""
+       return DataProcessor.calcular_ratios_vectorizado(self.totales_por_categoria())
+
+
+
+
+class IndicatorFormula:
+   """Fórmula de indicador sobre totales por categoría, compilada una vez a operaciones vectorizadas"""
+
+
+   # Categorías entre operadores, prefijos de código PUC entre corchetes (12 = deudores, 22 = cuentas por pagar)
+   PREDEFINIDAS = {
+       'capital_trabajo': 'Activo corriente - Pasivo corriente',
+       'rotacion_cartera': 'Ventas / [12]',
+       'dias_cartera': '[12] / Ventas * 365',
+       'dias_cuentas_por_pagar': '[22] / (Costos + Gastos) * 365',
+   }
+
+
+   _PATRON_TOKEN = re.compile(
+       r'\s*(?:(?P<numero>\d+(?:\.\d+)?)|\[(?P<codigo>\d+)\]|(?P<operador>[-+*/()])'
+       r'|(?P<nombre>[^-+*/()\[\]\d\s][^-+*/()\[\]]*))'
+   )
+   _OPERACIONES = {
+       '+': np.add,
+       '-': np.subtract,
+       '*': np.multiply,
+       '/': AccountMatrix.dividir_seguro,
+   }
+
+
+   def __init__(self, texto):
+       self.texto = texto
+       clasificador = FinancialClassifier()
+       categorias = {categoria for categoria, _ in clasificador.categorias_map.values()}
+       categorias |= {categoria for _, categoria in clasificador.PALABRAS_CLAVE} | {'No clasificada'}
+       self._categorias = {categoria.lower(): categoria for categoria in categorias}
+
+
+       self._tokens = self._tokenizar(texto)
+       self._posicion = 0
+       arbol = self._expresion()
+       if self._posicion < len(self._tokens):
+           raise ValueError(f"Fórmula inválida: sobra '{self._tokens[self._posicion][1]}'")
+       # Variables (categorías y prefijos de código) que se calculan una vez antes de evaluar
+       self.variables = []
+       self._evaluar = self._compilar(arbol)
+
+
+   def _tokenizar(self, texto):
+       """Divide el texto en (tipo, valor)"""
+       tokens = []
+       posicion = 0
+       texto = texto.strip()
+       while posicion < len(texto):
+           coincidencia = self._PATRON_TOKEN.match(texto, posicion)
+           if coincidencia is None or coincidencia.end() == posicion:
+               raise ValueError(f"Fórmula inválida cerca de '{texto[posicion:]}'")
+           tipo = coincidencia.lastgroup
+           tokens.append((tipo, coincidencia.group(tipo).strip()))
+           posicion = coincidencia.end()
+       if not tokens:
+           raise ValueError("La fórmula está vacía")
+       return tokens
+
+
+   def _siguiente(self):
+       return self._tokens[self._posicion] if self._posicion < len(self._tokens) else (None, None)
+
+
+   def _expresion(self):
+       """expresion := termino (('+' | '-') termino)*"""
+       nodo = self._termino()
+       while self._siguiente() in (('operador', '+'), ('operador', '-')):
+           operador = self._tokens[self._posicion][1]
+           self._posicion += 1
+           nodo = ('operacion', operador, nodo, self._termino())
+       return nodo
+
+
+   def _termino(self):
+       """termino := factor (('*' | '/') factor)*"""
+       nodo = self._factor()
+       while self._siguiente() in (('operador', '*'), ('operador', '/')):
+           operador = self._tokens[self._posicion][1]
+           self._posicion += 1
+           nodo = ('operacion', operador, nodo, self._factor())
+       return nodo
+
+
+   def _factor(self):
+       """factor := ('-' | '+') factor | número | [código] | categoría | '(' expresion ')'"""
+       tipo, valor = self._siguiente()
+       self._posicion += 1
+       if (tipo, valor) in (('operador', '-'), ('operador', '+')):
+           nodo = self._factor()
+           return ('negativo', nodo) if valor == '-' else nodo
+       if tipo == 'numero':
+           return ('numero', float(valor))
+       if tipo == 'codigo':
+           return ('variable', (None, valor))
+       if tipo == 'nombre':
+           if valor.lower() not in self._categorias:
+               raise ValueError(f"Categoría desconocida: '{valor}'")
+           return ('variable', (self._categorias[valor.lower()], None))
+       if (tipo, valor) == ('operador', '('):
+           nodo = self._expresion()
+           if self._siguiente() != ('operador', ')'):
+               raise ValueError("Fórmula inválida: falta ')'")
+           self._posicion += 1
+           return nodo
+       raise ValueError("Fórmula inválida: se esperaba un valor" + (f" antes de '{valor}'" if valor else " al final"))
+
+
+   def _compilar(self, nodo):
+       """Convierte el árbol en funciones sobre arreglos (una por nodo, sin volver a leer el texto)"""
+       tipo = nodo[0]
+       if tipo == 'numero':
+           valor = nodo[1]
+           return lambda variables: valor
+       if tipo == 'variable':
+           if nodo[1] not in self.variables:
+               self.variables.append(nodo[1])
+           posicion = self.variables.index(nodo[1])
+           return lambda variables: variables[posicion]
+       if tipo == 'negativo':
+           operando = self._compilar(nodo[1])
+           return lambda variables: -operando(variables)
+       operacion = self._OPERACIONES[nodo[1]]
+       izquierda, derecha = self._compilar(nodo[2]), self._compilar(nodo[3])
+       return lambda variables: operacion(izquierda(variables), derecha(variables))
+
+
+   def evaluar(self, variables, n_filas):
+       """Evalúa la fórmula con los valores por NIT de sus variables (en el orden de self.variables)"""
+       return np.broadcast_to(np.asarray(self._evaluar(variables), dtype=float), (n_filas,)).copy()
+
+
+   @classmethod
+   def evaluar_formulas(cls, formulas, fuente):
+       """Evalúa {nombre: texto o IndicatorFormula} para todos los NITs de una AccountMatrix o tabla de totales"""
+       compiladas = {
+           nombre: formula if isinstance(formula, cls) else cls(formula) for nombre, formula in formulas.items()
+       }
+       variables = list(dict.fromkeys(variable for formula in compiladas.values() for variable in formula.variables))
+
+
+       # Todas las variables de todas las fórmulas en una sola pasada
+       if isinstance(fuente, AccountMatrix):
+           indice = fuente.nits
+           matriz = fuente.combinar_varias([
+               ({categoria: 1}, None) if categoria is not None else (None, {codigo: 1})
+               for categoria, codigo in variables
+           ])
+           valores = {variable: matriz[:, i] for i, variable in enumerate(variables)}
+       else:
+           indice = fuente.index
+           valores = {}
+           for categoria, codigo in variables:
+               if codigo is not None:
+                   raise ValueError("Los códigos PUC solo están disponibles sobre la matriz de cuentas")
+               columna = fuente[categoria] if categoria in fuente.columns else pd.Series(0.0, index=indice)
+               valores[(categoria, codigo)] = columna.to_numpy(dtype=float)
+
+
+       return pd.DataFrame({
+           nombre: formula.evaluar([valores[variable] for variable in formula.variables], len(indice))
+           for nombre, formula in compiladas.items()
+       }, index=indice)
+
+
+
+
+class DataProcessor:
+   """Clase para procesar datos financieros"""
+
+
+   def __init__(self):
+       self.classifier = FinancialClassifier()
+
+
+   def procesar_dataframe(self, df, info_entidades=None):
+       """Procesa un DataFrame completo y clasifica todas las cuentas"""
+       # Usar nombres de columnas normalizados
+       CODIGO_CONCEPTO = 'codigoconcepto'
+       DENOMINACION = 'denominacion'
+
+
+       # Tabla de consulta por código distinto, unida a la columna de códigos (sin llamadas por fila)
+       codigos = df[CODIGO_CONCEPTO] if CODIGO_CONCEPTO in df.columns else pd.Series(np.nan, index=df.index)
+       denominaciones = df[DENOMINACION] if DENOMINACION in df.columns else None
+       df_clasificaciones = self.classifier.clasificar_lote(codigos, denominaciones)
+
+
+       df_resultado = df.copy()
+       # El tipo de entidad se calcula una vez por entidad y se propaga a sus filas
+       df_clasificaciones['tipo_entidad'] = self.determinar_tipos_entidad(df, info_entidades)
+
+
+       # Resetear índices para concatenación segura
+       df_resultado = df_resultado.reset_index(drop=True)
+       df_clasificaciones = df_clasificaciones.reset_index(drop=True)
+
+
+       return pd.concat([df_resultado, df_clasificaciones], axis=1)
+
+
+   def determinar_tipos_entidad(self, df, info_entidades=None):
+       """Determina el tipo de entidad (EPS/IPS) por cada par distinto de NIT y razón social"""
+       RAZON_SOCIAL = 'razonsocial'
+
+
+       # El NIT ya llega canónico desde la carga (REPSValidator.canonicalizar_nits)
+       nits = df['nit'] if 'nit' in df.columns else pd.Series('', index=df.index)
+       razones = df[RAZON_SOCIAL] if RAZON_SOCIAL in df.columns else pd.Series('', index=df.index)
+       pares = pd.DataFrame({
+           'nit': nits.astype(object).where(nits.notna(), '').astype(str).to_numpy(),
+           # Misma conversión que str(): una razón social vacía se compara como 'NAN'
+           'razon_social': razones.astype(object).where(razones.notna(), 'nan').astype(str).str.upper().to_numpy()
+       })
+       grupo_por_fila = pares.groupby(['nit', 'razon_social'], sort=False, dropna=False).ngroup().to_numpy()
+       distintos = pares.drop_duplicates()
+
+
+       # 1. Información de validación REPS
+       tipo_validado = pd.Series(np.nan, index=distintos.index, dtype=object)
+       if info_entidades:
+           tipos_info = {nit: info.get('tipo', 'NO VALIDADO') for nit, info in info_entidades.items()}
+           tipo_validado = distintos['nit'].map(tipos_info)
+       validado = distintos['nit'].isin(info_entidades.keys() if info_entidades else [])
+
+
+       # 2. Palabras clave en la razón social y 3. prefijo del NIT
+       es_eps = distintos['razon_social'].str.contains('EPS', regex=False)
+       es_ips = distintos['razon_social'].str.contains('IPS|CLINICA|HOSPITAL', regex=True)
+       nit_nueve_digitos = distintos['nit'].str.len() == 9
+       prefijo_eps = distintos['nit'].str.startswith('8') & nit_nueve_digitos
+       prefijo_ips = distintos['nit'].str.startswith('9') & nit_nueve_digitos
+
+
+       tipos = np.select(
+           [validado, es_eps, es_ips, prefijo_eps, prefijo_ips],
+           [tipo_validado, 'EPS', 'IPS', 'EPS', 'IPS'],
+           default='NO DETERMINADO'
+       )
+       return tipos[grupo_por_fila]
+
+
+   def calcular_indicadores_por_nit(self, df_clasificado, info_entidades=None, matriz=None):
+       """Calcula indicadores financieros por NIT (reutiliza la matriz NIT × cuenta si ya se construyó)"""
+       df_clasificado['nit'] = df_clasificado['nit'].astype(str)
+
+
+       # Usar nombre de columna normalizado
+       RAZON_SOCIAL = 'razonsocial'
+
+
+       # 'valor' ya llega como float64 desde UploadSchema; la matriz NIT × cuenta se construye una sola vez
+       matriz = matriz if matriz is not None else AccountMatrix(df_clasificado)
+       df_indicadores = matriz.calcular_ratios()
+       if df_indicadores.empty:
+           return {}
+
+
+       # Mismo orden de aparición de los NITs en el archivo
+       orden = pd.Index(df_clasificado['nit'].unique()).intersection(df_indicadores.index, sort=False)
+       df_indicadores = df_indicadores.reindex(orden)
+
+
+       # Razón social y tipo de entidad de la primera fila de cada NIT
+       primeras = df_clasificado.drop_duplicates('nit').set_index('nit')
+       if RAZON_SOCIAL in df_clasificado.columns:
+           con_razon_social = df_clasificado[RAZON_SOCIAL].notna().groupby(df_clasificado['nit']).any()
+           razon_social = primeras[RAZON_SOCIAL].where(con_razon_social.reindex(primeras.index), 'Sin razón social')
+           df_indicadores['razon_social'] = razon_social.reindex(orden)
+       else:
+           df_indicadores['razon_social'] = 'Sin razón social'
+       if 'tipo_entidad' in df_clasificado.columns:
+           df_indicadores['tipo_entidad'] = primeras['tipo_entidad'].reindex(orden)
+       else:
+           df_indicadores['tipo_entidad'] = 'NO DETERMINADO'
+
+
+       return df_indicadores.to_dict(orient='index')
+
+
+   def indicadores_a_dataframe(self, indicadores_por_nit):
+       """Convierte el diccionario de indicadores por NIT en una tabla indexada por NIT"""
+       df_indicadores = pd.DataFrame.from_dict(indicadores_por_nit, orient='index')
+       df_indicadores.index.name = 'nit'
+       return df_indicadores
+
+
+   def calcular_totales_por_categoria(self, df_clasificado):
+       """Calcula los totales por categoría de cada NIT (una fila por NIT)"""
+       valores = df_clasificado['valor']
+       mascara = valores.notna() & (valores != 0)
+
+
+       df_valido = pd.DataFrame({
+           'nit': df_clasificado['nit'].astype(str)[mascara],
+           'categoria_principal': df_clasificado['categoria_principal'][mascara],
+           'valor': valores[mascara]
+       })
+       return df_valido.pivot_table(
+           index='nit', columns='categoria_principal', values='valor', aggfunc='sum', fill_value=0
+       )
+
+
+   @staticmethod
+   def calcular_ratios_vectorizado(df_totales):
+       """Calcula los ratios financieros para todas las filas de una tabla de totales"""
+       def columna(nombre):
+           if nombre in df_totales.columns:
+               return df_totales[nombre].astype(float)
+           return pd.Series(0.0, index=df_totales.index)
+
+
+       def safe_divide(numerador, denominador):
+           return (numerador / denominador.where(denominador != 0)).fillna(0)
+
+
+       activo_corriente = columna('Activo corriente')
+       pasivo_corriente = columna('Pasivo corriente')
+       pasivo_total = pasivo_corriente + columna('Pasivo No corriente')
+       columnas_activo = [c for c in df_totales.columns if 'Activo' in str(c)]
+       activo_total = df_totales[columnas_activo].sum(axis=1).astype(float)
+       patrimonio = columna('Patrimonio')
+       utilidad_neta = columna('Utilidad neta')
+       ventas = columna('Ventas')
+
+
+       return pd.DataFrame({
+           'razon_corriente': safe_divide(activo_corriente, pasivo_corriente),
+           'prueba_acida': safe_divide(activo_corriente - columna('Inventarios'), pasivo_corriente),
+           'razon_endeudamiento': safe_divide(pasivo_total, activo_total),
+           'leverage_financiero': safe_divide(pasivo_total, patrimonio),
+           'roa': safe_divide(utilidad_neta, activo_total),
+           'roe': safe_divide(utilidad_neta, patrimonio),
+           'margen_neto': safe_divide(utilidad_neta, ventas),
+           'activo_corriente': activo_corriente,
+           'pasivo_corriente': pasivo_corriente,
+           'activo_total': activo_total,
+           'pasivo_total': pasivo_total,
+           'patrimonio': patrimonio,
+           'utilidad_neta': utilidad_neta,
+           'ventas': ventas
+       }, index=df_totales.index)
+
+
+   def calcular_ranking_pares(self, df_indicadores):
+       """Calcula percentiles y z-scores de cada entidad frente a su grupo de pares"""
+       # Grupo de pares: tipo de entidad y tamaño (terciles de activo total)
+       percentil_activo = pd.to_numeric(df_indicadores['activo_total'], errors='coerce').rank(pct=True)
+       tamano = pd.cut(percentil_activo, bins=[0, 1 / 3, 2 / 3, 1],
+                       labels=['Pequeña', 'Mediana', 'Grande'], include_lowest=True).astype(str)
+       grupo = df_indicadores['tipo_entidad'].astype(str) + ' / ' + tamano
+
+
+       valores = df_indicadores[RATIOS_FINANCIEROS].apply(pd.to_numeric, errors='coerce')
+       agrupado = valores.groupby(grupo)
+       # Un ratio faltante no es "la media del grupo": percentil y z-score quedan NaN
+       percentiles = agrupado.rank(pct=True, na_option='keep')
+       media = agrupado.transform('mean')
+       desviacion = agrupado.transform('std')
+       z_scores = (valores - media) / desviacion.where(desviacion > 0)
+       # Con dispersión nula todos los pares coinciden con la media
+       z_scores = z_scores.mask(desviacion.eq(0) & valores.notna(), 0.0)
+
+
+       df_ranking = pd.concat([
+           pd.DataFrame({'grupo_pares': grupo, 'tamano': tamano,
+                         'n_pares': grupo.map(grupo.value_counts())}),
+           percentiles.add_prefix('pct_'),
+           z_scores.add_prefix('z_')
+       ], axis=1)
+       return df_ranking
+
+
+   def calcular_huellas_por_nit(self, df):
+       """Calcula una huella de contenido por NIT para detectar cambios entre cargas"""
+       nits = df['nit'].astype(str)
+       columnas = sorted(df.columns.tolist())
+
+
+       # Las filas sin NIT forman su propio grupo (clave NaN): también se conservan o se reclasifican
+       df_huella = df[columnas].reset_index(drop=True)
+       # El orden de las filas dentro del NIT forma parte de la huella
+       df_huella['_orden'] = nits.groupby(nits.values, dropna=False).cumcount().values
+
+
+       hashes_fila = pd.util.hash_pandas_object(df_huella, index=False)
+       return hashes_fila.groupby(nits.values, dropna=False).sum()
+
+
+   def _firma_info_entidades(self, info_entidades):
+       """Obtiene una firma de la información REPS usada para clasificar"""
+       if not info_entidades:
+           return None
+       # Digest estable entre procesos (hash() cambia con PYTHONHASHSEED): forma parte de claves persistentes
+       firma = repr(sorted((str(nit), info.get('tipo')) for nit, info in info_entidades.items()))
+       return hashlib.sha256(firma.encode()).hexdigest()
+
+
+   def procesar_incremental(self, df, snapshot_anterior=None, info_entidades=None):
+       """Reclasifica solo los NITs cuyo contenido cambió respecto al snapshot anterior"""
+       huellas = self.calcular_huellas_por_nit(df)
+       firma_info = self._firma_info_entidades(info_entidades)
+       columnas = sorted(df.columns.tolist())
+
+
+       # Sin snapshot compatible se hace una corrida completa
+       if (snapshot_anterior is None
+               or snapshot_anterior['firma_info'] != firma_info
+               or snapshot_anterior['columnas'] != columnas):
+           df_clasificado = self.procesar_dataframe(df, info_entidades)
+           # La matriz NIT × cuenta (el paso más costoso) se construye una vez y se entrega junto al snapshot
+           matriz = AccountMatrix(df_clasificado)
+           indicadores_por_nit = self.calcular_indicadores_por_nit(df_clasificado, info_entidades, matriz)
+           snapshot = {
+               'df_clasificado': df_clasificado,
+               'indicadores_por_nit': indicadores_por_nit,
+               'huellas': huellas,
+               'firma_info': firma_info,
+               'columnas': columnas,
+               'matriz_cuentas': matriz
+           }
+           return snapshot, set(huellas.index), set()
+
+
+       huellas_previas = snapshot_anterior['huellas']
+       comunes = huellas.index.intersection(huellas_previas.index)
+       sin_cambios = comunes[huellas.loc[comunes].values == huellas_previas.loc[comunes].values]
+       nits_cambiados = huellas.index.difference(sin_cambios)
+       nits_eliminados = huellas_previas.index.difference(huellas.index)
+
+
+       df_cambiado = df[df['nit'].astype(str).isin(nits_cambiados)]
+       df_cambiado_clasificado = self.procesar_dataframe(df_cambiado, info_entidades)
+
+
+       # Parchear una copia de los indicadores: el snapshot anterior puede estar compartido
+       indicadores_por_nit = dict(snapshot_anterior['indicadores_por_nit'])
+       for nit in nits_cambiados.union(nits_eliminados):
+           indicadores_por_nit.pop(nit, None)
+       indicadores_por_nit.update(
+           self.calcular_indicadores_por_nit(df_cambiado_clasificado, info_entidades)
+       )
+
+
+       df_previo = snapshot_anterior['df_clasificado']
+       df_conservado = df_previo[df_previo['nit'].isin(sin_cambios)]
+       df_clasificado = pd.concat([df_conservado, df_cambiado_clasificado], ignore_index=True)
+
+
+       snapshot = {
+           'df_clasificado': df_clasificado,
+           'indicadores_por_nit': indicadores_por_nit,
+           'huellas': huellas,
+           'firma_info': firma_info,
+           'columnas': columnas,
+           # Los indicadores se parchearon por NIT: la matriz del archivo completo se construye si se necesita
+           'matriz_cuentas': None
+       }
+       return snapshot, set(nits_cambiados), set(nits_eliminados)
+
+
+
+
+class SimilarityIndex:
+   """Índice de vecinos más cercanos sobre los vectores normalizados de indicadores"""
+
+
+   FEATURES = RATIOS_FINANCIEROS
+
+
+   def __init__(self, df_indicadores):
+       X = df_indicadores.reindex(columns=self.FEATURES).apply(pd.to_numeric, errors='coerce').fillna(0)
+
+
+       # Acotar colas (divisiones por denominadores pequeños) antes de estandarizar
+       X = X.clip(X.quantile(0.01), X.quantile(0.99), axis=1)
+       self.matriz = StandardScaler().fit_transform(X.values)
+       self.nits = df_indicadores.index.to_numpy()
+       self.posiciones = pd.Index(self.nits)
+       self.vecinos = NearestNeighbors(algorithm='ball_tree').fit(self.matriz)
+
+
+   def similares(self, nit, k=5, candidatos=None):
+       """Retorna los k NITs más similares (opcionalmente restringidos a un conjunto de candidatos)"""
+       posicion = self.posiciones.get_loc(nit)
+       candidatos = set(candidatos) if candidatos is not None else None
+       n_total = len(self.nits)
+
+
+       n_consulta = min(n_total, k + 1)
+       while True:
+           distancias, indices = self.vecinos.kneighbors(self.matriz[posicion:posicion + 1], n_neighbors=n_consulta)
+           resultado = [
+               (self.nits[i], float(d)) for d, i in zip(distancias[0], indices[0])
+               if i != posicion and (candidatos is None or self.nits[i] in candidatos)
+           ]
+           if len(resultado) >= k or n_consulta == n_total:
+               return resultado[:k]
+           n_consulta = min(n_total, n_consulta * 4)
+
+
+
+
+class EntitySearchIndex:
+   """Índice de prefijos sobre NIT y palabras de la razón social para búsqueda incremental"""
+
+
+   def __init__(self, indicadores_por_nit):
+       self.display_por_nit = {}
+       tokens = []
+       posiciones = []
+       self.nits = np.array(list(indicadores_por_nit.keys()), dtype=object)
+
+
+       for posicion, nit in enumerate(self.nits):
+           indicadores = indicadores_por_nit[nit]
+           razon_social = indicadores.get('razon_social', 'Sin razón social')
+           tipo_entidad = indicadores.get('tipo_entidad', 'NO VALIDADO')
+           self.display_por_nit[nit] = f"{nit} - {razon_social} ({tipo_entidad})"
+
+
+           for token in {str(nit)} | set(self._tokenizar(razon_social)):
+               tokens.append(token)
+               posiciones.append(posicion)
+
+
+       orden = np.argsort(tokens, kind='stable')
+       self.tokens = np.array(tokens, dtype=object)[orden]
+       self.posiciones_token = np.array(posiciones, dtype=np.int64)[orden]
+       self.nit_por_display = {display: nit for nit, display in self.display_por_nit.items()}
+
+
+   def _tokenizar(self, texto):
+       """Normaliza (mayúsculas, sin tildes) y separa el texto en palabras"""
+       texto = unicodedata.normalize('NFKD', str(texto).upper())
+       texto = ''.join(c for c in texto if not unicodedata.combining(c))
+       return [token for token in re.split(r'[^0-9A-Z]+', texto) if token]
+
+
+   def _posiciones_prefijo(self, prefijo):
+       """Posiciones de entidades con algún token que empieza por el prefijo (búsqueda binaria)"""
+       inicio = bisect.bisect_left(self.tokens, prefijo)
+       fin = bisect.bisect_left(self.tokens, prefijo + '\uffff')
+       return set(self.posiciones_token[inicio:fin].tolist())
+
+
+   def buscar(self, consulta, candidatos=None, limite=50):
+       """Retorna hasta `limite` NITs cuyos tokens coinciden con todas las palabras de la consulta"""
+       terminos = self._tokenizar(consulta)
+       if terminos:
+           posiciones = self._posiciones_prefijo(terminos[0])
+           for termino in terminos[1:]:
+               posiciones &= self._posiciones_prefijo(termino)
+           nits = self.nits[sorted(posiciones)]
+       else:
+           nits = self.nits
+
+
+       if candidatos is not None:
+           nits = [nit for nit in nits if nit in candidatos]
+       return list(nits[:limite])
+
+
+   def resolver(self, display_text):
+       """Obtiene el NIT de un texto de selección"""
+       return self.nit_por_display.get(display_text)
+
+
+
+
+class FilteredView:
+   """Vista filtrada liviana: posiciones de fila sobre el DataFrame clasificado (que no se modifica)"""
+
+
+   def __init__(self, df_base, filas=None):
+       self.df_base = df_base
+       # None significa todas las filas
+       self.filas = filas
+
+
+   @classmethod
+   def desde_filtros(cls, df_base, filtros):
+       """Construye la vista a partir de {columna: valor}; los valores None no filtran"""
+       mascara = None
+       for columna, valor in filtros.items():
+           if valor is None:
+               continue
+           condicion = (df_base[columna] == valor).to_numpy()
+           mascara = condicion if mascara is None else mascara & condicion
+       return cls(df_base, None if mascara is None else np.flatnonzero(mascara))
+
+
+   def __len__(self):
+       return len(self.df_base) if self.filas is None else len(self.filas)
+
+
+   @property
+   def columns(self):
+       """Columnas del DataFrame base"""
+       return self.df_base.columns
+
+
+   def columna(self, nombre):
+       """Valores de una columna para las filas de la vista"""
+       serie = self.df_base[nombre]
+       return serie if self.filas is None else serie.iloc[self.filas]
+
+
+   def nits_unicos(self):
+       """NITs presentes en la vista"""
+       return self.columna('nit').unique()
+
+
+   def tabla(self, columnas=None):
+       """Materializa la vista (solo las columnas pedidas) como un DataFrame nuevo que se puede modificar"""
+       columnas = list(self.df_base.columns) if columnas is None else columnas
+       if self.filas is None:
+           return self.df_base[columnas]
+       return self.df_base.iloc[self.filas, self.df_base.columns.get_indexer(columnas)]
+
+
+
+
+class ChartDataLayer:
+   """Capa de datos para gráficos: agrega con pandas y acota categorías antes de construir figuras"""
+
+
+   def __init__(self, max_barras=30):
+       self.max_barras = max_barras
+
+
+   def conteos(self, df, columna, nombre_conteo='Conteo'):
+       """Cuenta filas por categoría (la figura recibe una fila por categoría)"""
+       df_conteo = df[columna].value_counts().reset_index()
+       df_conteo.columns = [columna, nombre_conteo]
+       return df_conteo
+
+
+   def top_categorias(self, df, categoria, valor, etiqueta_resto='Otros'):
+       """Conserva las categorías de mayor valor absoluto y agrupa el resto"""
+       totales = df.groupby(categoria)[valor].sum()
+       if len(totales) <= self.max_barras:
+           return df
+
+
+       principales = totales.abs().nlargest(self.max_barras - 1).index
+       df_reducido = df.copy()
+       df_reducido[categoria] = df_reducido[categoria].where(df_reducido[categoria].isin(principales), etiqueta_resto)
+       columnas_grupo = [c for c in df_reducido.columns
+                         if c != valor and not pd.api.types.is_numeric_dtype(df_reducido[c])]
+       return df_reducido.groupby(columnas_grupo, as_index=False)[valor].sum()
+
+
+
+
+class FigureCache:
+   """Caché LRU de figuras Plotly por (vista, clave, versión de datos)"""
+
+
+   def __init__(self, max_figuras=64):
+       self.max_figuras = max_figuras
+       self.figuras = OrderedDict()
+       self.aciertos = 0
+       self.fallos = 0
+
+
+   def obtener(self, clave, construir):
+       """Retorna la figura en caché o la construye y la guarda (expulsando la menos usada)"""
+       if clave in self.figuras:
+           self.figuras.move_to_end(clave)
+           self.aciertos += 1
+           return self.figuras[clave]
+
+
+       self.fallos += 1
+       figura = construir()
+       self.figuras[clave] = figura
+       if len(self.figuras) > self.max_figuras:
+           self.figuras.popitem(last=False)
+       return figura
+
+
+
+
+class PeriodStore:
+   """Almacén histórico de totales por categoría por NIT y periodo"""
+
+
+   def __init__(self, ruta='datos_periodos'):
+       self.ruta = ruta
+       self.data_processor = DataProcessor()
+
+
+   def _normalizar_periodo(self, periodo):
+       """Normaliza la etiqueta del periodo (ej. 2024Q1, 2024-03)"""
+       periodo_limpio = re.sub(r'[^0-9A-Za-z-]', '', str(periodo).strip()).upper()
+       if not periodo_limpio:
+           raise ValueError("El periodo no puede estar vacío")
+       return periodo_limpio
+
+
+   def guardar_periodo(self, df_clasificado, periodo):
+       """Agrega (o reemplaza) los totales por categoría de un periodo"""
+       periodo = self._normalizar_periodo(periodo)
+       df_totales = self.data_processor.calcular_totales_por_categoria(df_clasificado)
+
+
+       # Formato largo: el conjunto de categorías puede variar entre periodos
+       df_largo = df_totales.stack().rename('valor_total').reset_index()
+       df_largo = df_largo[df_largo['valor_total'] != 0]
+       df_largo['periodo'] = periodo
+
+
+       ruta_particion = os.path.join(self.ruta, f'periodo={periodo}')
+       if os.path.isdir(ruta_particion):
+           shutil.rmtree(ruta_particion)
+       os.makedirs(self.ruta, exist_ok=True)
+       df_largo.to_parquet(self.ruta, partition_cols=['periodo'], index=False)
+       return periodo
+
+
+   def periodos_disponibles(self):
+       """Lista los periodos almacenados en orden cronológico"""
+       if not os.path.isdir(self.ruta):
+           return []
+       return sorted(
+           nombre.split('=', 1)[1] for nombre in os.listdir(self.ruta)
+           if nombre.startswith('periodo=')
+       )
+
+
+   def cargar_totales(self, nits=None, periodos=None):
+       """Carga los totales por (nit, periodo) en formato ancho"""
+       if not self.periodos_disponibles():
+           return pd.DataFrame()
+
+
+       filtros = []
+       if nits is not None:
+           filtros.append(('nit', 'in', list(nits)))
+       if periodos is not None:
+           filtros.append(('periodo', 'in', list(periodos)))
+
+
+       df_largo = pd.read_parquet(self.ruta, filters=filtros or None)
+       if df_largo.empty:
+           return pd.DataFrame()
+       df_largo['periodo'] = df_largo['periodo'].astype(str)
+
+
+       return df_largo.pivot_table(
+           index=['nit', 'periodo'], columns='categoria_principal', values='valor_total',
+           aggfunc='sum', fill_value=0
+       ).sort_index()
+
+
+   def calcular_tendencias(self, nits=None, ventana=4):
+       """Calcula indicadores y sus variaciones entre periodos para todos los NITs"""
+       df_totales = self.cargar_totales(nits)
+       if df_totales.empty:
+           return pd.DataFrame()
+
+
+       df_tendencias = self.data_processor.calcular_ratios_vectorizado(df_totales)[
+           ['razon_corriente', 'prueba_acida', 'razon_endeudamiento', 'leverage_financiero']
+       ]
+       agrupado = df_tendencias.groupby(level='nit')
+
+
+       for indicador in ['razon_corriente', 'razon_endeudamiento']:
+           df_tendencias[f'delta_{indicador}'] = agrupado[indicador].diff()
+           df_tendencias[f'media_movil_{indicador}'] = agrupado[indicador].rolling(
+               ventana, min_periods=1
+           ).mean().droplevel(0)
+
+
+       return df_tendencias
+
+
+   def tendencias_periodo(self, periodo):
+       """Obtiene las variaciones de un periodo frente al anterior, por NIT"""
+       df_tendencias = self.calcular_tendencias()
+       if df_tendencias.empty:
+           return {}
+
+
+       periodo = self._normalizar_periodo(periodo)
+       df_periodo = df_tendencias.xs(periodo, level='periodo', drop_level=True)
+       df_periodo = df_periodo[['delta_razon_corriente', 'delta_razon_endeudamiento']].dropna()
+       return df_periodo.to_dict(orient='index')
+
+
+
+
+class IndicatorTableStore:
+   """Tablas de indicadores por NIT persistidas en formato Arrow y abiertas con memory-map (sin copias)"""
+
+
+   # Esquema fijo: NIT, indicadores y totales como float64, razón social y tipo de entidad como texto
+   COLUMNAS_NUMERICAS = RATIOS_FINANCIEROS + ['activo_corriente', 'pasivo_corriente', 'activo_total',
+                                              'pasivo_total', 'patrimonio', 'utilidad_neta', 'ventas']
+   COLUMNAS_TEXTO = ['razon_social', 'tipo_entidad']
+
+
+   # Se conservan las tablas usadas más recientemente (LRU por fecha de modificación, que se renueva al usarlas)
+   def __init__(self, ruta='datos_indicadores', max_tablas=50, max_bytes=2 * 1024 ** 3):
+       self.ruta = ruta
+       self.max_tablas = max_tablas
+       self.max_bytes = max_bytes
+
+
+   def ruta_tabla(self, clave):
+       """Ruta del archivo de la tabla de una clasificación (clave de contenido)"""
+       return os.path.join(self.ruta, f'{clave}.arrow')
+
+
+   def guardar(self, clave, indicadores_por_nit):
+       """Escribe la tabla de indicadores con el esquema fijo (reemplazo atómico); retorna la ruta"""
+       import pyarrow as pa
+       df = pd.DataFrame.from_dict(indicadores_por_nit, orient='index').reindex(
+           columns=self.COLUMNAS_NUMERICAS + self.COLUMNAS_TEXTO
+       )
+       # Los NaN se escriben como valores (no como nulos) para que la lectura de las columnas no copie
+       columnas = {'nit': pa.array(df.index.astype(str).to_numpy(dtype=object), type=pa.string())}
+       for columna in self.COLUMNAS_NUMERICAS:
+           columnas[columna] = pa.array(df[columna].to_numpy(dtype='float64', na_value=np.nan))
+       for columna in self.COLUMNAS_TEXTO:
+           columnas[columna] = pa.array(df[columna].astype(object).where(df[columna].notna(), None).to_numpy(),
+                                        type=pa.string())
+       tabla = pa.table(columnas).replace_schema_metadata({
+           'clave': clave,
+           'fecha': datetime.now().isoformat(timespec='seconds'),
+           'entidades': str(len(df))
+       })
+
+
+       os.makedirs(self.ruta, exist_ok=True)
+       ruta_tabla = self.ruta_tabla(clave)
+       ruta_temporal = f'{ruta_tabla}.{uuid.uuid4().hex}.tmp'
+       with pa.OSFile(ruta_temporal, 'wb') as archivo:
+           with pa.ipc.new_file(archivo, tabla.schema) as escritor:
+               escritor.write_table(tabla)
+       os.replace(ruta_temporal, ruta_tabla)
+       self._recortar(ruta_tabla)
+       return ruta_tabla
+
+
+   def marcar_uso(self, ruta_tabla):
+       """Renueva la fecha de modificación de la tabla para que la expulsión LRU la conserve"""
+       try:
+           os.utime(ruta_tabla)
+       except OSError:
+           pass
+
+
+   def _recortar(self, ruta_conservar):
+       """Elimina las tablas menos usadas por encima de max_tablas o max_bytes (nunca la recién escrita)"""
+       tablas = []
+       for nombre in os.listdir(self.ruta):
+           if not nombre.endswith('.arrow'):
+               continue
+           ruta_tabla = os.path.join(self.ruta, nombre)
+           try:
+               estado = os.stat(ruta_tabla)
+           except OSError:
+               continue
+           tablas.append((ruta_tabla != ruta_conservar, -estado.st_mtime, estado.st_size, ruta_tabla))
+
+
+       bytes_conservados = 0
+       for posicion, (_, _, tamano, ruta_tabla) in enumerate(sorted(tablas)):
+           bytes_conservados += tamano
+           if posicion == 0 or (posicion < self.max_tablas and bytes_conservados <= self.max_bytes):
+               continue
+           # Las sesiones que ya la tienen abierta conservan su memory-map; en Windows el archivo puede estar en uso
+           try:
+               os.remove(ruta_tabla)
+           except OSError:
+               pass
+
+
+   @staticmethod
+   def abrir(ruta_tabla):
+       """Abre la tabla con memory-map: las columnas numéricas son vistas de solo lectura sobre el archivo"""
+       import pyarrow as pa
+       tabla = pa.ipc.open_file(pa.memory_map(ruta_tabla, 'r')).read_all()
+       return tabla.to_pandas(split_blocks=True).set_index('nit')
+
+
+   def disponibles(self):
+       """Tablas guardadas (clave, fecha, entidades), de la más reciente a la más antigua"""
+       import pyarrow as pa
+       if not os.path.isdir(self.ruta):
+           return []
+       tablas = []
+       for nombre in os.listdir(self.ruta):
+           if not nombre.endswith('.arrow'):
+               continue
+           with pa.memory_map(os.path.join(self.ruta, nombre), 'r') as fuente:
+               metadatos = pa.ipc.open_file(fuente).schema.metadata or {}
+           tablas.append({
+               'clave': metadatos.get(b'clave', b'').decode() or nombre[:-len('.arrow')],
+               'fecha': metadatos.get(b'fecha', b'').decode(),
+               'entidades': int(metadatos.get(b'entidades', b'0'))
+           })
+       return sorted(tablas, key=lambda tabla: tabla['fecha'], reverse=True)
+
+
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def abrir_tabla_indicadores(ruta_tabla, version_archivo):
+   """Abre una tabla de indicadores una vez por proceso (y por versión del archivo); las sesiones la comparten"""
+   return IndicatorTableStore.abrir(ruta_tabla)
+
+
+
+
+class UploadSchema:
+   """Esquema de los archivos cargados: variantes de encabezado, columnas por módulo y tipos"""
+
+
+   # Variantes de encabezado (ya normalizadas) que corresponden a cada nombre canónico
+   VARIANTES = {
+       'nit': ['nit_entidad', 'nitentidad', 'numero_nit', 'numeronit', 'numero_identificacion',
+               'numeroidentificacion', 'identificacion'],
+       'razonsocial': ['razon_social', 'nombre_entidad', 'nombreentidad', 'entidad'],
+       'codigoconcepto': ['codigo_concepto', 'codigo', 'codigo_cuenta', 'codigocuenta', 'cuenta'],
+       'valor': ['saldo', 'saldo_final', 'saldofinal', 'valor_total', 'valortotal', 'monto'],
+       'denominacion': ['descripcion', 'nombre_cuenta', 'nombrecuenta', 'descripcion_cuenta', 'descripcioncuenta'],
+   }
+
+
+   # Tipos de las columnas conocidas: texto para identificadores y códigos, float64 para valores
+   TIPOS = {
+       'nit': 'texto',
+       'razonsocial': 'texto',
+       'codigoconcepto': 'texto',
+       'denominacion': 'texto',
+       'valor': 'float64',
+   }
+
+
+   _CANONICOS = {variante: canonico for canonico, variantes in VARIANTES.items() for variante in variantes}
+
+
+   # Montos con formato colombiano: "1.234.567,89", "$ (12.345)", "-1.500", "COP 2.000,5"
+   _PATRON_NEGATIVO = r'\(.*\)|^[^0-9]*-|-$'
+   _PATRON_CIENTIFICO = r'^[-+]?[0-9]+(\.[0-9]+)?[eE][-+]?[0-9]+$'
+   _PATRON_NO_NUMERICO = r'[^0-9.,]'
+   _PATRON_SEPARADOR = r'[.,]'
+   _PATRON_COMA_FINAL = r'^[^,]*,[0-9]*$'
+   _PATRON_PUNTO_FINAL = r'^[^.]*\.[0-9]*$'
+   _PATRON_AMBIGUO = r'^[0-9]*[.,][0-9]{3}$'
+   _PATRON_MEZCLADO = r'\..*,|,.*\.'
+
+
+   @staticmethod
+   def normalizar_nombre_columna(col):
+       """Normaliza un encabezado: minúsculas, sin tildes ni caracteres especiales"""
+       col_str = str(col).strip()
+       col_str = col_str.lower()
+       # Eliminar tildes (ejemplo básico)
+       col_str = col_str.replace('á', 'a').replace('é', 'e').replace('í', 'i').replace('ó', 'o').replace('ú', 'u')
+       # Eliminar caracteres no alfanuméricos (excepto guiones bajos)
+       col_str = re.sub(r'[^a-z0-9_]', '', col_str)
+       return col_str
+
+
+   @classmethod
+   def nombre_canonico(cls, col):
+       """Nombre canónico de un encabezado crudo"""
+       normalizado = cls.normalizar_nombre_columna(col)
+       return cls._CANONICOS.get(normalizado, normalizado)
+
+
+   @classmethod
+   def mapear_encabezados(cls, encabezados, columnas=None):
+       """Retorna {encabezado crudo: nombre canónico} solo para las columnas pedidas (todas si es None)"""
+       encabezados = list(encabezados)
+       mapeo = {}
+       # Primero los encabezados que ya tienen el nombre canónico, luego las variantes
+       for exacto in [True, False]:
+           for encabezado in encabezados:
+               normalizado = cls.normalizar_nombre_columna(encabezado)
+               nombre = cls.nombre_canonico(encabezado)
+               if (normalizado == nombre) != exacto or encabezado in mapeo:
+                   continue
+               if (columnas is None or nombre in columnas) and nombre not in mapeo.values():
+                   mapeo[encabezado] = nombre
+       return {encabezado: mapeo[encabezado] for encabezado in encabezados if encabezado in mapeo}
+
+
+   @classmethod
+   def tipos_lectura(cls, mapeo):
+       """dtype para el lector: las columnas de texto se leen como str (valor se deja inferir al lector)"""
+       return {encabezado: str for encabezado, nombre in mapeo.items() if cls.TIPOS.get(nombre) == 'texto'}
+
+
+   @classmethod
+   def aplicar_tipos(cls, df):
+       """Convierte las columnas conocidas a su tipo una sola vez; retorna (df, no convertidos por NIT o None)"""
+       no_convertidos_por_nit = None
+       for columna, tipo in cls.TIPOS.items():
+           if columna not in df.columns:
+               continue
+           if tipo == 'float64':
+               if df[columna].dtype != 'float64':
+                   df[columna], no_convertidos = cls.parsear_montos(df[columna])
+                   # Valores no vacíos que quedaron como NaN, por NIT (para reportarlos al usuario)
+                   if 'nit' in df.columns:
+                       no_convertidos_por_nit = df.loc[no_convertidos, 'nit'].value_counts()
+           elif not pd.api.types.is_string_dtype(df[columna]):
+               df[columna] = df[columna].astype(str).where(df[columna].notna())
+       return df, no_convertidos_por_nit
+
+
+   @classmethod
+   def parsear_montos(cls, serie):
+       """Convierte montos con formato local a float64; retorna (valores, máscara de no convertidos)"""
+       if pd.api.types.is_numeric_dtype(serie):
+           valores = serie.astype('float64')
+           return valores, np.zeros(len(serie), dtype=bool)
+
+
+       # Las celdas ya numéricas (p. ej. desde Excel) se conservan; el accesor .str deja NaN en ellas
+       texto = serie.astype(object).str.strip()
+       vacio = serie.isna() | texto.eq('')
+       valores = pd.to_numeric(serie.where(texto.isna()), errors='coerce').astype('float64')
+       con_texto = (texto.notna() & ~vacio).to_numpy()
+       if con_texto.any():
+           # Los montos se repiten mucho (ceros, valores redondos): se parsea cada texto distinto una vez
+           codigos, unicos = pd.factorize(texto[con_texto])
+           montos_unicos = cls._parsear_textos(pd.Series(unicos, dtype='string[pyarrow]'))
+           valores.iloc[np.flatnonzero(con_texto)] = montos_unicos[codigos]
+       return valores, (~vacio & valores.isna()).to_numpy()
+
+
+   @classmethod
+   def _parsear_textos(cls, texto):
+       """Parsea una serie de textos (sin vacíos) con expresiones regulares vectorizadas"""
+       negativo = texto.str.contains(cls._PATRON_NEGATIVO).to_numpy(dtype=bool)
+       cientifico = texto.str.contains(cls._PATRON_CIENTIFICO).to_numpy(dtype=bool)
+       limpio = texto.str.replace(cls._PATRON_NO_NUMERICO, '', regex=True)
+
+
+       # Un separador es decimal si es el último y aparece una sola vez ("1.234,5", "12,5", "1,234.5")
+       coma_decimal = limpio.str.contains(cls._PATRON_COMA_FINAL).to_numpy(dtype=bool)
+       punto_decimal = limpio.str.contains(cls._PATRON_PUNTO_FINAL).to_numpy(dtype=bool)
+       # Con un único separador seguido de 3 dígitos ("1.234", "1,234") el formato es ambiguo
+       ambiguo = limpio.str.contains(cls._PATRON_AMBIGUO).to_numpy(dtype=bool)
+       coma_decimal_clara = coma_decimal & ~ambiguo
+       punto_decimal_clara = punto_decimal & ~ambiguo
+       # Se resuelve con la convención dominante de la columna (colombiana por defecto: coma decimal)
+       if coma_decimal_clara.sum() >= punto_decimal_clara.sum():
+           punto_decimal = punto_decimal_clara
+       else:
+           coma_decimal = coma_decimal_clara
+
+
+       # Sin separador decimal válido solo se aceptan miles de un único tipo ("1.234.567"); "1.234,5.6" queda NaN
+       mezclado = limpio.str.contains(cls._PATRON_MEZCLADO).to_numpy(dtype=bool)
+
+
+       montos = np.full(len(texto), np.nan)
+       grupos = [
+           (coma_decimal, lambda t: t.str.replace('.', '', regex=False).str.replace(',', '.', regex=False)),
+           (punto_decimal, lambda t: t.str.replace(',', '', regex=False)),
+           (~coma_decimal & ~punto_decimal & ~mezclado, lambda t: t.str.replace(cls._PATRON_SEPARADOR, '', regex=True)),
+       ]
+       for mascara, normalizar in grupos:
+           if mascara.any():
+               montos[mascara] = pd.to_numeric(normalizar(limpio[mascara]), errors='coerce').to_numpy(
+                   dtype='float64', na_value=np.nan)
+
+
+       montos = np.where(negativo, -montos, montos)
+       if cientifico.any():
+           montos[cientifico] = pd.to_numeric(texto[cientifico], errors='coerce').to_numpy(
+               dtype='float64', na_value=np.nan)
+       return montos
+
+
+
+
+class ExcelReader:
+   """Lectura de libros Excel grandes: motor rápido si existe, lectura en streaming y caché Parquet"""
+
+
+   def __init__(self, ruta_cache='cache_excel'):
+       # ruta_cache=None desactiva la copia Parquet
+       self.ruta_cache = ruta_cache
+       self.motor = 'calamine' if importlib.util.find_spec('python_calamine') is not None else 'openpyxl'
+
+
+   def hojas(self, contenido):
+       """Nombres de las hojas del libro"""
+       with pd.ExcelFile(io.BytesIO(contenido), engine=self.motor) as libro:
+           return libro.sheet_names
+
+
+   def leer(self, contenido, hoja=None, columnas=None):
+       """Lee una hoja (la primera por defecto); retorna (df con nombres y tipos del esquema, no convertidos por NIT)"""
+       usecols = None
+       if columnas is not None:
+           usecols = lambda col: UploadSchema.nombre_canonico(col) in columnas
+       ruta_parquet = self._ruta_parquet(contenido, hoja, columnas)
+       if ruta_parquet is not None and os.path.exists(ruta_parquet) and os.path.exists(
+               self._ruta_no_convertidos(ruta_parquet)):
+           return pd.read_parquet(ruta_parquet), self._leer_no_convertidos(ruta_parquet)
+
+
+       if self.motor == 'calamine':
+           df = pd.read_excel(io.BytesIO(contenido), engine='calamine', sheet_name=hoja or 0, usecols=usecols)
+       else:
+           df = self._leer_streaming(contenido, hoja, usecols)
+       mapeo = UploadSchema.mapear_encabezados(df.columns, columnas)
+       df, no_convertidos_por_nit = UploadSchema.aplicar_tipos(df[list(mapeo)].rename(columns=mapeo))
+
+
+       if ruta_parquet is not None:
+           self._guardar_parquet(df, no_convertidos_por_nit, ruta_parquet)
+       return df, no_convertidos_por_nit
 
 
-       # Buscar coincidencia exacta
-       if codigo_str in self.categorias_map:
-           categoria, subcategoria = self.categorias_map[codigo_str]
-           return categoria, subcategoria, 1.0
+   def _leer_streaming(self, contenido, hoja, usecols):
+       """Recorre las filas en modo solo lectura sin materializar las columnas descartadas"""
+       import openpyxl
+       libro = openpyxl.load_workbook(io.BytesIO(contenido), read_only=True, data_only=True)
+       try:
+           hoja_excel = libro[hoja] if hoja is not None else libro.worksheets[0]
+           filas = hoja_excel.iter_rows(values_only=True)
+           encabezado = next(filas, None)
+           if encabezado is None:
+               return pd.DataFrame()
 
 
-       # Buscar por prefijo
-       for codigo, (categoria, subcategoria) in self.categorias_map.items():
-           if codigo_str.startswith(codigo):
-               return categoria, subcategoria, 0.8
+           posiciones = [
+               i for i, col in enumerate(encabezado)
+               if col is not None and (usecols is None or usecols(col))
+           ]
+           if not posiciones:
+               return pd.DataFrame()
+           extraer = itemgetter(*posiciones)
+           ancho = max(posiciones) + 1
+           valores = []
+           for fila in filas:
+               if len(fila) < ancho:
+                   fila = fila + (None,) * (ancho - len(fila))
+               valores.append(extraer(fila))
+       finally:
+           libro.close()
+
+
+       if len(posiciones) == 1:
+           valores = [(valor,) for valor in valores]
+       df = pd.DataFrame.from_records(valores, columns=[str(encabezado[i]) for i in posiciones])
+       # Mismo tratamiento de celdas vacías que pd.read_excel
+       return df.dropna(how='all').fillna(value=np.nan)
+
+
+   def _ruta_parquet(self, contenido, hoja, columnas):
+       """Ruta de la copia Parquet según el contenido del archivo, la hoja y las columnas"""
+       if self.ruta_cache is None:
+           return None
+       hash_contenido = hashlib.sha256(contenido)
+       hash_contenido.update(repr((
+           hoja, sorted(columnas) if columnas is not None else None, UploadSchema.VARIANTES, UploadSchema.TIPOS
+       )).encode())
+       return os.path.join(self.ruta_cache, f'{hash_contenido.hexdigest()}.parquet')
 
 
-       # Clasificación por palabras clave
-       denominacion_lower = str(denominacion).lower()
-       if any(palabra in denominacion_lower for palabra in ['activo', 'inversión']):
-           return 'Activo corriente', 'Clasificado por denominación', 0.6
-       elif any(palabra in denominacion_lower for palabra in ['pasivo', 'deuda']):
-           return 'Pasivo corriente', 'Clasificado por denominación', 0.6
-       elif any(palabra in denominacion_lower for palabra in ['patrimonio', 'capital']):
-           return 'Patrimonio', 'Clasificado por denominación', 0.6
-       elif any(palabra in denominacion_lower for palabra in ['ingreso', 'venta']):
-           return 'Ventas', 'Clasificado por denominación', 0.6
-       elif any(palabra in denominacion_lower for palabra in ['costo', 'gasto']):
-           return 'Costos', 'Clasificado por denominación', 0.6
+   def _guardar_parquet(self, df, no_convertidos_por_nit, ruta_parquet):
+       """Guarda la copia Parquet y, junto a ella, los no convertidos por NIT; si falla se omite la caché"""
+       ruta_no_convertidos = self._ruta_no_convertidos(ruta_parquet)
+       try:
+           os.makedirs(self.ruta_cache, exist_ok=True)
+           # Primero el JSON: la existencia del Parquet marca la entrada de caché como completa
+           with open(ruta_no_convertidos, 'w', encoding='utf-8') as archivo:
+               json.dump(
+                   None if no_convertidos_por_nit is None else
+                   {str(nit): int(total) for nit, total in no_convertidos_por_nit.items()},
+                   archivo
+               )
+           df.to_parquet(ruta_parquet, index=False)
+       except (ValueError, ImportError, OSError):
+           for ruta in [ruta_parquet, ruta_no_convertidos]:
+               if os.path.exists(ruta):
+                   os.remove(ruta)
 
 
-       return 'No clasificada', 'No clasificada', 0.0
+   @staticmethod
+   def _ruta_no_convertidos(ruta_parquet):
+       """Ruta del JSON con los valores no convertidos por NIT de una copia Parquet"""
+       return f'{os.path.splitext(ruta_parquet)[0]}.no_convertidos.json'
 
 
+   def _leer_no_convertidos(self, ruta_parquet):
+       """Valores no convertidos por NIT guardados junto a la copia Parquet (None si no hubo conversión)"""
+       try:
+           with open(self._ruta_no_convertidos(ruta_parquet), encoding='utf-8') as archivo:
+               no_convertidos = json.load(archivo)
+       except (OSError, ValueError):
+           return None
+       if no_convertidos is None:
+           return None
+       return pd.Series(no_convertidos, dtype='int64', name='count').rename_axis('nit')
 
 
-class RiskPredictor:
-   """Clase para predecir riesgo financiero"""
 
 
-   def __init__(self):
-       self.umbrales = self._definir_umbrales()
+class DataQualityScanner:
+   """Pre-escaneo de calidad del archivo cargado, antes de clasificar (conteos vectorizados o por muestra)"""
 
 
-   def _definir_umbrales(self):
-       return {
-           'liquidez_alto_riesgo': 1.0,
-           'liquidez_medio_riesgo': 1.5,
-           'endeudamiento_alto_riesgo': 0.7,
-           'endeudamiento_medio_riesgo': 0.5,
-           'margen_alto_riesgo': 0.0,
-           'margen_medio_riesgo': 0.05,
-       }
+   COLUMNAS_REQUERIDAS = ['nit', 'razonsocial', 'codigoconcepto', 'valor', 'denominacion']
+   MAX_NITS_REPORTADOS = 20
 
 
-   def predecir_riesgo(self, indicadores):
-       """Predice el riesgo basado en indicadores financieros"""
-       puntaje = 0
-       factores = []
-       umbral = self.umbrales
+   # Sobre archivos de más de max_filas_exactas filas la cobertura y los nulos se estiman con una muestra
+   def __init__(self, max_filas_exactas=1_000_000, tamano_muestra=200_000, semilla=42,
+                max_no_clasificada=0.5, max_valores_invalidos=0.2, max_nits_nulos=0.2):
+       self.max_filas_exactas = max_filas_exactas
+       self.tamano_muestra = tamano_muestra
+       self.semilla = semilla
+       self.max_no_clasificada = max_no_clasificada
+       self.max_valores_invalidos = max_valores_invalidos
+       self.max_nits_nulos = max_nits_nulos
+       self.classifier = FinancialClassifier()
 
 
-       # Evaluar liquidez
-       liquidez = indicadores.get('razon_corriente', 0)
-       if liquidez < umbral['liquidez_alto_riesgo']:
-           puntaje += 3
-           factores.append(('Liquidez crítica', 0.9))
-       elif liquidez < umbral['liquidez_medio_riesgo']:
-           puntaje += 1
-           factores.append(('Liquidez moderada', 0.6))
+   def escanear(self, df, no_convertidos_por_nit=None):
+       """Reporte de calidad: cobertura por prefijo, nulos, valores no numéricos, duplicados y motivos de rechazo"""
+       filas = len(df)
+       muestreado = filas > self.max_filas_exactas
+       df_analisis = df.sample(n=self.tamano_muestra, random_state=self.semilla) if muestreado else df
+       reporte = {'filas': filas, 'filas_analizadas': len(df_analisis), 'muestreado': muestreado}
 
 
-       # Evaluar endeudamiento
-       endeudamiento = indicadores.get('razon_endeudamiento', 0)
-       if endeudamiento > umbral['endeudamiento_alto_riesgo']:
-           puntaje += 3
-           factores.append(('Endeudamiento alto', 0.9))
-       elif endeudamiento > umbral['endeudamiento_medio_riesgo']:
-           puntaje += 1
-           factores.append(('Endeudamiento moderado', 0.6))
+       # Tasa de nulos de cada columna requerida (1.0 si la columna falta)
+       reporte['nulos'] = pd.Series({
+           columna: float(df_analisis[columna].isna().mean()) if columna in df_analisis.columns else 1.0
+           for columna in self.COLUMNAS_REQUERIDAS
+       }) if len(df_analisis) else pd.Series(0.0, index=self.COLUMNAS_REQUERIDAS)
 
 
-       # Evaluar rentabilidad
-       margen = indicadores.get('margen_neto', 0)
-       if margen < umbral['margen_alto_riesgo']:
-           puntaje += 2
-           factores.append(('Pérdidas operacionales', 0.8))
-       elif margen < umbral['margen_medio_riesgo']:
-           puntaje += 1
-           factores.append(('Baja rentabilidad', 0.5))
+       # Los montos no numéricos ya se detectaron al cargar (UploadSchema.parsear_montos)
+       reporte['valores_no_numericos'] = (
+           int(no_convertidos_por_nit.sum()) if no_convertidos_por_nit is not None else 0
+       )
 
 
-       # Determinar nivel de riesgo
-       if puntaje >= 6:
-           return "ALTO", min(0.95, 0.6 + (puntaje * 0.05)), factores
-       elif puntaje >= 3:
-           return "MEDIO", min(0.8, 0.3 + (puntaje * 0.1)), factores
-       else:
-           return "BAJO", max(0.1, 0.1 + (puntaje * 0.05)), factores
+       # Duplicados exactos y NITs sin razón social: propios de cada NIT, se estiman con una muestra de NITs completos
+       df_nits, factor = self._muestra_por_nit(df) if muestreado else (df, 1.0)
+       duplicadas = pd.util.hash_pandas_object(df_nits, index=False).duplicated().sum() if len(df_nits) else 0
+       reporte['filas_duplicadas'] = int(round(duplicadas * factor))
+       nits_sin_razon_social = []
+       if 'nit' in df_nits.columns and 'razonsocial' in df_nits.columns:
+           con_razon_social = df_nits['razonsocial'].notna().groupby(df_nits['nit']).any()
+           nits_sin_razon_social = con_razon_social.index[~con_razon_social.to_numpy()]
+       reporte['nits_sin_razon_social'] = int(round(len(nits_sin_razon_social) * factor))
+       reporte['muestra_nits_sin_razon_social'] = list(nits_sin_razon_social[:self.MAX_NITS_REPORTADOS])
 
 
+       reporte['cobertura_por_prefijo'] = self._cobertura_por_prefijo(df_analisis)
+       cobertura = reporte['cobertura_por_prefijo']
+       reporte['pct_no_clasificada'] = (
+           float((cobertura['filas'] * cobertura['pct_no_clasificada']).sum() / cobertura['filas'].sum())
+           if len(cobertura) else 0.0
+       )
+       reporte['motivos_rechazo'] = self._motivos_rechazo(df, reporte)
+       return reporte
 
 
-class DataProcessor:
-   """Clase para procesar datos financieros"""
+   def _muestra_por_nit(self, df):
+       """Todas las filas de una muestra de NITs (por hash del NIT); retorna (muestra, factor de expansión)"""
+       if 'nit' not in df.columns:
+           return df.sample(n=self.tamano_muestra, random_state=self.semilla), len(df) / self.tamano_muestra
+       # Cada NIT (incluido el grupo sin NIT) entra con probabilidad tamano_muestra / filas
+       fraccion = self.tamano_muestra / len(df)
+       hashes = pd.util.hash_array(df['nit'].to_numpy(dtype=object), hash_key=f'{self.semilla:016d}'[-16:])
+       return df[hashes % 1_000_000 < fraccion * 1_000_000], 1 / fraccion
+
+
+   def _cobertura_por_prefijo(self, df):
+       """Cobertura por prefijo de código (2 dígitos): clasificada por código, por denominación o sin clasificar"""
+       if 'codigoconcepto' not in df.columns or df.empty:
+           return pd.DataFrame(columns=['filas', 'pct_por_codigo', 'pct_por_denominacion', 'pct_no_clasificada'])
+
+
+       codigos = df['codigoconcepto']
+       # Misma tabla de consulta por código distinto que usa la clasificación
+       confianza = self.classifier.clasificar_lote(codigos, df.get('denominacion'))['confianza_clasificacion']
+       confianza = confianza.to_numpy()
+       prefijo = codigos.astype(str).str.strip().str[:2].where(codigos.notna(), 'Sin código').to_numpy(dtype=object)
+       df_cobertura = pd.DataFrame({
+           'prefijo': prefijo,
+           'por_codigo': confianza >= 0.8,
+           'por_denominacion': (confianza > 0) & (confianza < 0.8),
+           'no_clasificada': confianza == 0
+       })
+       return df_cobertura.groupby('prefijo').agg(
+           filas=('por_codigo', 'size'),
+           pct_por_codigo=('por_codigo', 'mean'),
+           pct_por_denominacion=('por_denominacion', 'mean'),
+           pct_no_clasificada=('no_clasificada', 'mean')
+       ).sort_values('filas', ascending=False)
+
+
+   def _motivos_rechazo(self, df, reporte):
+       """Motivos para rechazar el archivo antes de la clasificación (vacío si se puede procesar)"""
+       motivos = []
+       faltantes = [columna for columna in ['nit', 'codigoconcepto', 'valor'] if columna not in df.columns]
+       if faltantes:
+           motivos.append(f"Faltan columnas requeridas: {', '.join(faltantes)}")
+           return motivos
+       if reporte['filas'] == 0:
+           motivos.append("El archivo no tiene filas")
+           return motivos
+
+
+       if reporte['pct_no_clasificada'] > self.max_no_clasificada:
+           motivos.append(
+               f"{reporte['pct_no_clasificada']:.0%} de las filas quedaría como 'No clasificada' "
+               f"(máximo {self.max_no_clasificada:.0%})"
+           )
+       # Los montos no numéricos quedan como NaN al cargar: la tasa de nulos de valor ya los incluye
+       valores_invalidos = reporte['nulos']['valor']
+       if valores_invalidos > self.max_valores_invalidos:
+           motivos.append(
+               f"{valores_invalidos:.0%} de los valores son vacíos o no numéricos "
+               f"(máximo {self.max_valores_invalidos:.0%})"
+           )
+       if reporte['nulos']['nit'] > self.max_nits_nulos:
+           motivos.append(
+               f"{reporte['nulos']['nit']:.0%} de las filas no tiene NIT (máximo {self.max_nits_nulos:.0%})"
+           )
+       return motivos
 
 
-   def __init__(self):
-       self.classifier = FinancialClassifier()
 
 
-   def procesar_dataframe(self, df, info_entidades=None):
-       """Procesa un DataFrame completo y clasifica todas las cuentas"""
-       resultados = []
+class SQLBackend:
+   """Backend out-of-core de DataProcessor: clasifica y agrega con SQL (SQLite en disco) sobre CSV/Parquet"""
 
 
-       # Usar nombres de columnas normalizados
-       CODIGO_CONCEPTO = 'codigoconcepto'
-       DENOMINACION = 'denominacion'
-       NIT = 'nit'
+   COLUMNAS = ['nit', 'razonsocial', 'codigoconcepto', 'valor', 'denominacion']
 
 
-       for _, row in df.iterrows():
-           codigo_concepto_val = row.get(CODIGO_CONCEPTO)
-           denominacion_val = row.get(DENOMINACION)
+   def __init__(self, ruta_db=None, tamano_lote=500_000):
+       self.tamano_lote = tamano_lote
+       self.classifier = FinancialClassifier()
+       self.data_processor = DataProcessor()
+       # Sin ruta se usa una base temporal que se elimina al cerrar
+       self.temporal = ruta_db is None
+       if self.temporal:
+           descriptor, ruta_db = tempfile.mkstemp(suffix='.sqlite')
+           os.close(descriptor)
+       self.ruta_db = ruta_db
+       self.conexion = sqlite3.connect(ruta_db)
+       # Carga masiva: sin journal ni sincronización; la caché de páginas queda acotada
+       self.conexion.execute('PRAGMA journal_mode = OFF')
+       self.conexion.execute('PRAGMA synchronous = OFF')
+       self.conexion.execute('PRAGMA cache_size = -262144')
+       self.conexion.execute('PRAGMA temp_store = FILE')
+
+
+   def cerrar(self):
+       """Cierra la conexión y elimina la base temporal"""
+       self.conexion.close()
+       if self.temporal and os.path.exists(self.ruta_db):
+           os.remove(self.ruta_db)
+
+
+   def _lotes_archivo(self, ruta, encoding='utf-8'):
+       """Lee el archivo por lotes con las columnas del esquema (nombres canónicos)"""
+       if ruta.endswith('.parquet'):
+           import pyarrow.parquet as pq
+           archivo = pq.ParquetFile(ruta)
+           mapeo = UploadSchema.mapear_encabezados(archivo.schema_arrow.names, set(self.COLUMNAS))
+           for lote in archivo.iter_batches(batch_size=self.tamano_lote, columns=list(mapeo)):
+               yield lote.to_pandas().rename(columns=mapeo)
+       else:
+           encabezados = pd.read_csv(ruta, nrows=0, encoding=encoding).columns
+           mapeo = UploadSchema.mapear_encabezados(encabezados, set(self.COLUMNAS))
+           lector = pd.read_csv(ruta, usecols=list(mapeo), dtype=UploadSchema.tipos_lectura(mapeo),
+                                encoding=encoding, chunksize=self.tamano_lote)
+           for lote in lector:
+               yield lote.rename(columns=mapeo)
+
+
+   def cargar_archivo(self, ruta, encoding='utf-8'):
+       """Carga el archivo crudo a la tabla movimientos, lote por lote, con la misma limpieza que la carga en memoria"""
+       self.conexion.execute('DROP TABLE IF EXISTS movimientos')
+       self.conexion.execute(
+           'CREATE TABLE movimientos (fila INTEGER PRIMARY KEY, nit TEXT, razonsocial TEXT, codigoconcepto TEXT, '
+           'valor REAL, denominacion TEXT, codigo TEXT, denominacion_min TEXT)'
+       )
+       filas = 0
+       for lote in self._lotes_archivo(ruta, encoding):
+           lote, _ = UploadSchema.aplicar_tipos(lote.reindex(columns=self.COLUMNAS))
+           lote['nit'] = REPSValidator.canonicalizar_nits(lote['nit'])['nit']
+           # Mismas transformaciones que FinancialClassifier.clasificar_cuenta (str().strip() y lower())
+           lote['codigo'] = lote['codigoconcepto'].str.strip()
+           lote['denominacion_min'] = lote['denominacion'].str.lower()
+           lote.insert(0, 'fila', np.arange(filas, filas + len(lote)))
+           self.conexion.executemany(
+               'INSERT INTO movimientos VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+               lote.astype(object).where(lote.notna(), None).itertuples(index=False, name=None)
+           )
+           filas += len(lote)
+       self.conexion.commit()
+       return filas
+
+
+   def _crear_tablas_referencia(self, info_entidades=None):
+       """Crea la tabla de consulta de códigos distintos y la de tipo de entidad"""
+       # La misma tabla de consulta de FinancialClassifier (exacto 1.0 o prefijo 0.8), por código distinto
+       codigos = [fila[0] for fila in self.conexion.execute(
+           'SELECT DISTINCT codigo FROM movimientos WHERE codigo IS NOT NULL'
+       )]
+       tabla = self.classifier.tabla_codigos(codigos)
+       tabla = tabla[tabla['confianza_clasificacion'] > 0]
+       self.conexion.execute('DROP TABLE IF EXISTS clasificacion_codigos')
+       self.conexion.execute('CREATE TABLE clasificacion_codigos (codigo TEXT PRIMARY KEY, categoria TEXT, '
+                             'subcategoria TEXT, confianza REAL)')
+       self.conexion.executemany(
+           'INSERT INTO clasificacion_codigos VALUES (?, ?, ?, ?)',
+           tabla[self.classifier.COLUMNAS_TABLA[:3]].itertuples(index=True, name=None)
+       )
 
 
-           # Asegurar que los valores existen antes de clasificar
-           if pd.isna(codigo_concepto_val) and pd.isna(denominacion_val):
-               categoria, subcategoria, confianza = 'No clasificada', 'No clasificada', 0.0
-           else:
-               categoria, subcategoria, confianza = self.classifier.clasificar_cuenta(
-                   codigo_concepto_val,
-                   denominacion_val
-               )
+       # El tipo de entidad se resuelve con la misma lógica vectorizada, sobre los pares distintos
+       pares = pd.read_sql_query('SELECT DISTINCT nit, razonsocial FROM movimientos', self.conexion)
+       pares['tipo_entidad'] = self.data_processor.determinar_tipos_entidad(pares, info_entidades)
+       self.conexion.execute('DROP TABLE IF EXISTS tipos_entidad')
+       self.conexion.execute('CREATE TABLE tipos_entidad (nit TEXT, razonsocial TEXT, tipo_entidad TEXT)')
+       self.conexion.executemany('INSERT INTO tipos_entidad VALUES (?, ?, ?)',
+                                 pares.astype(object).where(pares.notna(), None).itertuples(index=False, name=None))
+       self.conexion.execute('CREATE INDEX idx_tipos_entidad ON tipos_entidad (nit, razonsocial)')
+
+
+   def _sql_palabras_clave(self, resultado):
+       """Ramas CASE de la clasificación por palabras clave de la denominación"""
+       ramas = []
+       for palabras, categoria in self.classifier.PALABRAS_CLAVE:
+           condicion = ' OR '.join(f"instr(m.denominacion_min, '{palabra}') > 0" for palabra in palabras)
+           valor = {
+               'categoria': f"'{categoria}'",
+               'subcategoria': "'Clasificado por denominación'",
+               'confianza': '0.6'
+           }[resultado]
+           ramas.append(f'WHEN {condicion} THEN {valor}')
+       return '\n'.join(ramas)
+
+
+   def clasificar(self, info_entidades=None):
+       """Clasifica todas las filas con SQL (tabla clasificado); equivale a DataProcessor.procesar_dataframe"""
+       self._crear_tablas_referencia(info_entidades)
+       self.conexion.execute('DROP TABLE IF EXISTS clasificado')
+       self.conexion.execute(f'''
+           CREATE TABLE clasificado AS
+           SELECT m.fila, m.nit, m.razonsocial, m.codigoconcepto, m.valor, m.denominacion,
+                  CASE WHEN m.codigo IS NULL THEN 'No clasificada'
+                       WHEN c.categoria IS NOT NULL THEN c.categoria
+                       {self._sql_palabras_clave('categoria')}
+                       ELSE 'No clasificada' END AS categoria_principal,
+                  CASE WHEN m.codigo IS NULL THEN 'No clasificada'
+                       WHEN c.categoria IS NOT NULL THEN c.subcategoria
+                       {self._sql_palabras_clave('subcategoria')}
+                       ELSE 'No clasificada' END AS subcategoria,
+                  CASE WHEN m.codigo IS NULL THEN 0.0
+                       WHEN c.categoria IS NOT NULL THEN c.confianza
+                       {self._sql_palabras_clave('confianza')}
+                       ELSE 0.0 END AS confianza_clasificacion,
+                  t.tipo_entidad
+           FROM movimientos m
+           LEFT JOIN clasificacion_codigos c ON c.codigo = m.codigo
+           LEFT JOIN tipos_entidad t ON t.nit IS m.nit AND t.razonsocial IS m.razonsocial
+           ORDER BY m.fila
+       ''')
+       self.conexion.execute('CREATE INDEX idx_clasificado_nit ON clasificado (nit, fila)')
+       self.conexion.commit()
+
+
+   def leer_clasificado(self):
+       """Retorna la tabla clasificada completa (solo para volúmenes que caben en memoria)"""
+       return pd.read_sql_query('SELECT * FROM clasificado ORDER BY fila', self.conexion).drop(columns=['fila'])
+
+
+   def exportar_clasificado(self, ruta_parquet):
+       """Escribe la tabla clasificada a Parquet por lotes, sin materializarla completa"""
+       import pyarrow as pa
+       import pyarrow.parquet as pq
+       cursor = self.conexion.execute('SELECT * FROM clasificado ORDER BY fila')
+       columnas = [descripcion[0] for descripcion in cursor.description]
+       escritor = None
+       try:
+           while True:
+               filas = cursor.fetchmany(self.tamano_lote)
+               if not filas:
+                   break
+               tabla = pa.Table.from_pandas(pd.DataFrame.from_records(filas, columns=columnas), preserve_index=False)
+               if escritor is None:
+                   escritor = pq.ParquetWriter(ruta_parquet, tabla.schema)
+               escritor.write_table(tabla.cast(escritor.schema))
+       finally:
+           if escritor is not None:
+               escritor.close()
+
+
+   def calcular_totales_por_categoria(self):
+       """Totales por NIT y categoría agregados en SQL (misma forma que en DataProcessor)"""
+       df_largo = pd.read_sql_query('''
+           SELECT nit, categoria_principal, SUM(valor) AS valor
+           FROM clasificado
+           WHERE nit IS NOT NULL AND valor IS NOT NULL AND valor != 0
+           GROUP BY 1, 2
+       ''', self.conexion)
+       return df_largo.pivot_table(
+           index='nit', columns='categoria_principal', values='valor', aggfunc='sum', fill_value=0
+       )
 
 
-           nit = str(row[NIT]).strip() if NIT in row and not pd.isna(row[NIT]) else ''
-           tipo_entidad = self._determinar_tipo_entidad(nit, info_entidades, row)
+   def calcular_indicadores_por_nit(self):
+       """Indicadores por NIT; equivale a DataProcessor.calcular_indicadores_por_nit sobre la tabla clasificada"""
+       df_totales = self.calcular_totales_por_categoria()
+       df_indicadores = self.data_processor.calcular_ratios_vectorizado(df_totales)
 
 
-           resultados.append({
-               'categoria_principal': categoria,
-               'subcategoria': subcategoria,
-               'confianza_clasificacion': confianza,
-               'tipo_entidad': tipo_entidad
-           })
+       # Razón social y tipo de entidad de la primera fila de cada NIT
+       df_entidades = pd.read_sql_query('''
+           SELECT c.nit, c.razonsocial, c.tipo_entidad, p.con_razon_social
+           FROM clasificado c
+           JOIN (SELECT nit, MIN(fila) AS fila, COUNT(razonsocial) AS con_razon_social
+                 FROM clasificado WHERE nit IS NOT NULL GROUP BY nit) p ON p.fila = c.fila
+       ''', self.conexion).set_index('nit')
+       razon_social = df_entidades['razonsocial'].where(df_entidades['con_razon_social'] > 0, 'Sin razón social')
+       df_indicadores['razon_social'] = razon_social.reindex(df_indicadores.index)
+       df_indicadores['tipo_entidad'] = df_entidades['tipo_entidad'].reindex(df_indicadores.index)
+       return df_indicadores.to_dict(orient='index')
 
 
-       df_resultado = df.copy()
-       df_clasificaciones = pd.DataFrame(resultados)
+   def procesar_archivo(self, ruta, info_entidades=None, encoding='utf-8'):
+       """Carga, clasifica y agrega un archivo completo; retorna los indicadores por NIT"""
+       self.cargar_archivo(ruta, encoding)
+       self.clasificar(info_entidades)
+       return self.calcular_indicadores_por_nit()
 
 
-       # Resetear índices para concatenación segura
-       df_resultado = df_resultado.reset_index(drop=True)
-       df_clasificaciones = df_clasificaciones.reset_index(drop=True)
 
 
-       return pd.concat([df_resultado, df_clasificaciones], axis=1)
+class SharedResultStore:
+   """Almacén de resultados compartido por proceso y direccionado por contenido"""
 
 
-   def _determinar_tipo_entidad(self, nit, info_entidades, row):
-       """Determina el tipo de entidad (EPS/IPS)"""
-       RAZON_SOCIAL = 'razonsocial'
+   # Las sesiones guardan solo la clave; los resultados publicados son de solo lectura.
+   # Cada entrada registra las sesiones que la referencian y solo se expulsa (LRU) sin referencias.
+   def __init__(self, max_bytes=2 * 1024 ** 3, ttl_sesion=4 * 3600):
+       self.max_bytes = max_bytes
+       # Las sesiones sin actividad durante este tiempo dejan de contar como referencia
+       self.ttl_sesion = ttl_sesion
+       self.entradas = OrderedDict()
+       self.en_calculo = {}
+       self.bytes_totales = 0
+       self.aciertos = 0
+       self.fallos = 0
+       self._lock = threading.Lock()
 
 
-       if info_entidades and nit in info_entidades:
-           return info_entidades[nit].get('tipo', 'NO VALIDADO')
+   @staticmethod
+   def clave_contenido(*partes):
+       """Genera una clave estable a partir del contenido de DataFrames y valores simples"""
+       hash_contenido = hashlib.sha256()
+       for parte in partes:
+           if isinstance(parte, pd.DataFrame):
+               hash_contenido.update(repr(parte.columns.tolist()).encode())
+               hash_contenido.update(pd.util.hash_pandas_object(parte, index=False).values.tobytes())
+           else:
+               hash_contenido.update(repr(parte).encode())
+           hash_contenido.update(b'|')
+       return hash_contenido.hexdigest()
+
+
+   @classmethod
+   def _estimar_bytes(cls, objeto):
+       """Estima la memoria ocupada por un resultado"""
+       if isinstance(objeto, (pd.DataFrame, pd.Series)):
+           uso = objeto.memory_usage(deep=True)
+           return int(uso.sum()) if isinstance(uso, pd.Series) else int(uso)
+       if isinstance(objeto, pd.Index):
+           return int(objeto.memory_usage(deep=True))
+       if isinstance(objeto, dict):
+           return sys.getsizeof(objeto) + sum(cls._estimar_bytes(valor) for valor in objeto.values())
+       if isinstance(objeto, (list, tuple, set)):
+           return sys.getsizeof(objeto) + sum(cls._estimar_bytes(valor) for valor in objeto)
+       # Objetos que reportan su memoria (arreglos numpy, AccountMatrix)
+       if hasattr(objeto, 'nbytes'):
+           return int(objeto.nbytes)
+       return sys.getsizeof(objeto)
+
+
+   def obtener(self, clave, sesion):
+       """Retorna el resultado de la clave (o None) y registra la referencia de la sesión"""
+       with self._lock:
+           entrada = self.entradas.get(clave)
+           if entrada is None:
+               self.fallos += 1
+               return None
+           self.entradas.move_to_end(clave)
+           entrada['sesiones'][sesion] = time.time()
+           self.aciertos += 1
+           return entrada['resultado']
+
+
+   def publicar(self, clave, resultado, sesion):
+       """Guarda un resultado bajo su clave de contenido, referenciado por la sesión"""
+       with self._lock:
+           entrada = self.entradas.get(clave)
+           if entrada is None:
+               entrada = {'resultado': resultado, 'bytes': self._estimar_bytes(resultado), 'sesiones': {}}
+               self.entradas[clave] = entrada
+               self.bytes_totales += entrada['bytes']
+           entrada['sesiones'][sesion] = time.time()
+           self.entradas.move_to_end(clave)
+           self._expulsar()
+           return entrada['resultado']
+
+
+   def obtener_o_calcular(self, clave, sesion, calcular):
+       """Retorna (resultado, reutilizado); si varias sesiones piden la misma clave se calcula una sola vez"""
+       resultado = self.obtener(clave, sesion)
+       if resultado is not None:
+           return resultado, True
+
+
+       with self._lock:
+           candado = self.en_calculo.setdefault(clave, threading.Lock())
+       try:
+           with candado:
+               # Otra sesión pudo terminar el cálculo mientras se esperaba el candado
+               resultado = self.obtener(clave, sesion)
+               if resultado is not None:
+                   return resultado, True
+               return self.publicar(clave, calcular(), sesion), False
+       finally:
+           with self._lock:
+               self.en_calculo.pop(clave, None)
+
+
+   def liberar(self, clave, sesion):
+       """Elimina la referencia de la sesión sobre la clave"""
+       with self._lock:
+           entrada = self.entradas.get(clave)
+           if entrada is not None:
+               entrada['sesiones'].pop(sesion, None)
+           self._expulsar()
+
+
+   def _expulsar(self):
+       """Expulsa las entradas sin referencias, de la menos usada a la más usada, hasta respetar el límite"""
+       limite_actividad = time.time() - self.ttl_sesion
+       for entrada in self.entradas.values():
+           for sesion in [s for s, acceso in entrada['sesiones'].items() if acceso < limite_actividad]:
+               del entrada['sesiones'][sesion]
+
+
+       for clave in list(self.entradas.keys()):
+           if self.bytes_totales <= self.max_bytes:
+               break
+           if not self.entradas[clave]['sesiones']:
+               self.bytes_totales -= self.entradas.pop(clave)['bytes']
 
 
-       razon_social = str(row.get(RAZON_SOCIAL, '')).upper()
-       if 'EPS' in razon_social:
-           return 'EPS'
-       elif any(palabra in razon_social for palabra in ['IPS', 'CLINICA', 'HOSPITAL']):
-           return 'IPS'
+   def estadisticas(self):
+       """Resumen del estado del almacén"""
+       with self._lock:
+           return {
+               'entradas': len(self.entradas),
+               'memoria_mb': self.bytes_totales / 1024 ** 2,
+               'referencias': sum(len(entrada['sesiones']) for entrada in self.entradas.values()),
+               'aciertos': self.aciertos,
+               'fallos': self.fallos
+           }
 
 
-       if nit.startswith('8') and len(nit) == 9:
-           return 'EPS'
-       elif nit.startswith('9') and len(nit) == 9:
-           return 'IPS'
 
 
-       return 'NO DETERMINADO'
+@st.cache_resource(show_spinner=False)
+def obtener_almacen_resultados():
+   """Almacén de resultados único para todas las sesiones del proceso"""
+   return SharedResultStore()
 
 
-   def calcular_indicadores_por_nit(self, df_clasificado, info_entidades=None):
-       """Calcula indicadores financieros por NIT"""
-       df_clasificado['nit'] = df_clasificado['nit'].astype(str)
 
 
-       # Usar nombre de columna normalizado
-       VALOR = 'valor'
-       RAZON_SOCIAL = 'razonsocial'
+class JobRunner:
+   """Trabajos en segundo plano (pool de hilos) con una tabla local de trabajos por proceso"""
 
 
-       df_clasificado['valor_numerico'] = pd.to_numeric(df_clasificado[VALOR], errors='coerce')
+   ACTIVOS = ('En cola', 'En curso')
 
 
-       indicadores_por_nit = {}
+   # Los trabajos terminados se conservan en la tabla para volver a adjuntar su resultado. Cada trabajo registra
+   # las sesiones que lo enviaron (un trabajo activo idéntico se comparte) y solo ellas lo ven o lo adjuntan.
+   # La función de un trabajo no usa st.*: recibe reportar(etapa, completados, total) y retorna un resumen.
+   def __init__(self, max_hilos=8, max_terminados=100):
+       self.pool = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix='trabajo')
+       self.max_terminados = max_terminados
+       self.trabajos = OrderedDict()
+       self._lock = threading.Lock()
 
 
-       for nit in df_clasificado['nit'].unique():
-           df_nit = df_clasificado[df_clasificado['nit'] == nit].copy()
-           indicadores = self._calcular_indicadores_completos(df_nit)
-           if indicadores:
-               razon_social = self._obtener_razon_social_desde_datos(df_nit)
-               indicadores['razon_social'] = razon_social
-               indicadores['tipo_entidad'] = df_nit['tipo_entidad'].iloc[
-                   0] if 'tipo_entidad' in df_nit.columns else 'NO DETERMINADO'
-               indicadores_por_nit[nit] = indicadores
+   def enviar(self, tipo, clave, descripcion, funcion, id_turno=None, sesion=None):
+       """Encola un trabajo de la sesión; si ya hay uno activo con la misma clave la sesión se suma a ese trabajo"""
+       with self._lock:
+           for trabajo in self.trabajos.values():
+               if trabajo['clave'] == clave and trabajo['estado'] in self.ACTIVOS:
+                   trabajo['sesiones'].add(sesion)
+                   return trabajo['id']
+           id_trabajo = uuid.uuid4().hex[:12]
+           self.trabajos[id_trabajo] = {
+               'id': id_trabajo,
+               'tipo': tipo,
+               'clave': clave,
+               'descripcion': descripcion,
+               'estado': 'En cola',
+               'creado': time.time(),
+               'inicio': None,
+               'fin': None,
+               'etapas': [],
+               'resumen': None,
+               'error': None,
+               # Turno en HeavyJobScheduler (para mostrar la posición en la cola)
+               'id_turno': id_turno,
+               'sesiones': {sesion}
+           }
+           self._recortar()
+       self.pool.submit(self._ejecutar, id_trabajo, funcion)
+       return id_trabajo
 
 
-       return indicadores_por_nit
+   def _ejecutar(self, id_trabajo, funcion):
+       """Corre el trabajo en un hilo del pool y registra su resultado o su error"""
+       with self._lock:
+           self.trabajos[id_trabajo].update(estado='En curso', inicio=time.time())
+       try:
+           resumen = funcion(lambda etapa, completados=0, total=None: self._reportar(
+               id_trabajo, etapa, completados, total
+           ))
+           estado, error = 'Completado', None
+       except Exception as e:
+           resumen, estado, error = None, 'Error', str(e)
+       with self._lock:
+           trabajo = self.trabajos[id_trabajo]
+           trabajo.update(estado=estado, fin=time.time(), resumen=resumen, error=error)
+           if trabajo['etapas'] and trabajo['etapas'][-1]['fin'] is None:
+               trabajo['etapas'][-1]['fin'] = trabajo['fin']
+
+
+   def _reportar(self, id_trabajo, etapa, completados, total):
+       """Actualiza el avance de la etapa actual (una etapa nueva cierra la anterior)"""
+       ahora = time.time()
+       with self._lock:
+           etapas = self.trabajos[id_trabajo]['etapas']
+           if not etapas or etapas[-1]['etapa'] != etapa:
+               if etapas:
+                   etapas[-1]['fin'] = ahora
+               etapas.append({'etapa': etapa, 'inicio': ahora, 'fin': None, 'completados': 0, 'total': total})
+           etapas[-1]['completados'] = completados
+           if total is not None:
+               etapas[-1]['total'] = total
+
+
+   def _recortar(self):
+       """Elimina los trabajos terminados más antiguos por encima del máximo"""
+       terminados = [id_trabajo for id_trabajo, trabajo in self.trabajos.items()
+                     if trabajo['estado'] not in self.ACTIVOS]
+       for id_trabajo in terminados[:max(0, len(terminados) - self.max_terminados)]:
+           del self.trabajos[id_trabajo]
+
+
+   def consultar(self, id_trabajo):
+       """Copia del estado de un trabajo con el throughput por etapa (o None si no existe)"""
+       with self._lock:
+           trabajo = self.trabajos.get(id_trabajo)
+           if trabajo is None:
+               return None
+           copia = dict(trabajo, etapas=[dict(etapa) for etapa in trabajo['etapas']], sesiones=set(trabajo['sesiones']))
+
+
+       ahora = time.time()
+       for etapa in copia['etapas']:
+           etapa['segundos'] = (etapa['fin'] or ahora) - etapa['inicio']
+           etapa['por_segundo'] = etapa['completados'] / etapa['segundos'] if etapa['segundos'] > 0 else np.nan
+       etapa_actual = copia['etapas'][-1] if copia['etapas'] else None
+       copia['etapa'] = etapa_actual['etapa'] if etapa_actual else None
+       copia['progreso'] = 1.0 if copia['estado'] == 'Completado' else (
+           min(etapa_actual['completados'] / etapa_actual['total'], 1.0)
+           if etapa_actual and etapa_actual['total'] else 0.0
+       )
+       return copia
 
 
-   def _obtener_razon_social_desde_datos(self, df_nit):
-       """Obtiene la razón social desde la base de datos original"""
-       RAZON_SOCIAL = 'razonsocial'
+   def listar(self, sesion=None):
+       """Estado de los trabajos de la sesión (todos si es None), del más reciente al más antiguo"""
+       with self._lock:
+           ids = [id_trabajo for id_trabajo, trabajo in self.trabajos.items()
+                  if sesion is None or sesion in trabajo['sesiones']]
+       return [trabajo for trabajo in map(self.consultar, reversed(ids)) if trabajo is not None]
 
 
-       if RAZON_SOCIAL in df_nit.columns and not df_nit[RAZON_SOCIAL].isna().all():
-           return df_nit[RAZON_SOCIAL].iloc[0]
-       return 'Sin razón social'
 
 
-   def _calcular_indicadores_completos(self, df_nit):
-       """Calcula todos los indicadores financieros para un NIT específico"""
-       categorias_totales = {}
+@st.cache_resource(show_spinner=False)
+def obtener_ejecutor_trabajos():
+   """Ejecutor de trabajos único para todas las sesiones del proceso"""
+   return JobRunner()
 
 
-       for _, row in df_nit.iterrows():
-           categoria = row['categoria_principal']
-           valor = row['valor_numerico']
 
 
-           if not pd.isna(valor) and valor != 0:
-               categorias_totales[categoria] = categorias_totales.get(categoria, 0) + valor
+class HeavyJobScheduler:
+   """Planificador de operaciones pesadas del servidor: cupo de concurrencia, admisión por memoria y cola FIFO"""
 
 
-       if not categorias_totales:
-           return None
+   # Pico de memoria estimado de una clasificación respecto al tamaño del archivo cargado en memoria
+   FACTOR_MEMORIA = 4
 
 
-       return self._calcular_ratios_financieros(categorias_totales)
+   def __init__(self, max_concurrentes=2, max_memoria_bytes=4 * 1024 ** 3, max_muestras=500):
+       self.max_concurrentes = max_concurrentes
+       self.max_memoria_bytes = max_memoria_bytes
+       self.cola = deque()
+       self.en_ejecucion = {}
+       self.esperas = deque(maxlen=max_muestras)
+       self.admitidos = 0
+       self._condicion = threading.Condition()
 
 
-   def _calcular_ratios_financieros(self, categorias_totales):
-       """Calcula ratios financieros"""
-       indicadores = {}
+   @classmethod
+   def estimar_bytes(cls, df):
+       """Memoria estimada de procesar un DataFrame cargado"""
+       return int(df.memory_usage(deep=True).sum()) * cls.FACTOR_MEMORIA
 
 
-       # Valores básicos
-       activo_corriente = categorias_totales.get('Activo corriente', 0)
-       pasivo_corriente = categorias_totales.get('Pasivo corriente', 0)
-       pasivo_no_corriente = categorias_totales.get('Pasivo No corriente', 0)
-       pasivo_total = pasivo_corriente + pasivo_no_corriente
+   def _admisible(self, bytes_estimados):
+       """Hay cupo de concurrencia y de memoria para una operación de ese tamaño"""
+       if len(self.en_ejecucion) >= self.max_concurrentes:
+           return False
+       # Una operación mayor que el límite de memoria se admite sola para que no espere indefinidamente
+       if not self.en_ejecucion:
+           return True
+       return sum(self.en_ejecucion.values()) + bytes_estimados <= self.max_memoria_bytes
 
 
-       # Calcular activo total sumando todas las categorías de Activo
-       activo_total = sum(v for k, v in categorias_totales.items() if 'Activo' in k)
+   @contextmanager
+   def turno(self, id_turno, bytes_estimados):
+       """Bloquea hasta que la operación sea admitida, en orden de llegada, y libera el cupo al terminar"""
+       llegada = time.time()
+       with self._condicion:
+           self.cola.append(id_turno)
+           # FIFO estricto: solo se admite la cabeza de la cola, aunque una operación posterior quepa
+           while self.cola[0] != id_turno or not self._admisible(bytes_estimados):
+               self._condicion.wait()
+           self.cola.popleft()
+           self.en_ejecucion[id_turno] = bytes_estimados
+           self.esperas.append(time.time() - llegada)
+           self.admitidos += 1
+           # La nueva cabeza de la cola también puede caber
+           self._condicion.notify_all()
+       try:
+           yield
+       finally:
+           with self._condicion:
+               del self.en_ejecucion[id_turno]
+               self._condicion.notify_all()
 
 
-       patrimonio = categorias_totales.get('Patrimonio', 0)
-       utilidad_neta = categorias_totales.get('Utilidad neta', 0)
-       ventas = categorias_totales.get('Ventas', 0)
+   def posicion(self, id_turno):
+       """Posición (desde 1) de la operación en la cola; None si no está esperando"""
+       with self._condicion:
+           return self.cola.index(id_turno) + 1 if id_turno in self.cola else None
 
 
-       # Ratios de liquidez
-       indicadores['razon_corriente'] = self._safe_divide(activo_corriente, pasivo_corriente)
-       indicadores['prueba_acida'] = self._safe_divide(activo_corriente - categorias_totales.get('Inventarios', 0),
-                                                       pasivo_corriente)
+   def estadisticas(self):
+       """Ocupación actual y métricas del tiempo de espera en cola"""
+       with self._condicion:
+           esperas = np.array(self.esperas, dtype=float)
+           return {
+               'en_ejecucion': len(self.en_ejecucion),
+               'en_cola': len(self.cola),
+               'max_concurrentes': self.max_concurrentes,
+               'memoria_reservada_mb': sum(self.en_ejecucion.values()) / 1024 ** 2,
+               'admitidos': self.admitidos,
+               'espera_media_s': float(esperas.mean()) if len(esperas) else 0.0,
+               'espera_p95_s': float(np.percentile(esperas, 95)) if len(esperas) else 0.0,
+               'espera_max_s': float(esperas.max()) if len(esperas) else 0.0
+           }
 
 
-       # Ratios de endeudamiento
-       indicadores['razon_endeudamiento'] = self._safe_divide(pasivo_total, activo_total)
-       indicadores['leverage_financiero'] = self._safe_divide(pasivo_total, patrimonio)
 
 
-       # Ratios de rentabilidad
-       indicadores['roa'] = self._safe_divide(utilidad_neta, activo_total)
-       indicadores['roe'] = self._safe_divide(utilidad_neta, patrimonio)
-       indicadores['margen_neto'] = self._safe_divide(utilidad_neta, ventas)
+@st.cache_resource(show_spinner=False)
+def obtener_planificador_pesado():
+   """Planificador único del proceso; el cupo y la memoria se configuran con variables de entorno"""
+   return HeavyJobScheduler(
+       max_concurrentes=int(os.environ.get('RIESGO_MAX_TRABAJOS_PESADOS', 2)),
+       max_memoria_bytes=int(float(os.environ.get('RIESGO_MEMORIA_TRABAJOS_GB', 4)) * 1024 ** 3)
+   )
 
 
-       # Valores absolutos
-       indicadores.update({
-           'activo_corriente': activo_corriente,
-           'pasivo_corriente': pasivo_corriente,
-           'activo_total': activo_total,
-           'pasivo_total': pasivo_total,
-           'patrimonio': patrimonio,
-           'utilidad_neta': utilidad_neta,
-           'ventas': ventas
-       })
 
 
-       return indicadores
+class FinancialAnalyzerApp:
+   """Clase principal de la aplicación Streamlit"""
 
 
-   def _safe_divide(self, numerador, denominador):
-       """División segura evitando división por cero"""
-       return numerador / denominador if denominador != 0 else 0
+   # Límite de filas para resaltar la tabla de riesgo con Styler
+   MAX_FILAS_ESTILO = 2000
 
 
+   # Máximo de coincidencias enviadas a los selectores de entidades
+   MAX_OPCIONES_BUSQUEDA = 50
 
 
-class FinancialAnalyzerApp:
-   """Clase principal de la aplicación Streamlit"""
+   # Columnas que se leen de los libros Excel en cada módulo
+   COLUMNAS_VALIDACION = {'nit', 'razonsocial'}
+   COLUMNAS_FINANCIERAS = {'nit', 'razonsocial', 'codigoconcepto', 'valor', 'denominacion'}
 
 
    def __init__(self):
        self.reps_validator = REPSValidator()
        self.data_processor = DataProcessor()
        self.risk_predictor = RiskPredictor()
+       self.period_store = PeriodStore()
+       self.indicator_store = IndicatorTableStore()
+       self.quality_scanner = DataQualityScanner()
+       self.chart_data = ChartDataLayer()
+       self.almacen = obtener_almacen_resultados()
+       self.ejecutor = obtener_ejecutor_trabajos()
+       self.planificador = obtener_planificador_pesado()
+       self.excel_reader = ExcelReader()
 
 
    def run(self):
@@ -635,6 +2887,7 @@ class FinancialAnalyzerApp:
 
 
        modulo = self._show_sidebar()
+       self._show_jobs_panel()
 
 
        if modulo == "Validación REPS":
@@ -645,47 +2898,193 @@ class FinancialAnalyzerApp:
            self._show_risk_analysis()
 
 
-   def _load_dataframe(self, uploaded_file):
-       """Carga el DataFrame desde el archivo subido y normaliza las columnas."""
+   def _id_sesion(self):
+       """Identificador de la sesión para el conteo de referencias del almacén compartido"""
+       if 'id_sesion' not in st.session_state:
+           st.session_state.id_sesion = uuid.uuid4().hex
+       return st.session_state.id_sesion
+
+
+   def _resultado(self, nombre):
+       """Lee un resultado del almacén compartido a partir de la clave guardada en la sesión"""
+       grupo = 'validacion' if nombre in ('df_validacion', 'info_entidades') else 'clasificacion'
+       clave = st.session_state.get(f'clave_{grupo}')
+       if clave is None:
+           return None
+
+
+       resultado = self.almacen.obtener(clave, self._id_sesion())
+       if resultado is None:
+           return None
+       if nombre in ('df_clasificado', 'indicadores_por_nit'):
+           return resultado['snapshot_clasificacion'][nombre]
+       return resultado.get(nombre)
+
+
+   def _tabla_indicadores(self, clave=None):
+       """Tabla de indicadores (de la clasificación de la sesión por defecto): vista memory-map compartida"""
+       if clave is None:
+           clave = st.session_state.get('clave_clasificacion')
+       if clave is None:
+           return None
+
+
+       ruta_tabla = self.indicator_store.ruta_tabla(clave)
+       if not os.path.exists(ruta_tabla):
+           # Solo la clasificación de la sesión puede volver a escribirse desde el almacén compartido
+           indicadores_por_nit = self._resultado('indicadores_por_nit')
+           if indicadores_por_nit is None or clave != st.session_state.get('clave_clasificacion'):
+               return None
+           self.indicator_store.guardar(clave, indicadores_por_nit)
+       # La versión es el inodo (cambia con cada reemplazo atómico), no la fecha que renueva marcar_uso
+       estado = os.stat(ruta_tabla)
+       self.indicator_store.marcar_uso(ruta_tabla)
+       return abrir_tabla_indicadores(ruta_tabla, (estado.st_ino, estado.st_size))
+
+
+   def _asignar_resultado(self, grupo, clave):
+       """Apunta la sesión a una nueva clave y libera la referencia anterior"""
+       clave_anterior = st.session_state.get(f'clave_{grupo}')
+       st.session_state[f'clave_{grupo}'] = clave
+       if clave_anterior is not None and clave_anterior != clave:
+           self.almacen.liberar(clave_anterior, self._id_sesion())
+
+
+   def _enviar_trabajo(self, tipo, clave, descripcion, funcion, id_turno=None):
+       """Encola un trabajo en el ejecutor compartido y lo registra como pendiente de la sesión"""
+       id_trabajo = self.ejecutor.enviar(tipo, clave, descripcion, funcion, id_turno, self._id_sesion())
+       st.session_state.setdefault('trabajos_pendientes', {})[id_trabajo] = tipo
+
+
+   def _adjuntar_resultado(self, grupo, clave, resumen=None):
+       """Apunta la sesión al resultado de un trabajo terminado; False si ya no está en el almacén"""
+       if self.almacen.obtener(clave, self._id_sesion()) is None:
+           return False
+       self._asignar_resultado(grupo, clave)
+       if grupo == 'validacion':
+           st.session_state.version_validacion = st.session_state.get('version_validacion', 0) + 1
+       else:
+           st.session_state.version_datos = st.session_state.get('version_datos', 0) + 1
+           st.session_state.resumen_clasificacion = resumen
+           st.session_state.data_just_classified = True
+       return True
+
+
+   def _show_jobs_panel(self):
+       """Panel de trabajos en segundo plano de la sesión; se actualiza solo mientras haya trabajos activos"""
+       trabajos = self.ejecutor.listar(self._id_sesion())
+       if not trabajos:
+           return
+       activos = any(trabajo['estado'] in JobRunner.ACTIVOS for trabajo in trabajos)
+       st.fragment(self._mostrar_trabajos, run_every=2 if activos else None)(activos)
+
+
+   def _mostrar_trabajos(self, habia_activos):
+       """Muestra el avance de los trabajos de la sesión y los adjunta cuando terminan"""
+       # Solo los trabajos enviados por esta sesión: los archivos y resultados de otras sesiones no se exponen
+       trabajos = self.ejecutor.listar(self._id_sesion())
+       pendientes = st.session_state.get('trabajos_pendientes', {})
+       adjuntados = False
+       for trabajo in trabajos:
+           if trabajo['id'] not in pendientes or trabajo['estado'] in JobRunner.ACTIVOS:
+               continue
+           del pendientes[trabajo['id']]
+           if trabajo['estado'] == 'Error':
+               st.error(f"❌ {trabajo['descripcion']}: {trabajo['error']}")
+           else:
+               if self._adjuntar_resultado(trabajo['tipo'], trabajo['clave'], trabajo['resumen']):
+                   adjuntados = True
+       activos = [trabajo for trabajo in trabajos if trabajo['estado'] in JobRunner.ACTIVOS]
+       # Al terminar se recarga la app completa (resultados adjuntados y fin del sondeo)
+       if adjuntados or (habia_activos and not activos):
+           st.rerun()
+
+
+       with st.expander(f"⏳ Trabajos en segundo plano ({len(activos)} activos)", expanded=bool(activos)):
+           for trabajo in activos:
+               etapa = trabajo['etapas'][-1] if trabajo['etapas'] else None
+               detalle = f"{etapa['etapa']} ({etapa['completados']:,}/{etapa['total'] or 0:,})" if etapa else 'En cola'
+               posicion = self.planificador.posicion(trabajo['id_turno']) if trabajo['id_turno'] else None
+               if posicion is not None:
+                   detalle = f"esperando turno del servidor (posición {posicion} en la cola)"
+               st.progress(trabajo['progreso'], text=f"{trabajo['descripcion']}: {detalle}")
+               if trabajo['etapas']:
+                   st.dataframe(pd.DataFrame([{
+                       'Etapa': etapa['etapa'],
+                       'Elementos': etapa['completados'],
+                       'Segundos': etapa['segundos'],
+                       'Elementos/s': etapa['por_segundo']
+                   } for etapa in trabajo['etapas']]), hide_index=True)
+
+
+           terminados = [trabajo for trabajo in trabajos if trabajo['estado'] not in JobRunner.ACTIVOS]
+           if not terminados:
+               return
+           st.dataframe(pd.DataFrame([{
+               'Trabajo': trabajo['descripcion'],
+               'Estado': trabajo['estado'],
+               'Inicio': datetime.fromtimestamp(trabajo['creado']).strftime('%H:%M:%S'),
+               'Duración (s)': (trabajo['fin'] or time.time()) - (trabajo['inicio'] or trabajo['creado']),
+               'Resumen': trabajo['resumen'] or trabajo['error']
+           } for trabajo in terminados]), hide_index=True)
+
+
+           # Un resultado terminado de la sesión (p. ej. una clasificación anterior) se puede volver a adjuntar
+           completados = {
+               f"{trabajo['descripcion']} - {datetime.fromtimestamp(trabajo['creado']).strftime('%H:%M:%S')}": trabajo
+               for trabajo in terminados if trabajo['estado'] == 'Completado'
+           }
+           if completados:
+               col1, col2 = st.columns([3, 1])
+               with col1:
+                   seleccion = st.selectbox("Trabajo terminado:", list(completados), key="trabajo_a_adjuntar")
+               with col2:
+                   if st.button("📎 Usar resultado", key="adjuntar_trabajo"):
+                       trabajo = completados[seleccion]
+                       if self._adjuntar_resultado(trabajo['tipo'], trabajo['clave'], trabajo['resumen']):
+                           st.rerun()
+                       st.warning("⚠️ El resultado ya no está disponible en memoria; vuelva a ejecutar el trabajo")
+
+
+   def _load_dataframe(self, uploaded_file, columnas=None):
+       """Carga el DataFrame desde el archivo subido y normaliza las columnas; retorna (df, no convertidos por NIT)"""
        try:
            # Intentar leer CSV con diferentes codificaciones si falla UTF-8
+           no_convertidos_por_nit = None
            if uploaded_file.name.endswith('.csv'):
                try:
-                   df = pd.read_csv(uploaded_file, dtype={'nit': str}, encoding='utf-8')
+                   df = self._load_csv(uploaded_file, columnas, 'utf-8')
                except UnicodeDecodeError:
                    uploaded_file.seek(0)  # Resetear puntero del archivo
-                   df = pd.read_csv(uploaded_file, dtype={'nit': str}, encoding='latin1')
+                   df = self._load_csv(uploaded_file, columnas, 'latin1')
 
 
            else:
-               df = pd.read_excel(uploaded_file, dtype={'nit': str})
-
+               df, no_convertidos_por_nit = self._load_excel(uploaded_file, columnas)
 
-           # 1. Normalización de Nombres de Columnas
-           def normalize_column_name(col):
-               col_str = str(col).strip()
-               col_str = col_str.lower()
-               # Eliminar tildes (ejemplo básico)
-               col_str = col_str.replace('á', 'a').replace('é', 'e').replace('í', 'i').replace('ó', 'o').replace('ú',
-                                                                                                                 'u')
-               # Eliminar caracteres no alfanuméricos (excepto guiones bajos)
-               col_str = re.sub(r'[^a-z0-9_]', '', col_str)
-               return col_str
 
-
-           column_mapping = {
-               col: normalize_column_name(col)
-               for col in df.columns
-           }
-           df = df.rename(columns=column_mapping)
+           # 1. Normalización de Nombres de Columnas (variantes del esquema) y tipos
+           column_mapping = UploadSchema.mapear_encabezados(df.columns, columnas)
+           df, no_convertidos_tipos = UploadSchema.aplicar_tipos(
+               df[list(column_mapping)].rename(columns=column_mapping)
+           )
+           if no_convertidos_tipos is not None:
+               no_convertidos_por_nit = no_convertidos_tipos
 
 
-           # 2. Ajustar el tipo de dato de NIT
+           # 2. NIT canónico (una sola vez; todos los módulos reutilizan esta columna)
            if 'nit' in df.columns:
-               df['nit'] = df['nit'].astype(str).str.strip()
+               nits = REPSValidator.canonicalizar_nits(df['nit'])
+               df['nit'] = nits['nit']
+               nits_digito_invalido = nits.loc[nits['digito_valido'] == False, 'nit'].unique()
+               if len(nits_digito_invalido) > 0:
+                   st.warning(
+                       f"⚠️ {len(nits_digito_invalido):,} NITs con dígito de verificación inválido: "
+                       f"{', '.join(nits_digito_invalido[:10])}{'...' if len(nits_digito_invalido) > 10 else ''}"
+                   )
 
 
-           return df
+           return df, no_convertidos_por_nit
 
 
        except Exception as e:
@@ -693,6 +3092,43 @@ class FinancialAnalyzerApp:
            raise e
 
 
+   def _load_csv(self, uploaded_file, columnas, encoding):
+       """Lee un CSV con solo las columnas del módulo, mapeando los encabezados antes de leer los datos"""
+       encabezados = pd.read_csv(uploaded_file, nrows=0, encoding=encoding).columns
+       mapeo = UploadSchema.mapear_encabezados(encabezados, columnas)
+       uploaded_file.seek(0)
+       return pd.read_csv(
+           uploaded_file,
+           usecols=list(mapeo),
+           dtype=UploadSchema.tipos_lectura(mapeo),
+           encoding=encoding
+       )
+
+
+   def _huella_carga(self, uploaded_file):
+       """Huella del archivo cargado (contenido y hoja elegida) para reutilizar cálculos entre reruns"""
+       hash_contenido = hashlib.sha256(uploaded_file.getvalue())
+       hash_contenido.update(repr(st.session_state.get(f"hoja_excel_{uploaded_file.name}")).encode())
+       return hash_contenido.hexdigest()
+
+
+   def _load_excel(self, uploaded_file, columnas=None):
+       """Lee un libro Excel con el lector optimizado, permitiendo elegir la hoja; retorna (df, no convertidos)"""
+       contenido = uploaded_file.getvalue()
+       hojas = self.excel_reader.hojas(contenido)
+       hoja = None
+       if len(hojas) > 1:
+           hoja = st.selectbox(
+               "Hoja del libro:",
+               hojas,
+               key=f"hoja_excel_{uploaded_file.name}"
+           )
+
+
+       with st.spinner(f"Leyendo Excel ({self.excel_reader.motor})..."):
+           return self.excel_reader.leer(contenido, hoja, columnas)
+
+
    def _show_sidebar(self):
        """Muestra la barra lateral"""
        st.sidebar.title("🏥 Sistema de Riesgo EPS/IPS")
@@ -706,6 +3142,19 @@ class FinancialAnalyzerApp:
        )
 
 
+       estadisticas = self.almacen.estadisticas()
+       st.sidebar.caption(
+           f"🗄️ Resultados compartidos: {estadisticas['entradas']} "
+           f"({estadisticas['memoria_mb']:.1f} MB, {estadisticas['referencias']} sesiones)"
+       )
+       carga = self.planificador.estadisticas()
+       st.sidebar.caption(
+           f"⚙️ Clasificaciones en curso: {carga['en_ejecucion']}/{carga['max_concurrentes']}, "
+           f"en cola: {carga['en_cola']} (espera media {carga['espera_media_s']:.1f} s, "
+           f"p95 {carga['espera_p95_s']:.1f} s, máx {carga['espera_max_s']:.1f} s)"
+       )
+
+
        st.sidebar.markdown("---")
        st.sidebar.markdown("**Desarrollado para análisis de riesgo en entidades de salud**")
 
@@ -728,17 +3177,17 @@ class FinancialAnalyzerApp:
 
        if uploaded_file is not None:
            try:
-               df = self._load_dataframe(uploaded_file)
+               df, _ = self._load_dataframe(uploaded_file, self.COLUMNAS_VALIDACION)
                self._process_validation_file(df, uploaded_file.name)
            except Exception as e:
                st.error(f"❌ Error al procesar el archivo: {str(e)}")
-               st.session_state.df_validacion = None
-               st.session_state.info_entidades = None
+               self._asignar_resultado('validacion', None)
 
 
        # Mostrar resultados si existen, incluso después de un rerun
-       if 'df_validacion' in st.session_state and st.session_state.df_validacion is not None:
-           self._show_validation_results(st.session_state.df_validacion)
+       df_validacion = self._resultado('df_validacion')
+       if df_validacion is not None:
+           self._show_validation_results(df_validacion)
        st.markdown('</div>', unsafe_allow_html=True)
 
 
@@ -771,25 +3220,41 @@ class FinancialAnalyzerApp:
 
 
        if st.button("🔍 Validar en REPS", type="primary"):
-           with st.spinner("Validando entidades en REPS..."):
-               self._validate_entities(df)
+           self._validate_entities(df)
 
 
    def _validate_entities(self, df):
-       """Valida las entidades en el REPS"""
-       nits_unicos = df['nit'].dropna().unique()
+       """Encola la validación REPS en segundo plano (una sola vez por contenido, compartida entre sesiones)"""
        RAZON_SOCIAL = 'razonsocial'
+       columnas_validacion = [col for col in ['nit', RAZON_SOCIAL] if col in df.columns]
+       clave = self.almacen.clave_contenido('validacion', df[columnas_validacion])
+       sesion = self._id_sesion()
+
+
+       if self.almacen.obtener(clave, sesion) is not None:
+           self._adjuntar_resultado('validacion', clave)
+       else:
+           def trabajo(reportar):
+               resultado, _ = self.almacen.obtener_o_calcular(
+                   clave, sesion, lambda: self._calcular_validacion(df, reportar)
+               )
+               return f"Validación completada para {len(resultado['df_validacion'])} NITs"
+
+
+           self._enviar_trabajo('validacion', clave, f"Validación REPS ({df['nit'].nunique():,} NITs)", trabajo)
+       # st.rerun() para mostrar el avance (o los resultados) en el siguiente ciclo
+       st.rerun()
 
 
-       progress_bar = st.progress(0)
-       status_text = st.empty()
+   def _calcular_validacion(self, df, reportar):
+       """Consulta cada NIT en el REPS y arma el resultado de validación (corre en un hilo del ejecutor)"""
+       nits_unicos = df['nit'].dropna().unique()
+       RAZON_SOCIAL = 'razonsocial'
 
 
        resultados = []
        for i, nit in enumerate(nits_unicos):
-           progress = (i + 1) / len(nits_unicos)
-           progress_bar.progress(progress)
-           status_text.text(f"Validando NIT {i + 1}/{len(nits_unicos)}: {nit}")
+           reportar('Consulta REPS', i, len(nits_unicos))
 
 
            razon_social = ''
@@ -802,10 +3267,7 @@ class FinancialAnalyzerApp:
            resultado = self.reps_validator.validar_entidad(nit, razon_social)
            resultados.append(resultado)
            time.sleep(0.01)
-
-
-       progress_bar.empty()
-       status_text.empty()
+       reportar('Consulta REPS', len(nits_unicos), len(nits_unicos))
 
 
        df_resultados = pd.DataFrame(resultados)
@@ -822,8 +3284,7 @@ class FinancialAnalyzerApp:
        })
 
 
-       st.session_state.df_validacion = df_resultados
-       st.session_state.info_entidades = {
+       info_entidades = {
            row['nit']: {
                'nombre': row['Razón Social'],
                'tipo': row['Tipo Entidad'],
@@ -831,11 +3292,7 @@ class FinancialAnalyzerApp:
            }
            for _, row in df_resultados.iterrows()
        }
-
-
-       st.success(f"✅ Validación completada para {len(nits_unicos)} NITs")
-       # st.rerun() para mostrar los resultados en el siguiente ciclo
-       st.rerun()
+       return {'df_validacion': df_resultados, 'info_entidades': info_entidades}
 
 
    def _show_validation_results(self, df_validacion):
@@ -866,10 +3323,14 @@ class FinancialAnalyzerApp:
        st.dataframe(df_validacion, use_container_width=True)
 
 
-       fig = px.pie(
-           df_validacion,
-           names='Tipo Entidad',
-           title='Distribución de Tipos de Entidades'
+       fig = self._figura_cacheada(
+           ('validacion_tipos', st.session_state.get('version_validacion', 0)),
+           lambda: px.pie(
+               self.chart_data.conteos(df_validacion, 'Tipo Entidad'),
+               names='Tipo Entidad',
+               values='Conteo',
+               title='Distribución de Tipos de Entidades'
+           )
        )
        st.plotly_chart(fig, use_container_width=True)
 
@@ -888,7 +3349,7 @@ class FinancialAnalyzerApp:
        st.header("💰 Clasificación Financiera")
 
 
-       info_entidades = st.session_state.get('info_entidades', None)
+       info_entidades = self._resultado('info_entidades')
        if info_entidades:
            st.success("✅ Información de validación REPS disponible")
        else:
@@ -904,70 +3365,254 @@ class FinancialAnalyzerApp:
 
        if uploaded_file is not None:
            try:
-               df = self._load_dataframe(uploaded_file)
-               self._process_financial_file(df, uploaded_file.name)
+               df, no_convertidos_por_nit = self._load_dataframe(uploaded_file, self.COLUMNAS_FINANCIERAS)
+               self._process_financial_file(
+                   df, uploaded_file.name, no_convertidos_por_nit, self._huella_carga(uploaded_file)
+               )
            except Exception as e:
                # El error ya se muestra en _load_dataframe
                pass
 
 
-       # FIX FINAL CLAVE: Llamar a la visualización si existe data clasificada
-       if 'df_clasificado' in st.session_state and st.session_state.df_clasificado is not None:
-           self._show_classification_results()
-       st.markdown('</div>', unsafe_allow_html=True)
+       # FIX FINAL CLAVE: Llamar a la visualización si existe data clasificada
+       if self._resultado('df_clasificado') is not None:
+           self._show_classification_results()
+       st.markdown('</div>', unsafe_allow_html=True)
+
+
+   def _process_financial_file(self, df, filename, no_convertidos_por_nit=None, huella_carga=None):
+       """Procesa el archivo financiero"""
+       st.success(f"✅ Archivo cargado: {filename}")
+
+
+       # Usar nombres de columnas normalizados y verificar su existencia
+       columnas_requeridas = ['nit', 'codigoconcepto', 'valor', 'denominacion']
+       columnas_faltantes = [col for col in columnas_requeridas if col not in df.columns]
+
+
+       if columnas_faltantes:
+           st.error(f"❌ Faltan columnas requeridas o los nombres son incorrectos: {columnas_faltantes}")
+           st.info(f"💡 Columnas encontradas: {df.columns.tolist()}")
+           return
+
+
+       with st.expander("📋 Vista previa de datos"):
+           st.dataframe(df.head(10))
+
+
+       if no_convertidos_por_nit is not None and len(no_convertidos_por_nit) > 0:
+           st.warning(
+               f"⚠️ {int(no_convertidos_por_nit.sum()):,} valores de {len(no_convertidos_por_nit):,} NITs no se "
+               f"pudieron convertir a número y no se incluirán en los totales"
+           )
+           with st.expander("🔎 Valores no numéricos por NIT"):
+               st.dataframe(
+                   no_convertidos_por_nit.rename('Valores no convertidos').rename_axis('NIT').reset_index()
+               )
+
+
+       # Pre-escaneo de calidad: los archivos malos se detienen antes de la clasificación completa
+       motivos_rechazo = self._show_quality_prescan(df, no_convertidos_por_nit, huella_carga)
+       if motivos_rechazo:
+           st.error("🚫 El archivo no pasó el pre-escaneo de calidad:\n\n" + '\n'.join(
+               f"- {motivo}" for motivo in motivos_rechazo
+           ))
+           if not st.checkbox("Clasificar de todas formas", key="ignorar_preescaneo"):
+               return
+
+
+       modo_incremental = st.checkbox(
+           "⚡ Modo incremental (reclasificar solo los NITs modificados)",
+           value=st.session_state.get('clave_clasificacion') is not None,
+           disabled=st.session_state.get('clave_clasificacion') is None,
+           key="modo_incremental_clasificacion"
+       )
+
+
+       # Solo mostrar el botón si no hay data clasificada O la data cargada es diferente
+       if st.button("🎯 Clasificar Datos Financieros", type="primary"):
+           self._process_financial_data(df, incremental=modo_incremental)
+           st.rerun()
+
+
+   def _show_quality_prescan(self, df, no_convertidos_por_nit=None, huella_carga=None):
+       """Muestra el pre-escaneo de calidad (en caché por archivo cargado); retorna los motivos de rechazo"""
+       cache = st.session_state.get('cache_preescaneo')
+       if huella_carga is None or cache is None or cache['huella'] != huella_carga:
+           inicio = time.perf_counter()
+           reporte = self.quality_scanner.escanear(df, no_convertidos_por_nit)
+           cache = {'huella': huella_carga, 'reporte': reporte, 'segundos': time.perf_counter() - inicio}
+           st.session_state.cache_preescaneo = cache
+       reporte, segundos = cache['reporte'], cache['segundos']
+
+
+       with st.expander("🔬 Pre-escaneo de calidad", expanded=bool(reporte['motivos_rechazo'])):
+           if reporte['muestreado']:
+               st.caption(
+                   f"Estimado sobre una muestra de {reporte['filas_analizadas']:,} de {reporte['filas']:,} filas "
+                   f"({segundos:.1f} s)"
+               )
+           else:
+               st.caption(f"Calculado sobre las {reporte['filas']:,} filas ({segundos:.1f} s)")
+
+
+           col1, col2, col3, col4 = st.columns(4)
+           col1.metric("No clasificada (estimado)", f"{reporte['pct_no_clasificada']:.1%}")
+           col2.metric("Valores no numéricos", f"{reporte['valores_no_numericos']:,}")
+           col3.metric("Filas duplicadas", f"{reporte['filas_duplicadas']:,}")
+           col4.metric("NITs sin razón social", f"{reporte['nits_sin_razon_social']:,}")
+
+
+           st.write("**Nulos por columna:**")
+           st.dataframe(
+               reporte['nulos'].rename('Nulos').rename_axis('Columna').reset_index(),
+               hide_index=True,
+               column_config={'Nulos': st.column_config.NumberColumn(format="percent")}
+           )
+
+
+           st.write("**Cobertura de clasificación por prefijo de código:**")
+           formato_porcentaje = st.column_config.NumberColumn(format="percent")
+           st.dataframe(
+               reporte['cobertura_por_prefijo'].rename_axis('Prefijo').reset_index(),
+               hide_index=True,
+               column_config={
+                   'filas': st.column_config.NumberColumn("Filas"),
+                   'pct_por_codigo': formato_porcentaje,
+                   'pct_por_denominacion': formato_porcentaje,
+                   'pct_no_clasificada': formato_porcentaje
+               }
+           )
+
+
+           if reporte['nits_sin_razon_social']:
+               nits = reporte['muestra_nits_sin_razon_social']
+               st.write(
+                   f"**NITs sin razón social:** {', '.join(map(str, nits))}"
+                   f"{'...' if reporte['nits_sin_razon_social'] > len(nits) else ''}"
+               )
+       return reporte['motivos_rechazo']
+
+
+   def _process_financial_data(self, df, incremental=False):
+       """Encola la clasificación de los datos financieros como trabajo en segundo plano"""
+       info_entidades = self._resultado('info_entidades')
+       clave = self.almacen.clave_contenido(
+           'clasificacion', df, self.data_processor._firma_info_entidades(info_entidades)
+       )
+       sesion = self._id_sesion()
+
+
+       # Resultado ya calculado (por esta u otra sesión): se adjunta sin encolar nada
+       resultado = self.almacen.obtener(clave, sesion)
+       if resultado is not None:
+           total_nits = len(resultado['snapshot_clasificacion']['huellas'])
+           self._adjuntar_resultado('clasificacion', clave, (
+               f"Resultado reutilizado del almacén compartido ({total_nits:,} NITs ya clasificados)"
+           ))
+           return
+
+
+       # El estado de la sesión se lee aquí: el hilo del trabajo no tiene acceso a st.session_state
+       snapshot_anterior = self._resultado('snapshot_clasificacion') if incremental else None
+       riesgos_anteriores = self._resultado('riesgos_por_nit') if incremental else None
+       # Admisión en el planificador del servidor según la memoria estimada del archivo cargado
+       bytes_estimados = self.planificador.estimar_bytes(df)
+       id_turno = uuid.uuid4().hex
 
 
-   def _process_financial_file(self, df, filename):
-       """Procesa el archivo financiero"""
-       st.success(f"✅ Archivo cargado: {filename}")
+       def trabajo(reportar):
+           estadisticas = {}
 
 
-       # Usar nombres de columnas normalizados y verificar su existencia
-       columnas_requeridas = ['nit', 'codigoconcepto', 'valor', 'denominacion']
-       columnas_faltantes = [col for col in columnas_requeridas if col not in df.columns]
+           def clasificar():
+               reportar('Clasificación e indicadores', 0, len(df))
+               snapshot, nits_cambiados, nits_eliminados = self.data_processor.procesar_incremental(
+                   df, snapshot_anterior, info_entidades
+               )
+               indicadores_por_nit = snapshot['indicadores_por_nit']
+               # La misma matriz de los indicadores se publica aparte; el snapshot no la conserva
+               matriz_cuentas = snapshot.pop('matriz_cuentas')
+               if matriz_cuentas is None:
+                   matriz_cuentas = AccountMatrix(snapshot['df_clasificado'])
+               reportar('Clasificación e indicadores', len(df), len(df))
+
+
+               # Parchear una copia de la tabla de riesgo solo para los NITs afectados
+               if snapshot_anterior is None or riesgos_anteriores is None:
+                   riesgos_por_nit = {}
+                   nits_a_evaluar = list(indicadores_por_nit.keys())
+               else:
+                   riesgos_por_nit = dict(riesgos_anteriores)
+                   for nit in nits_cambiados | nits_eliminados:
+                       riesgos_por_nit.pop(nit, None)
+                   nits_a_evaluar = [nit for nit in nits_cambiados if nit in indicadores_por_nit]
+               reportar('Evaluación de riesgo', 0, len(nits_a_evaluar))
+               df_indicadores = self.data_processor.indicadores_a_dataframe(indicadores_por_nit)
+               riesgos_por_nit.update(
+                   self._evaluar_riesgos(df_indicadores, nits_a_evaluar).to_dict(orient='index')
+               )
+               reportar('Evaluación de riesgo', len(nits_a_evaluar), len(nits_a_evaluar))
 
 
-       if columnas_faltantes:
-           st.error(f"❌ Faltan columnas requeridas o los nombres son incorrectos: {columnas_faltantes}")
-           st.info(f"💡 Columnas encontradas: {df.columns.tolist()}")
-           return
+               reportar('Ranking de pares', 0, len(indicadores_por_nit))
+               ranking_pares = (
+                   self.data_processor.calcular_ranking_pares(df_indicadores) if indicadores_por_nit else None
+               )
+               reportar('Ranking de pares', len(indicadores_por_nit), len(indicadores_por_nit))
 
 
-       with st.expander("📋 Vista previa de datos"):
-           st.dataframe(df.head(10))
+               estadisticas.update(cambiados=len(nits_cambiados), eliminados=len(nits_eliminados))
+               return {
+                   'snapshot_clasificacion': snapshot,
+                   'riesgos_por_nit': riesgos_por_nit,
+                   'ranking_pares': ranking_pares,
+                   # Base de los indicadores personalizados (fórmulas sobre totales por categoría)
+                   'matriz_cuentas': matriz_cuentas
+               }
 
 
-       # Solo mostrar el botón si no hay data clasificada O la data cargada es diferente
-       if st.button("🎯 Clasificar Datos Financieros", type="primary"):
-           with st.spinner("Clasificando datos financieros..."):
-               self._process_financial_data(df)
-               # FIX: Se establece una bandera y se recarga la página
-               st.session_state.data_just_classified = True
-               st.rerun()
+           def clasificar_con_turno():
+               # Las clasificaciones de todas las sesiones comparten el cupo del servidor
+               reportar('Espera de turno', 0, None)
+               with self.planificador.turno(id_turno, bytes_estimados):
+                   return clasificar()
 
 
-   def _process_financial_data(self, df):
-       """Procesa los datos financieros"""
-       info_entidades = st.session_state.get('info_entidades', None)
-       df_clasificado = self.data_processor.procesar_dataframe(df, info_entidades)
-       indicadores_por_nit = self.data_processor.calcular_indicadores_por_nit(df_clasificado, info_entidades)
+           resultado, reutilizado = self.almacen.obtener_o_calcular(clave, sesion, clasificar_con_turno)
+           indicadores_por_nit = resultado['snapshot_clasificacion']['indicadores_por_nit']
+           # La tabla de indicadores queda en disco: sobrevive a reinicios del servidor
+           if not os.path.exists(self.indicator_store.ruta_tabla(clave)):
+               reportar('Tabla de indicadores en disco', 0, len(indicadores_por_nit))
+               self.indicator_store.guardar(clave, indicadores_por_nit)
+               reportar('Tabla de indicadores en disco', len(indicadores_por_nit), len(indicadores_por_nit))
 
 
-       st.session_state.df_clasificado = df_clasificado
-       st.session_state.indicadores_por_nit = indicadores_por_nit
+           total_nits = len(resultado['snapshot_clasificacion']['huellas'])
+           if reutilizado:
+               return f"Resultado reutilizado del almacén compartido ({total_nits:,} NITs ya clasificados)"
+           return (
+               f"NITs reclasificados: {estadisticas['cambiados']:,} de {total_nits:,} "
+               f"(eliminados: {estadisticas['eliminados']:,})"
+           )
 
 
-       st.success("✅ Clasificación completada! Preparando resultados...")
+       self._enviar_trabajo('clasificacion', clave, f"Clasificación ({len(df):,} filas)", trabajo, id_turno)
 
 
    def _show_classification_results(self):
        """Muestra los resultados de la clasificación"""
-       if 'df_clasificado' not in st.session_state or st.session_state.df_clasificado is None:
+       df_clasificado = self._resultado('df_clasificado')
+       if df_clasificado is None:
            st.warning("⚠️ Primero debes procesar los datos financieros")
            return
 
 
-       df_clasificado = st.session_state.df_clasificado
+       if st.session_state.get('resumen_clasificacion'):
+           st.info(f"⚡ {st.session_state.resumen_clasificacion}")
+
+
+       self._show_period_history(df_clasificado)
 
 
        # FIX: Reinicio de filtros si se acaba de clasificar data
@@ -1005,7 +3650,7 @@ class FinancialAnalyzerApp:
 
        # --- FILTRO 1: TIPO DE ENTIDAD ---
        with col1:
-           tipos_entidad = ['TODOS'] + sorted(df_clasificado['tipo_entidad'].unique().tolist())
+           tipos_entidad = ['TODOS'] + sorted(df_clasificado['tipo_entidad'].dropna().unique().tolist())
            initial_index_tipo = tipos_entidad.index(current_tipo) if current_tipo in tipos_entidad else 0
 
 
@@ -1019,7 +3664,7 @@ class FinancialAnalyzerApp:
 
        # --- FILTRO 2: CATEGORÍA PRINCIPAL ---
        with col2:
-           categorias = ['TODAS'] + sorted(df_clasificado['categoria_principal'].unique().tolist())
+           categorias = ['TODAS'] + sorted(df_clasificado['categoria_principal'].dropna().unique().tolist())
            initial_index_categoria = categorias.index(current_categoria) if current_categoria in categorias else 0
 
 
@@ -1033,7 +3678,7 @@ class FinancialAnalyzerApp:
 
        # --- FILTRO 3: NIT ---
        with col3:
-           nits = ['TODOS'] + sorted(df_clasificado['nit'].unique().tolist())
+           nits = ['TODOS'] + sorted(df_clasificado['nit'].dropna().unique().tolist())
            initial_index_nit = nits.index(current_nit) if current_nit in nits else 0
 
 
@@ -1046,24 +3691,17 @@ class FinancialAnalyzerApp:
 
 
        # 2. APLICAR FILTROS (Usando directamente los valores de la sesión actualizados)
-       df_filtrado = df_clasificado.copy()
-
-
        tipo_filtro = st.session_state.filtros_clasificacion['tipo']
        categoria_filtro = st.session_state.filtros_clasificacion['categoria']
        nit_filtro = st.session_state.filtros_clasificacion['nit']
 
 
-       if tipo_filtro != 'TODOS':
-           df_filtrado = df_filtrado[df_filtrado['tipo_entidad'] == tipo_filtro]
-
-
-       if categoria_filtro != 'TODAS':
-           df_filtrado = df_filtrado[df_filtrado['categoria_principal'] == categoria_filtro]
-
-
-       if nit_filtro != 'TODOS':
-           df_filtrado = df_filtrado[df_filtrado['nit'] == nit_filtro]
+       # Vista por posiciones de fila: no se copia ni se modifica el DataFrame compartido
+       df_filtrado = FilteredView.desde_filtros(df_clasificado, {
+           'tipo_entidad': tipo_filtro if tipo_filtro != 'TODOS' else None,
+           'categoria_principal': categoria_filtro if categoria_filtro != 'TODAS' else None,
+           'nit': nit_filtro if nit_filtro != 'TODOS' else None
+       })
 
 
        # Mostrar información del filtro
@@ -1083,10 +3721,6 @@ class FinancialAnalyzerApp:
        st.markdown('</div>', unsafe_allow_html=True)
 
 
-       # GUARDAR DATOS FILTRADOS EN SESSION STATE
-       st.session_state.df_filtrado_clasificacion = df_filtrado
-
-
        # TABS QUE USAN LOS DATOS FILTRADOS
        tab1, tab2, tab3 = st.tabs(["📋 Datos Clasificados", "📊 Resumen por Categoría", "📈 Análisis Gráfico"])
        with tab1:
@@ -1094,12 +3728,51 @@ class FinancialAnalyzerApp:
        with tab2:
            self._show_category_summary(df_filtrado)
        with tab3:
-           if 'indicadores_por_nit' in st.session_state:
+           if self._resultado('indicadores_por_nit') is not None:
                self._show_graphical_analysis(df_filtrado)
            else:
                st.warning("⚠️ No hay indicadores para el análisis gráfico. Ejecute la clasificación de datos primero.")
 
 
+   def _show_period_history(self, df_clasificado):
+       """Permite guardar la clasificación actual como un periodo del histórico"""
+       with st.expander("📅 Histórico por periodos"):
+           periodos = self.period_store.periodos_disponibles()
+           if periodos:
+               st.write(f"**Periodos guardados:** {', '.join(periodos)}")
+           else:
+               st.info("ℹ️ Aún no hay periodos guardados.")
+
+
+           col1, col2 = st.columns([2, 1])
+           with col1:
+               periodo = st.text_input(
+                   "Periodo de los datos clasificados (ej. 2024Q1):",
+                   value=st.session_state.get('periodo_actual') or '',
+                   key="periodo_clasificacion"
+               )
+           with col2:
+               guardar = st.button("💾 Guardar periodo", key="guardar_periodo")
+
+
+           if guardar:
+               try:
+                   periodo = self.period_store.guardar_periodo(df_clasificado, periodo)
+               except ValueError as e:
+                   st.error(f"❌ {str(e)}")
+                   return
+
+
+               st.session_state.periodo_actual = periodo
+               st.session_state.tendencias_por_nit = self.period_store.tendencias_periodo(periodo)
+               # Recalcular el riesgo incorporando las tendencias
+               st.session_state.version_datos = st.session_state.get('version_datos', 0) + 1
+               st.success(
+                   f"✅ Periodo {periodo} guardado. "
+                   f"{len(st.session_state.tendencias_por_nit):,} entidades con periodo anterior para comparar."
+               )
+
+
    def _show_classified_data(self, df_filtrado):
        """Muestra los datos clasificados filtrados"""
        st.subheader("Datos Clasificados Filtrados")
@@ -1117,7 +3790,7 @@ class FinancialAnalyzerApp:
 
 
            # Renombrar para visualización (solo si las columnas existen)
-           df_display = df_filtrado[columnas_disponibles].rename(columns={
+           df_display = df_filtrado.tabla(columnas_disponibles).rename(columns={
                RAZON_SOCIAL: 'Razón Social',
                CODIGO_CONCEPTO: 'Código Concepto',
                DENOMINACION: 'Denominación'
@@ -1128,14 +3801,25 @@ class FinancialAnalyzerApp:
            st.dataframe(df_display, use_container_width=True)
 
 
-           # Botón de descarga
-           csv = df_filtrado[columnas_disponibles].to_csv(index=False)
+           # Botón de descarga (el CSV se genera solo al hacer clic)
            st.download_button(
                "📥 Descargar datos clasificados filtrados",
-               data=csv,
+               data=lambda: df_filtrado.tabla(columnas_disponibles).to_csv(index=False),
                file_name="datos_clasificados_filtrados.csv",
                type="primary"
            )
+
+
+
+           # Tabla de consulta para auditoría: cómo se clasificó cada código de todo el archivo cargado
+           df_base = df_filtrado.df_base
+           st.download_button(
+               "📥 Descargar tabla de clasificación de códigos (auditoría)",
+               data=lambda: self.data_processor.classifier.tabla_auditoria(
+                   df_base[CODIGO_CONCEPTO], df_base.get(DENOMINACION)
+               ).to_csv(index=False),
+               file_name="tabla_clasificacion_codigos.csv"
+           )
        else:
            st.warning("🚫 No hay datos que coincidan con los filtros aplicados")
            st.info("💡 Prueba con diferentes combinaciones de filtros")
@@ -1149,18 +3833,17 @@ class FinancialAnalyzerApp:
            return
 
 
-       # Asegurar que tenemos la columna valor_numerico
-       if 'valor_numerico' not in df_filtrado.columns:
-           df_filtrado['valor_numerico'] = pd.to_numeric(df_filtrado['valor'], errors='coerce')
+       # 'valor' ya es float64: se agrega directamente sobre las columnas necesarias
+       df_resumen = df_filtrado.tabla(['categoria_principal', 'tipo_entidad', 'nit', 'valor'])
 
 
        # Resumen por categoría y tipo de entidad
-       resumen = df_filtrado.groupby(['categoria_principal', 'tipo_entidad']).agg({
-           'valor_numerico': 'sum',
+       resumen = df_resumen.groupby(['categoria_principal', 'tipo_entidad']).agg({
+           'valor': 'sum',
            'nit': 'nunique'
        }).reset_index()
        resumen = resumen.rename(columns={
-           'valor_numerico': 'Valor Total',
+           'valor': 'Valor Total',
            'nit': 'Número de Entidades'
        })
 
@@ -1169,41 +3852,51 @@ class FinancialAnalyzerApp:
        st.dataframe(resumen, use_container_width=True)
 
 
-       # Gráficos
+       # Gráficos (en caché por estado de filtros y versión de datos)
+       estado_filtros = tuple(sorted(st.session_state.get('filtros_clasificacion', {}).items()))
        if len(resumen) > 0:
            col1, col2 = st.columns(2)
            with col1:
                # Gráfico de barras
-               fig = px.bar(
-                   resumen,
+               fig = self._figura_cacheada(('resumen_valor_barras', estado_filtros), lambda: px.bar(
+                   self.chart_data.top_categorias(
+                       resumen[['categoria_principal', 'tipo_entidad', 'Valor Total']],
+                       'categoria_principal', 'Valor Total'
+                   ),
                    x='categoria_principal',
                    y='Valor Total',
                    color='tipo_entidad',
                    title="Valor por Categoría y Tipo de Entidad",
                    barmode='group',
                    labels={'categoria_principal': 'Categoría', 'Valor Total': 'Valor Total'}
-               )
+               ))
                st.plotly_chart(fig, use_container_width=True)
            with col2:
                # Gráfico de torta por categoría
-               fig_pie = px.pie(
-                   resumen,
+               fig_pie = self._figura_cacheada(('resumen_valor_torta', estado_filtros), lambda: px.pie(
+                   self.chart_data.top_categorias(
+                       resumen.groupby('categoria_principal', as_index=False)['Valor Total'].sum(),
+                       'categoria_principal', 'Valor Total'
+                   ),
                    values='Valor Total',
                    names='categoria_principal',
                    title='Distribución de Valor por Categoría'
-               )
+               ))
                st.plotly_chart(fig_pie, use_container_width=True)
 
 
            # Gráfico adicional - número de entidades por categoría
-           fig_entidades = px.bar(
-               resumen,
+           fig_entidades = self._figura_cacheada(('resumen_entidades_barras', estado_filtros), lambda: px.bar(
+               self.chart_data.top_categorias(
+                   resumen[['categoria_principal', 'tipo_entidad', 'Número de Entidades']],
+                   'categoria_principal', 'Número de Entidades'
+               ),
                x='categoria_principal',
                y='Número de Entidades',
                color='tipo_entidad',
                title="Número de Entidades por Categoría",
                barmode='group'
-           )
+           ))
            st.plotly_chart(fig_entidades, use_container_width=True)
 
 
@@ -1215,15 +3908,13 @@ class FinancialAnalyzerApp:
            return
 
 
-       if 'indicadores_por_nit' not in st.session_state:
+       indicadores_por_nit = self._resultado('indicadores_por_nit')
+       if indicadores_por_nit is None:
            st.warning("No hay indicadores financieros calculados")
            return
 
 
-       indicadores_por_nit = st.session_state.indicadores_por_nit
-
-
-       nits_filtrados = df_filtrado['nit'].unique()
+       nits_filtrados = df_filtrado.nits_unicos()
        indicadores_filtrados = {nit: indicadores_por_nit[nit] for nit in nits_filtrados if nit in indicadores_por_nit}
 
 
@@ -1235,50 +3926,130 @@ class FinancialAnalyzerApp:
        st.success(f"✅ {len(indicadores_filtrados)} entidades con indicadores disponibles")
 
 
-       entidades_opciones = []
-       for nit, indicadores in indicadores_filtrados.items():
-           razon_social = indicadores.get('razon_social', 'Sin razón social')
-           tipo_entidad = indicadores.get('tipo_entidad', 'NO VALIDADO')
-           display_text = f"{nit} - {razon_social} ({tipo_entidad})"
-           entidades_opciones.append((nit, display_text, razon_social, tipo_entidad))
-
-
-       if not entidades_opciones:
-           st.info("No hay entidades disponibles para análisis")
-           return
+       indice_busqueda = self._obtener_indice_busqueda()
+       nits_candidatos = indicadores_filtrados.keys()
 
 
        col1, col2 = st.columns([2, 1])
        with col1:
+           consulta = st.text_input(
+               "Buscar entidad (NIT o razón social):",
+               key="buscar_entidad_analisis_filtrado"
+           )
+           nits_encontrados = indice_busqueda.buscar(consulta, nits_candidatos, self.MAX_OPCIONES_BUSQUEDA)
+           if not nits_encontrados:
+               st.info("No hay entidades que coincidan con la búsqueda")
+               return
+
+
            entidad_principal = st.selectbox(
                "Seleccionar entidad para análisis detallado:",
-               options=[opt[1] for opt in entidades_opciones],
+               options=[indice_busqueda.display_por_nit[nit] for nit in nits_encontrados],
                key="selector_entidad_analisis_filtrado"
            )
+       nit_principal = indice_busqueda.resolver(entidad_principal)
+
+
        with col2:
-           opciones_comparacion = [opt[1] for opt in entidades_opciones if opt[1] != entidad_principal]
+           consulta_comparacion = st.text_input(
+               "Buscar entidades para comparar:",
+               key="buscar_comparacion_filtrado"
+           )
+           # Mantener en las opciones lo ya seleccionado aunque no coincida con la búsqueda
+           seleccion_actual = [
+               display for display in st.session_state.get('selector_comparacion_filtrado', [])
+               if indice_busqueda.resolver(display) in nits_candidatos
+               and indice_busqueda.resolver(display) != nit_principal
+           ]
+           nits_comparables = [
+               nit for nit in indice_busqueda.buscar(consulta_comparacion, nits_candidatos,
+                                                     self.MAX_OPCIONES_BUSQUEDA + 1)
+               if nit != nit_principal
+           ][:self.MAX_OPCIONES_BUSQUEDA]
+           opciones_comparacion = seleccion_actual + [
+               indice_busqueda.display_por_nit[nit] for nit in nits_comparables
+               if indice_busqueda.display_por_nit[nit] not in seleccion_actual
+           ]
+           if 'selector_comparacion_filtrado' in st.session_state:
+               st.session_state.selector_comparacion_filtrado = seleccion_actual
            entidades_comparacion = st.multiselect(
                "Seleccionar para comparar:",
                options=opciones_comparacion,
-               default=opciones_comparacion[:min(2, len(opciones_comparacion))] if opciones_comparacion else [],
+               # Sin default si la selección ya viene del estado (ej. "Comparar con similares")
+               default=(opciones_comparacion[:min(2, len(opciones_comparacion))]
+                        if 'selector_comparacion_filtrado' not in st.session_state else None),
                key="selector_comparacion_filtrado"
            )
 
 
-       nit_principal = None
-       for nit, display_text, razon_social, tipo_entidad in entidades_opciones:
-           if display_text == entidad_principal:
-               nit_principal = nit
-               break
-
-
        if nit_principal:
+           self._show_similar_entities(nit_principal, indice_busqueda, nits_candidatos)
            self._show_individual_analysis(indicadores_filtrados, nit_principal)
 
 
            if entidades_comparacion:
-               self._show_comparative_analysis(indicadores_filtrados, nit_principal, entidades_comparacion,
-                                               entidades_opciones)
+               nits_comparacion = [indice_busqueda.resolver(display) for display in entidades_comparacion]
+               self._show_comparative_analysis(indicadores_filtrados, nit_principal, nits_comparacion)
+
+
+   def _obtener_indice_busqueda(self):
+       """Obtiene el índice de búsqueda de entidades, reconstruido solo si cambian los indicadores"""
+       version = st.session_state.get('version_datos', 0)
+       cache = st.session_state.get('cache_indice_busqueda')
+       if cache is not None and cache['version'] == version:
+           return cache['indice']
+
+
+       indice = EntitySearchIndex(self._resultado('indicadores_por_nit') or {})
+       st.session_state.cache_indice_busqueda = {'version': version, 'indice': indice}
+       return indice
+
+
+   def _obtener_indice_similitud(self):
+       """Obtiene el índice de similitud; solo se reconstruye si cambia la tabla de indicadores"""
+       # Clave de la tabla (contenido clasificado): guardar un periodo no invalida el índice
+       clave = st.session_state.get('clave_clasificacion')
+       cache = st.session_state.get('cache_indice_similitud')
+       if cache is not None and cache['clave'] == clave:
+           return cache['indice']
+
+
+       df_indicadores = self._tabla_indicadores(clave)
+       indice = None
+       if df_indicadores is not None and len(df_indicadores) > 1:
+           indice = SimilarityIndex(df_indicadores)
+       st.session_state.cache_indice_similitud = {'clave': clave, 'indice': indice}
+       return indice
+
+
+   def _show_similar_entities(self, nit_principal, indice_busqueda, nits_candidatos, k=5):
+       """Sugiere las entidades más similares a la seleccionada para compararlas"""
+       indice = self._obtener_indice_similitud()
+       if indice is None or nit_principal not in indice.posiciones:
+           return
+
+
+       display_por_nit = indice_busqueda.display_por_nit
+       similares = indice.similares(nit_principal, k=k, candidatos=nits_candidatos)
+       if not similares:
+           return
+
+
+       def usar_similares():
+           st.session_state.selector_comparacion_filtrado = [display_por_nit[nit] for nit, _ in similares]
+
+
+       with st.expander(f"🔎 {len(similares)} entidades más similares"):
+           st.dataframe(
+               pd.DataFrame({
+                   'Entidad': [display_por_nit[nit] for nit, _ in similares],
+                   'Distancia': [distancia for _, distancia in similares]
+               }),
+               use_container_width=True,
+               hide_index=True,
+               column_config={'Distancia': st.column_config.NumberColumn(format="%.3f")}
+           )
+           st.button("🔄 Comparar con similares", on_click=usar_similares, key="comparar_similares")
 
 
    def _show_individual_analysis(self, indicadores_por_nit, nit_principal):
@@ -1304,21 +4075,72 @@ class FinancialAnalyzerApp:
            st.metric("ROE", f"{roe:.2%}")
 
 
+       self._show_peer_ranking(nit_principal)
+
+
        # Gráficos
-       tab1, tab2, tab3 = st.tabs(["📈 Liquidez", "💰 Endeudamiento", "📊 Rentabilidad"])
+       tab1, tab2, tab3, tab4 = st.tabs(["📈 Liquidez", "💰 Endeudamiento", "📊 Rentabilidad", "📅 Tendencia"])
        with tab1:
-           self._create_liquidity_charts(indicadores)
+           self._create_liquidity_charts(indicadores, nit_principal)
        with tab2:
-           self._create_leverage_charts(indicadores)
+           self._create_leverage_charts(indicadores, nit_principal)
        with tab3:
-           self._create_profitability_charts(indicadores)
+           self._create_profitability_charts(indicadores, nit_principal)
+       with tab4:
+           self._create_trend_charts(nit_principal)
+
+
+   def _show_peer_ranking(self, nit):
+       """Muestra la posición de la entidad frente a su grupo de pares"""
+       ranking_pares = self._resultado('ranking_pares')
+       if ranking_pares is None or nit not in ranking_pares.index:
+           return
+
+
+       ranking = ranking_pares.loc[nit]
+       nombres = {
+           'razon_corriente': 'Razón Corriente',
+           'prueba_acida': 'Prueba Ácida',
+           'razon_endeudamiento': 'Endeudamiento',
+           'leverage_financiero': 'Leverage',
+           'roa': 'ROA',
+           'roe': 'ROE',
+           'margen_neto': 'Margen Neto'
+       }
+
+
+       with st.expander(f"👥 Ranking frente a pares: {ranking['grupo_pares']} ({ranking['n_pares']} entidades)"):
+           df_ranking = pd.DataFrame({
+               'Indicador': list(nombres.values()),
+               'Percentil en el grupo': [ranking[f'pct_{ratio}'] for ratio in nombres],
+               'Z-score': ['N/D' if pd.isna(ranking[f'z_{ratio}']) else f"{ranking[f'z_{ratio}']:.2f}"
+                           for ratio in nombres]
+           })
+           st.dataframe(
+               df_ranking,
+               use_container_width=True,
+               hide_index=True,
+               column_config={
+                   'Percentil en el grupo': st.column_config.ProgressColumn(
+                       format="percent", min_value=0.0, max_value=1.0
+                   )
+               }
+           )
+
 
+   def _figura_cacheada(self, clave, construir):
+       """Obtiene una figura del caché LRU de la sesión o la construye"""
+       cache = st.session_state.get('cache_figuras')
+       if cache is None:
+           cache = FigureCache()
+           st.session_state.cache_figuras = cache
+       return cache.obtener(clave + (st.session_state.get('version_datos', 0),), construir)
 
-   def _create_liquidity_charts(self, indicadores):
+
+   def _create_liquidity_charts(self, indicadores, nit):
        """Crea gráficos de liquidez"""
-       col1, col2 = st.columns(2)
-       with col1:
-           fig_gauge = go.Figure(go.Indicator(
+       def crear_gauge():
+           return go.Figure(go.Indicator(
                mode="gauge+number",
                value=indicadores.get('razon_corriente', 0),
                title={'text': "Razón Corriente"},
@@ -1332,52 +4154,67 @@ class FinancialAnalyzerApp:
                        {'range': [1.5, 3], 'color': "green"}]
                }
            ))
-           st.plotly_chart(fig_gauge, use_container_width=True)
-       with col2:
+
+
+       def crear_barras():
            liquidez_metrics = {
                'Razón Corriente': indicadores.get('razon_corriente', 0),
                'Prueba Ácida': indicadores.get('prueba_acida', 0)
            }
-           fig_bar = px.bar(
+           return px.bar(
                x=list(liquidez_metrics.keys()),
                y=list(liquidez_metrics.values()),
                title="Indicadores de Liquidez",
                labels={'x': 'Indicador', 'y': 'Valor'}
            )
-           st.plotly_chart(fig_bar, use_container_width=True)
 
 
-   def _create_leverage_charts(self, indicadores):
-       """Crea gráficos de endeudamiento"""
        col1, col2 = st.columns(2)
        with col1:
-           patrimonio = indicadores.get('patrimonio', 0)
-           pasivo_total = indicadores.get('pasivo_total', 0)
-           total = patrimonio + pasivo_total
-           if total > 0:
-               fig_pie = px.pie(
-                   values=[patrimonio, pasivo_total],
-                   names=['Patrimonio', 'Pasivo Total'],
-                   title='Estructura de Capital'
-               )
-               st.plotly_chart(fig_pie, use_container_width=True)
+           st.plotly_chart(self._figura_cacheada(('liquidez_gauge', nit), crear_gauge), use_container_width=True)
        with col2:
+           st.plotly_chart(self._figura_cacheada(('liquidez_barras', nit), crear_barras), use_container_width=True)
+
+
+   def _create_leverage_charts(self, indicadores, nit):
+       """Crea gráficos de endeudamiento"""
+       patrimonio = indicadores.get('patrimonio', 0)
+       pasivo_total = indicadores.get('pasivo_total', 0)
+
+
+       def crear_torta():
+           return px.pie(
+               values=[patrimonio, pasivo_total],
+               names=['Patrimonio', 'Pasivo Total'],
+               title='Estructura de Capital'
+           )
+
+
+       def crear_barras():
            leverage_metrics = {
                'Endeudamiento': indicadores.get('razon_endeudamiento', 0),
                'Leverage': indicadores.get('leverage_financiero', 0)
            }
-           fig_bar = px.bar(
+           return px.bar(
                x=list(leverage_metrics.keys()),
                y=list(leverage_metrics.values()),
                title="Indicadores de Endeudamiento"
            )
-           st.plotly_chart(fig_bar, use_container_width=True)
 
 
-   def _create_profitability_charts(self, indicadores):
-       """Crea gráficos de rentabilidad"""
        col1, col2 = st.columns(2)
        with col1:
+           total = patrimonio + pasivo_total
+           if total > 0:
+               st.plotly_chart(self._figura_cacheada(('capital_torta', nit), crear_torta), use_container_width=True)
+       with col2:
+           st.plotly_chart(self._figura_cacheada(('endeudamiento_barras', nit), crear_barras),
+                           use_container_width=True)
+
+
+   def _create_profitability_charts(self, indicadores, nit):
+       """Crea gráficos de rentabilidad"""
+       def crear_barras():
            profit_metrics = {
                'ROA': indicadores.get('roa', 0),
                'ROE': indicadores.get('roe', 0),
@@ -1389,8 +4226,10 @@ class FinancialAnalyzerApp:
                title="Indicadores de Rentabilidad"
            )
            fig_bar.update_layout(yaxis_tickformat='.2%')
-           st.plotly_chart(fig_bar, use_container_width=True)
-       with col2:
+           return fig_bar
+
+
+       def crear_radar():
            categories = ['ROA', 'ROE', 'Margen Neto']
            values = [
                max(0, indicadores.get('roa', 0)),
@@ -1413,36 +4252,72 @@ class FinancialAnalyzerApp:
                showlegend=False,
                title="Análisis de Rentabilidad"
            )
-           st.plotly_chart(fig_radar, use_container_width=True)
+           return fig_radar
+
+
+       col1, col2 = st.columns(2)
+       with col1:
+           st.plotly_chart(self._figura_cacheada(('rentabilidad_barras', nit), crear_barras),
+                           use_container_width=True)
+       with col2:
+           st.plotly_chart(self._figura_cacheada(('rentabilidad_radar', nit), crear_radar), use_container_width=True)
+
+
+   def _create_trend_charts(self, nit):
+       """Crea gráficos de evolución de indicadores entre periodos"""
+       df_tendencias = self.period_store.calcular_tendencias(nits=[nit])
+       if df_tendencias.empty:
+           st.info("ℹ️ No hay periodos guardados para esta entidad.")
+           return
+
+
+       df_nit = df_tendencias.reset_index()
+       col1, col2 = st.columns(2)
+       with col1:
+           fig_liquidez = px.line(
+               df_nit,
+               x='periodo',
+               y=['razon_corriente', 'media_movil_razon_corriente'],
+               title="Evolución de la Razón Corriente",
+               markers=True
+           )
+           st.plotly_chart(fig_liquidez, use_container_width=True)
+       with col2:
+           fig_endeudamiento = px.line(
+               df_nit,
+               x='periodo',
+               y=['razon_endeudamiento', 'media_movil_razon_endeudamiento'],
+               title="Evolución del Endeudamiento",
+               markers=True
+           )
+           st.plotly_chart(fig_endeudamiento, use_container_width=True)
 
 
-   def _show_comparative_analysis(self, indicadores_por_nit, nit_principal, entidades_comparacion, entidades_opciones):
+       st.dataframe(df_nit, use_container_width=True)
+
+
+   def _show_comparative_analysis(self, indicadores_por_nit, nit_principal, nits_comparados):
        """Muestra análisis comparativo"""
        st.markdown("---")
        st.subheader("🔄 Análisis Comparativo")
 
 
-       nits_comparacion = [nit_principal]
-       for display_text in entidades_comparacion:
-           for nit, display, razon_social, tipo_entidad in entidades_opciones:
-               if display == display_text:
-                   nits_comparacion.append(nit)
-                   break
-
-
-       datos_comparativos = []
-       for nit in nits_comparacion:
-           if nit in indicadores_por_nit:
-               info = indicadores_por_nit[nit]
-               datos_comparativos.append({
-                   'Entidad': info['razon_social'],
-                   'Razón Corriente': info.get('razon_corriente', 0),
-                   'Endeudamiento': info.get('razon_endeudamiento', 0),
-                   'Margen Neto': info.get('margen_neto', 0)
-               })
+       nits_comparacion = [nit_principal] + list(nits_comparados)
 
 
-       df_comparacion = pd.DataFrame(datos_comparativos)
+       # Filas de la tabla compartida (vista memory-map); el diccionario solo si no hay tabla
+       df_indicadores = self._tabla_indicadores()
+       if df_indicadores is None:
+           df_indicadores = self.data_processor.indicadores_a_dataframe(indicadores_por_nit)
+       columnas_comparacion = {
+           'razon_social': 'Entidad',
+           'razon_corriente': 'Razón Corriente',
+           'razon_endeudamiento': 'Endeudamiento',
+           'margen_neto': 'Margen Neto'
+       }
+       nits_presentes = [nit for nit in nits_comparacion if nit in df_indicadores.index]
+       df_raw = df_indicadores.loc[nits_presentes, list(columnas_comparacion)].rename(columns=columnas_comparacion)
+       df_comparacion = df_raw.reset_index(drop=True)
 
 
        def format_ratios(val, is_percent=False):
@@ -1466,7 +4341,7 @@ class FinancialAnalyzerApp:
 
 
        metrics = ['Razón Corriente', 'Endeudamiento', 'Margen Neto']
-       df_raw = pd.DataFrame([d for d in datos_comparativos if d['Razón Corriente'] != 0])
+       df_raw = df_raw[df_raw['Razón Corriente'] != 0]
        if df_raw.empty:
            return
 
@@ -1514,101 +4389,430 @@ class FinancialAnalyzerApp:
        st.plotly_chart(fig_radar_comp, use_container_width=True)
 
 
-   def _show_risk_analysis(self):
-       """Muestra el módulo de análisis de riesgo"""
-       st.markdown('<div class="main-container">', unsafe_allow_html=True)
-       st.header("⚠️ Análisis y Predicción de Riesgo")
+   def _evaluar_riesgos(self, df_indicadores, nits):
+       """Evalúa el riesgo de un conjunto de entidades (filas de la tabla de indicadores) en una pasada vectorizada"""
+       nits = list(nits)
+       if not nits:
+           return pd.DataFrame()
 
 
-       indicadores_por_nit = st.session_state.get('indicadores_por_nit', None)
+       # Sin tendencias: el resultado se comparte entre sesiones con distinto histórico
+       return self.risk_predictor.predecir_riesgo_vectorizado(df_indicadores.loc[nits])
 
 
-       if not indicadores_por_nit:
-           st.warning(
-               "⚠️ Primero debes clasificar los datos financieros en el módulo anterior para calcular los indicadores.")
-           return
+   def _obtener_modelo_riesgo(self):
+       """Obtiene el modelo de riesgo persistido (cargado una vez por proceso)"""
+       ruta_modelo = MLRiskModel().ruta_modelo
+       if not os.path.exists(ruta_modelo):
+           return None
+       try:
+           return cargar_modelo_riesgo(ruta_modelo, os.path.getmtime(ruta_modelo))
+       except MLRiskModel.ERRORES_MODELO as e:
+           st.error(f"❌ No se pudo cargar el modelo de riesgo guardado: {str(e)}")
+           return None
 
 
-       st.success(f"✅ Calculando riesgo para {len(indicadores_por_nit)} entidades.")
+   def _show_model_training(self, df_indicadores):
+       """Permite entrenar el modelo de riesgo con etiquetas provistas por el analista"""
+       with st.expander("🤖 Entrenar modelo de riesgo"):
+           st.info("ℹ️ El archivo de etiquetas debe contener las columnas: nit y nivel_riesgo (ALTO/MEDIO/BAJO)")
+           archivo_etiquetas = st.file_uploader(
+               "Cargar archivo de etiquetas",
+               type=['csv', 'xlsx'],
+               key="archivo_etiquetas_riesgo"
+           )
+           algoritmo = st.selectbox(
+               "Algoritmo:",
+               ["logistic_regression", "gradient_boosting"],
+               key="algoritmo_modelo_riesgo"
+           )
 
 
-       df_indicadores = pd.DataFrame.from_dict(indicadores_por_nit, orient='index')
-       df_indicadores.index.name = 'nit'
-       df_indicadores = df_indicadores.reset_index()
+           if archivo_etiquetas is not None and st.button("🎓 Entrenar modelo", key="entrenar_modelo_riesgo"):
+               try:
+                   df_etiquetas, _ = self._load_dataframe(archivo_etiquetas)
+               except Exception:
+                   # El error ya se muestra en _load_dataframe
+                   return
 
 
-       riesgos = []
-       for index, row in df_indicadores.iterrows():
-           indicadores_input = row.drop(['nit', 'razon_social', 'tipo_entidad']).apply(pd.to_numeric,
-                                                                                       errors='coerce').to_dict()
+               try:
+                   columna_etiqueta = next(
+                       (col for col in ['nivel_riesgo', 'nivelriesgo', 'etiqueta'] if col in df_etiquetas.columns),
+                       None
+                   )
+                   if 'nit' not in df_etiquetas.columns or columna_etiqueta is None:
+                       st.error("❌ El archivo debe contener las columnas 'nit' y 'nivel_riesgo'")
+                       return
+
+
+                   etiquetas = df_etiquetas.drop_duplicates('nit').set_index('nit')[columna_etiqueta]
+                   modelo = MLRiskModel()
+                   metadatos = modelo.entrenar(df_indicadores, etiquetas, algoritmo)
+                   modelo.guardar()
+                   st.success(
+                       f"✅ Modelo entrenado con {metadatos['muestras']} entidades "
+                       f"(exactitud en entrenamiento: {metadatos['exactitud_entrenamiento']:.1%})"
+                   )
+               except MLRiskModel.ERRORES_MODELO as e:
+                   st.error(f"❌ No se pudo entrenar el modelo: {str(e)}")
+
+
+   def _obtener_tabla_indicadores(self, indicadores_por_nit, tabla_base=None):
+       """Obtiene la tabla de indicadores (con tendencias) en caché por versión de datos"""
+       version = st.session_state.get('version_datos', 0)
+       cache = st.session_state.get('cache_tabla_indicadores')
+       if cache is not None and cache['version'] == version:
+           return cache['tabla']
+
+
+       # Sin tendencias se usa directamente la vista compartida (o la tabla guardada elegida), sin copiarla
+       df_indicadores = tabla_base if tabla_base is not None else self._tabla_indicadores()
+       if df_indicadores is None:
+           df_indicadores = self.data_processor.indicadores_a_dataframe(indicadores_por_nit)
+       tendencias_por_nit = st.session_state.get('tendencias_por_nit')
+       if tendencias_por_nit:
+           df_indicadores = df_indicadores.join(pd.DataFrame.from_dict(tendencias_por_nit, orient='index'))
+
+
+       st.session_state.cache_tabla_indicadores = {'version': version, 'tabla': df_indicadores}
+       return df_indicadores
+
+
+   def _show_whatif_sidebar(self):
+       """Muestra los controles what-if de umbrales; retorna None si el modo está apagado"""
+       st.sidebar.markdown("---")
+       st.sidebar.markdown("### 🧪 Simulador What-if")
+       if not st.sidebar.toggle("Editar umbrales de riesgo", key="modo_whatif"):
+           return None
 
 
-           # Asegurar que los indicadores son números y no nulos para el predictor
-           if all(pd.notna(v) for v in indicadores_input.values()):
-               nivel_riesgo, score, factores = self.risk_predictor.predecir_riesgo(indicadores_input)
-           else:
-               nivel_riesgo, score, factores = "NO CALC.", 0.0, [("Datos insuficientes", 1.0)]
+       base = self.risk_predictor.umbrales
+       rangos = {
+           'liquidez_alto_riesgo': ("Liquidez - riesgo alto (<)", 0.0, 3.0, 0.05),
+           'liquidez_medio_riesgo': ("Liquidez - riesgo medio (<)", 0.0, 3.0, 0.05),
+           'endeudamiento_alto_riesgo': ("Endeudamiento - riesgo alto (>)", 0.0, 1.5, 0.05),
+           'endeudamiento_medio_riesgo': ("Endeudamiento - riesgo medio (>)", 0.0, 1.5, 0.05),
+           'margen_alto_riesgo': ("Margen neto - riesgo alto (<)", -0.5, 0.5, 0.01),
+           'margen_medio_riesgo': ("Margen neto - riesgo medio (<)", -0.5, 0.5, 0.01),
+           'caida_liquidez_riesgo': ("Caída de liquidez vs periodo anterior (≤)", -1.0, 0.0, 0.05),
+           'aumento_endeudamiento_riesgo': ("Aumento de endeudamiento vs periodo anterior (≥)", 0.0, 0.5, 0.01),
+       }
 
 
-           factores_str = ", ".join([f"{f[0]} ({f[1] * 100:.0f}%)" for f in factores])
-           riesgos.append({
-               'Nivel Riesgo': nivel_riesgo,
-               'Probabilidad': score,
-               'Factores Clave': factores_str
-           })
+       umbrales = {}
+       for parametro, (etiqueta, minimo, maximo, paso) in rangos.items():
+           umbrales[parametro] = st.sidebar.slider(
+               etiqueta, min_value=minimo, max_value=maximo, value=float(base[parametro]), step=paso,
+               key=f"whatif_{parametro}"
+           )
+       return umbrales
 
 
-       df_riesgos = pd.DataFrame(riesgos)
-       df_final = pd.concat([df_indicadores, df_riesgos], axis=1)
+   def _show_sensitivity_sweep(self, df_indicadores, umbrales):
+       """Muestra cuántas entidades cambian de nivel a lo largo de una grilla de umbrales"""
+       with st.expander("📉 Análisis de sensibilidad de umbrales"):
+           col1, col2 = st.columns([2, 1])
+           with col1:
+               parametro = st.selectbox("Umbral a variar:", list(umbrales.keys()), key="sensibilidad_parametro")
+           with col2:
+               n_puntos = st.number_input("Puntos de la grilla:", min_value=3, max_value=200, value=21,
+                                          key="sensibilidad_puntos")
+
+
+           valor_actual = umbrales[parametro]
+           amplitud = max(abs(valor_actual), 0.1)
+           minimo, maximo = st.slider(
+               "Rango del umbral:",
+               min_value=float(valor_actual - 2 * amplitud),
+               max_value=float(valor_actual + 2 * amplitud),
+               value=(float(valor_actual - amplitud), float(valor_actual + amplitud)),
+               key=f"sensibilidad_rango_{parametro}"
+           )
 
 
-       st.subheader("Tabla de Indicadores y Riesgo por Entidad")
+           # En caché por versión de datos, grilla y umbrales: los reruns de otros controles no lo recalculan
+           clave = (
+               st.session_state.get('version_datos', 0), parametro, minimo, maximo, int(n_puntos),
+               tuple(sorted(umbrales.items()))
+           )
+           cache = st.session_state.get('cache_barrido_sensibilidad')
+           if cache is None or cache['clave'] != clave:
+               df_barrido = self.risk_predictor.barrido_sensibilidad(
+                   df_indicadores, parametro, np.linspace(minimo, maximo, int(n_puntos)), umbrales
+               )
+               cache = {'clave': clave, 'tabla': df_barrido}
+               st.session_state.cache_barrido_sensibilidad = cache
+           df_barrido = cache['tabla']
+
+
+           fig = px.bar(
+               df_barrido,
+               x='valor_umbral',
+               y=['ALTO', 'MEDIO', 'BAJO'],
+               title=f"Entidades por nivel de riesgo según {parametro}",
+               color_discrete_map={'ALTO': '#dc3545', 'MEDIO': '#ffc107', 'BAJO': '#28a745'},
+               labels={'valor_umbral': parametro, 'value': 'Entidades', 'variable': 'Nivel Riesgo'}
+           )
+           st.plotly_chart(fig, use_container_width=True)
+           st.dataframe(df_barrido, use_container_width=True)
 
 
-       # Formatear columnas de ratios
-       columnas_ratio = ['razon_corriente', 'prueba_acida', 'razon_endeudamiento', 'leverage_financiero', 'roa', 'roe',
-                         'margen_neto', 'Probabilidad']
-       for col in columnas_ratio:
-           if col in df_final.columns:
-               if col == 'Probabilidad':
-                   df_final[col] = df_final[col].apply(lambda x: f"{x:.1%}" if not pd.isna(x) and x != 0.0 else 'N/A')
-               else:
-                   df_final[col] = pd.to_numeric(df_final[col], errors='coerce').apply(
-                       lambda x: f"{x:,.2f}" if not pd.isna(x) else 'N/A')
+   def _obtener_tabla_riesgo(self, df_indicadores, motor, umbrales_whatif, modelo_ml):
+       """Obtiene la tabla numérica de riesgo en caché por versión de datos y motor"""
+       clave = (
+           st.session_state.get('version_datos', 0),
+           motor,
+           tuple(sorted(umbrales_whatif.items())) if umbrales_whatif is not None else None,
+           modelo_ml.metadatos.get('fecha_entrenamiento') if motor == "Modelo ML" else None
+       )
+       cache = st.session_state.get('cache_tabla_riesgo')
+       if cache is not None and cache['clave'] == clave:
+           return cache['tabla']
+
+
+       if umbrales_whatif is not None:
+           # Re-scoring instantáneo sobre los indicadores en caché, sin reclasificar
+           df_riesgos = self.risk_predictor.predecir_riesgo_vectorizado(df_indicadores, umbrales_whatif)
+       elif motor == "Modelo ML":
+           df_riesgos = modelo_ml.predecir_lote(df_indicadores)
+           df_riesgos['Factores Clave'] = f"Modelo {modelo_ml.metadatos.get('algoritmo', 'ML')}"
+       elif st.session_state.get('tendencias_por_nit'):
+           # Las tendencias son propias de la sesión: se evalúan sobre la tabla que ya las incluye
+           df_riesgos = self.risk_predictor.predecir_riesgo_vectorizado(df_indicadores)
+       else:
+           # Reutilizar el riesgo compartido calculado (y parchado) en la clasificación, sin modificarlo
+           riesgos_por_nit = self._resultado('riesgos_por_nit') or {}
+           df_riesgos = self._evaluar_riesgos(
+               df_indicadores, df_indicadores.index.difference(list(riesgos_por_nit))
+           )
+           if riesgos_por_nit:
+               df_riesgos = pd.concat([pd.DataFrame.from_dict(riesgos_por_nit, orient='index'), df_riesgos])
+           df_riesgos = df_riesgos.reindex(df_indicadores.index)
 
 
-       # Formatear valores monetarios
-       columnas_monetarias = ['activo_total', 'pasivo_total', 'utilidad_neta', 'ventas', 'activo_corriente',
-                              'pasivo_corriente', 'patrimonio']
-       for col in columnas_monetarias:
+       df_final = df_indicadores.join(df_riesgos).reset_index()
+
+
+       columnas_numericas = RATIOS_FINANCIEROS + ['activo_total', 'pasivo_total', 'utilidad_neta', 'ventas',
+                                                  'activo_corriente', 'pasivo_corriente', 'patrimonio']
+       for col in columnas_numericas:
            if col in df_final.columns:
-               df_final[col] = pd.to_numeric(df_final[col], errors='coerce').apply(
-                   lambda x: f"${x:,.0f}" if not pd.isna(x) else 'N/A')
+               df_final[col] = pd.to_numeric(df_final[col], errors='coerce')
+       df_final['Probabilidad'] = df_final['Probabilidad'].where(df_final['Nivel Riesgo'] != 'NO CALC.')
+       df_final['Semáforo'] = df_final['Nivel Riesgo'].map(
+           {'ALTO': '🔴', 'MEDIO': '🟡', 'BAJO': '🟢'}
+       ).fillna('⚪')
+
+
+       st.session_state.cache_tabla_riesgo = {'clave': clave, 'tabla': df_final}
+       return df_final
+
+
+   def _configuracion_columnas_riesgo(self):
+       """Formato de visualización de la tabla de riesgo (los datos permanecen numéricos)"""
+       formato_ratio = st.column_config.NumberColumn(format="%.2f")
+       formato_moneda = st.column_config.NumberColumn(format="dollar")
+       return {
+           'nit': st.column_config.TextColumn("NIT"),
+           'Semáforo': st.column_config.TextColumn("", width="small"),
+           'Probabilidad': st.column_config.NumberColumn(format="percent"),
+           'razon_corriente': formato_ratio,
+           'prueba_acida': formato_ratio,
+           'razon_endeudamiento': formato_ratio,
+           'leverage_financiero': formato_ratio,
+           'roa': formato_ratio,
+           'roe': formato_ratio,
+           'margen_neto': formato_ratio,
+           'activo_total': formato_moneda,
+           'pasivo_total': formato_moneda,
+           'utilidad_neta': formato_moneda,
+           'ventas': formato_moneda,
+           'activo_corriente': formato_moneda,
+           'pasivo_corriente': formato_moneda,
+           'patrimonio': formato_moneda,
+       }
+
+
+   def _restaurar_indicadores_guardados(self):
+       """Permite retomar una tabla guardada en disco (p. ej. tras reiniciar el servidor); retorna su vista"""
+       tablas = self.indicator_store.disponibles()
+       if not tablas:
+           return None
+
+
+       opciones = {
+           f"{tabla['fecha']} - {tabla['entidades']:,} entidades": tabla['clave'] for tabla in tablas
+       }
+       seleccion = st.selectbox(
+           "📂 Indicadores guardados de clasificaciones anteriores:",
+           ['Ninguno'] + list(opciones),
+           key="indicadores_guardados_riesgo"
+       )
+       clave = opciones.get(seleccion)
+       if clave != st.session_state.get('clave_indicadores_guardados'):
+           st.session_state.clave_indicadores_guardados = clave
+           st.session_state.version_datos = st.session_state.get('version_datos', 0) + 1
+       if clave is None:
+           return None
+       return self._tabla_indicadores(clave)
+
+
+   def _obtener_matriz_cuentas(self):
+       """Matriz NIT × cuenta de la clasificación (compartida si la calculó el trabajo de clasificación)"""
+       matriz = self._resultado('matriz_cuentas')
+       if matriz is not None:
+           return matriz
+
+
+       version = st.session_state.get('version_datos', 0)
+       cache = st.session_state.get('cache_matriz_cuentas')
+       if cache is None or cache['version'] != version:
+           df_clasificado = self._resultado('df_clasificado')
+           matriz = AccountMatrix(df_clasificado) if df_clasificado is not None else None
+           cache = {'version': version, 'matriz': matriz}
+           st.session_state.cache_matriz_cuentas = cache
+       return cache['matriz']
+
+
+   def _show_custom_indicators(self, df_final):
+       """Indicadores definidos por el usuario con fórmulas sobre los totales por categoría"""
+       matriz = self._obtener_matriz_cuentas()
+       if matriz is None:
+           return
+
+
+       with st.expander("🧮 Indicadores personalizados"):
+           st.caption(
+               "Una fórmula por línea con el formato `nombre = fórmula`. Use las categorías, prefijos de "
+               "código PUC entre corchetes (p. ej. `[12]`), números, `+ - * /` y paréntesis. "
+               "Las divisiones por cero valen 0."
+           )
+           texto = st.text_area(
+               "Fórmulas:",
+               value='\n'.join(f"{nombre} = {formula}" for nombre, formula in IndicatorFormula.PREDEFINIDAS.items()),
+               height=150,
+               key="formulas_indicadores"
+           )
+
+
+           formulas = {}
+           for numero, linea in enumerate(texto.splitlines(), start=1):
+               if not linea.strip():
+                   continue
+               nombre, separador, formula = linea.partition('=')
+               if not separador or not nombre.strip():
+                   st.error(f"❌ Línea {numero}: use el formato `nombre = fórmula`")
+                   continue
+               try:
+                   formulas[nombre.strip()] = IndicatorFormula(formula)
+               except ValueError as e:
+                   st.error(f"❌ Línea {numero} ({nombre.strip()}): {str(e)}")
+           if not formulas:
+               return
+
+
+           # Todas las fórmulas se evalúan juntas sobre todos los NITs
+           df_personalizados = IndicatorFormula.evaluar_formulas(formulas, matriz)
+           df_personalizados = df_final.set_index('nit')[['razon_social', 'Nivel Riesgo']].join(
+               df_personalizados, how='inner'
+           ).reset_index()
+           st.dataframe(df_personalizados, use_container_width=True, hide_index=True)
+           st.download_button(
+               "📥 Descargar indicadores personalizados",
+               data=lambda: df_personalizados.to_csv(index=False),
+               file_name="indicadores_personalizados.csv"
+           )
 
 
-       def highlight_risk(s):
-           if 'Nivel Riesgo' in s and s['Nivel Riesgo'] == 'ALTO':
-               return ['background-color: #f8d7da'] * len(s)
-           elif 'Nivel Riesgo' in s and s['Nivel Riesgo'] == 'MEDIO':
-               return ['background-color: #fff3cd'] * len(s)
-           elif 'Nivel Riesgo' in s and s['Nivel Riesgo'] == 'BAJO':
-               return ['background-color: #d4edda'] * len(s)
-           return [''] * len(s)
+   def _show_risk_analysis(self):
+       """Muestra el módulo de análisis de riesgo"""
+       st.markdown('<div class="main-container">', unsafe_allow_html=True)
+       st.header("⚠️ Análisis y Predicción de Riesgo")
+
+
+       # Indicadores de la clasificación o, sin ella, una tabla guardada (vista memory-map, sin pasar a dict)
+       indicadores_por_nit = self._resultado('indicadores_por_nit')
+       tabla_guardada = None
+       if not indicadores_por_nit:
+           tabla_guardada = self._restaurar_indicadores_guardados()
+           if tabla_guardada is None or tabla_guardada.empty:
+               st.warning(
+                   "⚠️ Primero debes clasificar los datos financieros en el módulo anterior para calcular los "
+                   "indicadores.")
+               return
+
+
+       df_indicadores = self._obtener_tabla_indicadores(indicadores_por_nit, tabla_guardada)
+       st.success(f"✅ Calculando riesgo para {len(df_indicadores)} entidades.")
+
+
+       self._show_model_training(df_indicadores)
+       modelo_ml = self._obtener_modelo_riesgo()
+       umbrales_whatif = self._show_whatif_sidebar()
+
+
+       motor = st.radio(
+           "Motor de scoring:",
+           ["Reglas", "Modelo ML"] if modelo_ml is not None and umbrales_whatif is None else ["Reglas"],
+           horizontal=True,
+           key="motor_scoring_riesgo"
+       )
+
+
+       if umbrales_whatif is not None:
+           st.info("🧪 Modo what-if activo: el riesgo se calcula con los umbrales de la barra lateral.")
+           self._show_sensitivity_sweep(df_indicadores, umbrales_whatif)
+
+
+       try:
+           df_final = self._obtener_tabla_riesgo(
+               df_indicadores, motor, umbrales_whatif, modelo_ml
+           )
+       except MLRiskModel.ERRORES_MODELO as e:
+           if motor != "Modelo ML":
+               raise
+           st.error(f"❌ El modelo de riesgo no pudo evaluar las entidades ({str(e)}); se usa el motor de reglas")
+           df_final = self._obtener_tabla_riesgo(df_indicadores, "Reglas", umbrales_whatif, None)
+
+
+       st.subheader("Tabla de Indicadores y Riesgo por Entidad")
 
 
        columnas_a_mostrar = [
-           'nit', 'razon_social', 'tipo_entidad', 'Nivel Riesgo', 'Probabilidad',
+           'nit', 'razon_social', 'tipo_entidad', 'Semáforo', 'Nivel Riesgo', 'Probabilidad',
            'razon_corriente', 'razon_endeudamiento', 'margen_neto',
            'utilidad_neta', 'Factores Clave'
        ]
 
 
        columnas_existentes = [col for col in columnas_a_mostrar if col in df_final.columns]
+       df_display = df_final[columnas_existentes]
+
+
+       # El resaltado por fila con Styler solo es viable en tablas pequeñas
+       if len(df_display) <= self.MAX_FILAS_ESTILO:
+           colores = np.select(
+               [df_display['Nivel Riesgo'].eq('ALTO'), df_display['Nivel Riesgo'].eq('MEDIO'),
+                df_display['Nivel Riesgo'].eq('BAJO')],
+               ['background-color: #f8d7da', 'background-color: #fff3cd', 'background-color: #d4edda'],
+               ''
+           )
+
+
+           def highlight_risk(df):
+               return pd.DataFrame(np.repeat(colores[:, None], df.shape[1], axis=1),
+                                   index=df.index, columns=df.columns)
+
+
+           df_display = df_display.style.apply(highlight_risk, axis=None)
 
 
        st.dataframe(
-           df_final[columnas_existentes].style.apply(highlight_risk, axis=1),
-           use_container_width=True
+           df_display,
+           use_container_width=True,
+           hide_index=True,
+           column_config=self._configuracion_columnas_riesgo()
        )
 
 
@@ -1631,9 +4835,13 @@ class FinancialAnalyzerApp:
        st.plotly_chart(fig, use_container_width=True)
 
 
+       self._show_custom_indicators(df_final)
+
+
        st.download_button(
            "📥 Descargar Análisis de Riesgo",
-           data=df_final.to_csv(index=False),
+           # El CSV se genera solo al hacer clic, en un hilo aparte
+           data=lambda: df_final.drop(columns=['Semáforo']).to_csv(index=False),
            file_name="analisis_riesgo_eps_ips.csv",
            type="primary"
        )
@@ -1644,14 +4852,13 @@ class FinancialAnalyzerApp:
 
 if __name__ == '__main__':
    # Inicializar session state si es la primera ejecución
-   if 'df_validacion' not in st.session_state:
-       st.session_state.df_validacion = None
-   if 'info_entidades' not in st.session_state:
-       st.session_state.info_entidades = None
-   if 'df_clasificado' not in st.session_state:
-       st.session_state.df_clasificado = None
-   if 'indicadores_por_nit' not in st.session_state:
-       st.session_state.indicadores_por_nit = None
+   # Los resultados viven en el almacén compartido; la sesión guarda solo sus claves
+   if 'clave_validacion' not in st.session_state:
+       st.session_state.clave_validacion = None
+   if 'clave_clasificacion' not in st.session_state:
+       st.session_state.clave_clasificacion = None
+   if 'version_datos' not in st.session_state:
+       st.session_state.version_datos = 0
    # FIX: Inicializar la bandera de clasificación
    if 'data_just_classified' not in st.session_state:
        st.session_state.data_just_classified = False